@@ -1,23 +1,60 @@
 import gradio as gr
 import os
+import logging
 from google import genai
 import functools
 from frontend import initial_bpmn_xml, head_html
-from gemini_handler import get_bpmn_from_gemini_internal
+from frontend_assets import mount_assets
+from gemini_handler import astream_bpmn_from_gemini_internal, prewarm_sessions
+from gemini_router import Router
+from metrics import Metrics
+from response_cache import ResponseCache
+from revision_store import RevisionStore, safe_diff
+from session_store import SessionStore
 
 API_KEY = os.environ.get("GEMINI_API_KEY")
 #API_KEY = os.environ.get("GEMINI_FREE_API_KEY")
-if API_KEY:
+if os.environ.get("TACITFLOW_FAKE_GEMINI") == "1":
+    # Local fake model (fake_gemini.py) – no key, no network
+    from fake_gemini import FakeClient
+    client = FakeClient.from_env()
+    GEMINI_API_AVAILABLE = True
+elif API_KEY:
     client = genai.Client(api_key=API_KEY)
     GEMINI_API_AVAILABLE = True
 else:
     client = None
     GEMINI_API_AVAILABLE = False
 
+# Concurrency: the handler is an async generator, so a request waiting on
+# Gemini costs an event-loop task rather than a worker thread.  These caps
+# bound in-flight model calls and the number of queued requests.
+GEMINI_CONCURRENCY = int(os.environ.get("TACITFLOW_CONCURRENCY", 200))
+QUEUE_MAX_SIZE = int(os.environ.get("TACITFLOW_QUEUE_SIZE", 1000))
+
+# Per-request traces (phase latencies, tokens, payload, errors) – served on
+# /metrics (Prometheus) and /metrics.json next to the UI
+metrics = Metrics()
+
+# Model routing and call policy; with TACITFLOW_QUOTA_* set it also holds the
+# scheduler that admits calls within the project quota, fairly per session
+router = Router.from_env()
+
+# Chat sessions and each session's diagram revisions (undo / redo / history);
+# both are memory LRUs or SQLite files shared by all workers
+sessions = SessionStore.from_env()
+revisions = RevisionStore.from_env()
+
+# Async generator handler: Gradio pushes every yield to the chat and canvas,
+# so the diagram appears as soon as its XML block has streamed in.
 get_bpmn_handler = functools.partial(
-    get_bpmn_from_gemini_internal,
+    astream_bpmn_from_gemini_internal,
     client=client,
-    gemini_api_available=GEMINI_API_AVAILABLE
+    gemini_api_available=GEMINI_API_AVAILABLE,
+    cache=ResponseCache.from_env(),
+    router=router,
+    sessions=sessions,
+    metrics=metrics,
 )
 
 # ------------------------------------------------------------------------
@@ -26,7 +63,7 @@ get_bpmn_handler = functools.partial(
 #   2. include it in .then() outputs / inputs
 # ------------------------------------------------------------------------
 with gr.Blocks(head=head_html, title="BPMN Chatbot") as demo:
-    chat_state = gr.State()
+    chat_state = gr.State()         # session id; history lives in SessionStore
     gr.Markdown("# 🤖 BPMN Generation Chatbot")
     gr.Markdown("Describe a business process to generate a BPMN diagram. Once you have a model, ask for comments or analysis to identify improvement opportunities for AS-IS to TO-BE transformation.")
 
@@ -54,10 +91,86 @@ with gr.Blocks(head=head_html, title="BPMN Chatbot") as demo:
                                               elem_id="overlay_specs",
                                               visible=False)
 
+            with gr.Row(visible=revisions is not None):
+                undo_btn = gr.Button("↶ Undo", size="sm")
+                redo_btn = gr.Button("↷ Redo", size="sm")
+            with gr.Accordion("History", open=False, visible=revisions is not None):
+                revision_list = gr.Dropdown(label="Revisions", choices=[], interactive=True)
+                with gr.Row():
+                    checkout_btn = gr.Button("Restore", size="sm")
+                    compare_btn = gr.Button("Compare with current", size="sm")
+
     # -------------------- callback wiring (one extra output) -------------
     def _add_user_msg(user_msg, chat_hist):
         return chat_hist + [[user_msg, None]], ""
 
+    # -------------------- revisions (no model call) ----------------------
+    _EMPTY_SESSION = {"earlier": [], "history": []}
+
+    def _revision_choices(session_id):
+        entries = revisions.log(session_id) if revisions and session_id else []
+        choices = [
+            (f"#{e['seq']} {e['label'] or '(no prompt)'}"
+             + (" – current" if e["head"] else "") + (" – other branch" if e["branch"] else ""),
+             e["id"])
+            for e in reversed(entries)
+        ]
+        head = next((e["id"] for e in entries if e["head"]), None)
+        return gr.update(choices=choices, value=head)
+
+    def _record_revision(session_id, xml, overlays, chat_hist):
+        """After each turn: the diagram it left on screen becomes the head."""
+        if revisions is None or not session_id:
+            return gr.update()
+        if revisions.head(session_id) is None:
+            # The empty canvas is the root, so the first diagram can be undone
+            revisions.commit(session_id, initial_bpmn_xml, "[]",
+                             label="Empty diagram", session=_EMPTY_SESSION)
+        prompt = next((user for user, _ in reversed(chat_hist) if user), "")
+        revisions.commit(session_id, xml, overlays, label=prompt,
+                         session=sessions.load(session_id))
+        return _revision_choices(session_id)
+
+    def _show_revision(session_id, chat_hist, revision, note):
+        if revision is None:
+            return gr.update(), gr.update(), chat_hist + [[None, note]], gr.update()
+        if revision.session is not None:
+            # Gemini's memory goes back with the diagram
+            sessions.restore(session_id, revision.session)
+        return (revision.xml, revision.overlays,
+                chat_hist + [[None, f"{note} #{revision.seq}: {revision.label or '(no prompt)'}"]],
+                _revision_choices(session_id))
+
+    def _undo(session_id, chat_hist):
+        revision = revisions.undo(session_id) if session_id else None
+        return _show_revision(session_id, chat_hist, revision,
+                              "Back to" if revision else "Nothing to undo.")
+
+    def _redo(session_id, chat_hist):
+        revision = revisions.redo(session_id) if session_id else None
+        return _show_revision(session_id, chat_hist, revision,
+                              "Forward to" if revision else "Nothing to redo.")
+
+    def _checkout(session_id, rid, chat_hist):
+        revision = revisions.checkout(session_id, rid) if session_id and rid else None
+        return _show_revision(session_id, chat_hist, revision,
+                              "Restored" if revision else "Pick a revision first.")
+
+    def _compare(session_id, rid, chat_hist):
+        head = revisions.head(session_id) if session_id else None
+        if head is None or not rid:
+            return chat_hist + [[None, "Pick a revision first."]]
+        return chat_hist + [[None, "**Changes from the selected revision to the current one:**\n"
+                             + safe_diff(revisions, session_id, rid, head.id)]]
+
+    revision_outputs = [bpmn_xml_output, overlay_specs_output, chatbot, revision_list]
+    undo_btn.click(_undo, inputs=[chat_state, chatbot], outputs=revision_outputs, queue=False)
+    redo_btn.click(_redo, inputs=[chat_state, chatbot], outputs=revision_outputs, queue=False)
+    checkout_btn.click(_checkout, inputs=[chat_state, revision_list, chatbot],
+                       outputs=revision_outputs, queue=False)
+    compare_btn.click(_compare, inputs=[chat_state, revision_list, chatbot],
+                      outputs=[chatbot], queue=False)
+
     user_input.submit(
         fn=_add_user_msg,
         inputs=[user_input, chatbot],
@@ -68,7 +181,14 @@ with gr.Blocks(head=head_html, title="BPMN Chatbot") as demo:
         # inputs are unchanged – chat_state & XML suffice
         inputs=[chatbot, chat_state, bpmn_xml_output],
         # now FOUR outputs in the order expected by gemini_handler
-        outputs=[chatbot, bpmn_xml_output, overlay_specs_output, chat_state]
+        outputs=[chatbot, bpmn_xml_output, overlay_specs_output, chat_state],
+        concurrency_limit=GEMINI_CONCURRENCY,
+        concurrency_id="gemini",
+    ).then(
+        fn=_record_revision,
+        inputs=[chat_state, bpmn_xml_output, overlay_specs_output, chatbot],
+        outputs=[revision_list],
+        queue=False,
     )
 
     submit_btn.click(
@@ -79,10 +199,57 @@ with gr.Blocks(head=head_html, title="BPMN Chatbot") as demo:
     ).then(
         fn=get_bpmn_handler,
         inputs=[chatbot, chat_state, bpmn_xml_output],
-        outputs=[chatbot, bpmn_xml_output, overlay_specs_output, chat_state]
+        outputs=[chatbot, bpmn_xml_output, overlay_specs_output, chat_state],
+        concurrency_limit=GEMINI_CONCURRENCY,
+        concurrency_id="gemini",
+    ).then(
+        fn=_record_revision,
+        inputs=[chat_state, bpmn_xml_output, overlay_specs_output, chatbot],
+        outputs=[revision_list],
+        queue=False,
     )
 
+demo.queue(default_concurrency_limit=GEMINI_CONCURRENCY, max_size=QUEUE_MAX_SIZE)
+
+
+def create_server():
+    """
+    FastAPI app serving the metrics endpoints and the vendored bpmn-js
+    assets, with the Gradio UI mounted at /.
+    """
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
+
+    server = FastAPI()
+
+    @server.get("/metrics")
+    def prometheus_metrics():
+        return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+    @server.get("/metrics.json")
+    def json_metrics():
+        snapshot = metrics.snapshot()
+        if router.scheduler is not None:
+            snapshot["scheduler"] = router.scheduler.stats()
+        return JSONResponse(snapshot)
+
+    mount_assets(server)
+    return gr.mount_gradio_app(server, demo, path="/")
+
+
 if __name__ == "__main__":
+    import uvicorn
+
+    logging.basicConfig(
+        level=os.environ.get("TACITFLOW_LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
     if not GEMINI_API_AVAILABLE:
-        print("WARNING: GEMINI_API_KEY not found – the app will run offline.")
-    demo.launch()
+        logging.warning("GEMINI_API_KEY not found – the app will run offline.")
+    elif os.environ.get("TACITFLOW_CONTEXT_CACHE", "0") == "1":
+        prewarm_sessions(client)
+    uvicorn.run(
+        create_server(),
+        host=os.environ.get("GRADIO_SERVER_NAME", "127.0.0.1"),
+        port=int(os.environ.get("GRADIO_SERVER_PORT", 7860)),
+    )
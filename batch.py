@@ -0,0 +1,366 @@
+"""
+batch.py
+--------
+Headless batch generation: many process descriptions in, one ``.bpmn``
+file (plus its overlay comments) per description out – no UI involved.
+
+Built on ``aget_bpmn_from_gemini_internal``, so prompts, routing, retries,
+validation, the response cache and request traces are exactly those of
+the chat.  On top of that:
+
+  • bounded parallelism – ``--concurrency`` workers share one event loop
+    (the handler awaits Gemini, it never holds a thread);
+  • rate limits – ``--rpm`` requests and ``--tpm`` tokens per minute,
+    enforced per Gemini call by the router's scheduler (retries, hedges
+    and section calls count too) and shared by all workers;
+  • checkpointing – every finished item appends one line to
+    ``checkpoint.jsonl`` in the output directory; a rerun skips items that
+    already succeeded with the same prompt, so an interrupted run resumes
+    without paying for them again;
+  • results are written as soon as an item finishes (atomically, so a
+    killed run never leaves half a file): ``<id>.bpmn`` and
+    ``<id>.overlays.json``.
+
+Input is a JSON-lines file – one ``{"id": ..., "prompt": ..., "followups":
+[...]}`` object per line, ``id`` and ``followups`` optional – or a
+directory of ``.txt`` / ``.md`` files (id = file name, prompt = content).
+Follow-ups are sent as further turns of the same session, like chat
+messages after the first diagram.
+
+Usage
+    python batch.py prompts.jsonl --out diagrams/
+    python batch.py docs/processes/ --out diagrams/ --concurrency 16 --rpm 120
+    TACITFLOW_FAKE_GEMINI=1 python batch.py prompts.jsonl --out /tmp/dry-run
+"""
+
+import argparse
+import asyncio
+import collections
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+from frontend import initial_bpmn_xml
+from gemini_handler import aget_bpmn_from_gemini_internal
+from gemini_router import Router
+from gemini_scheduler import Scheduler
+from metrics import Metrics
+from response_cache import ResponseCache
+from session_store import SessionStore
+
+logger = logging.getLogger("tacitflow.batch")
+
+CHECKPOINT = "checkpoint.jsonl"
+DEFAULT_CONCURRENCY = 8
+PROMPT_SUFFIXES = (".txt", ".md")
+_SUCCESS = ("ok", "cached", "local")
+
+
+class BatchError(Exception):
+    """An item's reply could not be turned into a diagram."""
+
+
+# ------------------------------------------------------------------------
+#  Input
+# ------------------------------------------------------------------------
+def _safe_id(value: str) -> str:
+    """*value* as a file name stem."""
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip("._") or "item"
+
+
+def load_items(path: str) -> list:
+    """
+    Items of a JSON-lines file or a directory of prompt files, as dicts
+    ``{"id", "prompt", "followups"}`` in input order.  Duplicate ids raise.
+    """
+    items = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stem, suffix = os.path.splitext(name)
+            if suffix.lower() not in PROMPT_SUFFIXES:
+                continue
+            with open(os.path.join(path, name), encoding="utf-8") as fh:
+                prompt = fh.read().strip()
+            if prompt:
+                items.append({"id": _safe_id(stem), "prompt": prompt, "followups": []})
+    else:
+        with open(path, encoding="utf-8") as fh:
+            for number, line in enumerate(fh, 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    record = {"prompt": record}
+                if not isinstance(record, dict):
+                    raise ValueError(f"{path}:{number}: item is not an object or a string")
+                prompt = record.get("prompt")
+                if not isinstance(prompt, str) or not prompt.strip():
+                    raise ValueError(f"{path}:{number}: item without a text prompt")
+                followups = record.get("followups") or []
+                if not isinstance(followups, list):
+                    raise ValueError(f"{path}:{number}: followups must be a list")
+                items.append({
+                    "id": _safe_id(record.get("id") or f"item-{number:05d}"),
+                    "prompt": prompt.strip(),
+                    "followups": [str(f) for f in followups],
+                })
+
+    seen = set()
+    for item in items:
+        if item["id"] in seen:
+            raise ValueError(f"duplicate item id {item['id']!r}")
+        seen.add(item["id"])
+    return items
+
+
+def _fingerprint(item: dict) -> str:
+    """Changes whenever the item's prompts change – a finished item is redone then."""
+    text = json.dumps([item["prompt"], item["followups"]], ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+# ------------------------------------------------------------------------
+#  Checkpoint and output files
+# ------------------------------------------------------------------------
+def read_checkpoint(out_dir: str) -> dict:
+    """Last checkpoint record per item id (a truncated last line is ignored)."""
+    records = {}
+    path = os.path.join(out_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record["id"]] = record
+    return records
+
+
+def _write_atomic(path: str, text: str):
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write_outputs(out_dir: str, item_id: str, xml: str, overlays: str) -> list:
+    files = [f"{item_id}.bpmn", f"{item_id}.overlays.json"]
+    _write_atomic(os.path.join(out_dir, files[0]), xml)
+    _write_atomic(os.path.join(out_dir, files[1]), overlays)
+    return files
+
+
+class _TraceProbe:
+    """Metrics stand-in that forwards to the registry and keeps the last trace."""
+
+    def __init__(self, metrics, **fields):
+        self.metrics = metrics
+        self.fields = fields
+        self.last = None
+
+    def trace(self, **fields):
+        self.last = self.metrics.trace(**self.fields, **fields)
+        return self.last
+
+
+# ------------------------------------------------------------------------
+#  Runner
+# ------------------------------------------------------------------------
+class BatchRunner:
+    """
+    Parameters
+    ----------
+    client : genai.Client | fake_gemini.FakeClient
+        Shared by all workers.
+    out_dir : str
+        Receives ``<id>.bpmn``, ``<id>.overlays.json`` and the checkpoint.
+    concurrency : int
+        Items generated at the same time.
+    rpm, tpm : float | None
+        Gemini requests / tokens per minute across all workers; either one
+        runs the batch on a copy of the router with a scheduler for that
+        quota (the breaker and latency stats stay shared).
+    cache, router, sessions, metrics
+        As for ``aget_bpmn_from_gemini_internal``; sessions default to an
+        in-memory store (a session only lives for one item).
+    retry_failed : bool
+        Rerun items whose last attempt failed (default); False skips them
+        too, so only new items are generated.
+    """
+
+    def __init__(self, client, out_dir, concurrency=DEFAULT_CONCURRENCY, rpm=None, tpm=None,
+                 cache=None, router=None, sessions=None, metrics=None, retry_failed=True):
+        self.client = client
+        self.out_dir = out_dir
+        self.concurrency = max(1, int(concurrency))
+        self.cache = cache
+        self.router = router or Router.from_env()
+        if rpm or tpm:
+            # A copy, so a router the caller shares keeps its own scheduler;
+            # a batch waits as long as the quota needs instead of failing items
+            self.router = copy.copy(self.router)
+            self.router.scheduler = Scheduler(rpm=rpm, tpm=tpm, max_wait=float("inf"))
+        self.sessions = sessions or SessionStore(max_sessions=max(64, 4 * self.concurrency))
+        self.metrics = metrics or Metrics()
+        self.retry_failed = retry_failed
+
+    def pending(self, items: list) -> list:
+        """Items still to generate according to the checkpoint."""
+        done = read_checkpoint(self.out_dir)
+        pending = []
+        for item in items:
+            record = done.get(item["id"])
+            if record is not None and record.get("fingerprint") == _fingerprint(item):
+                if record["status"] in _SUCCESS or not self.retry_failed:
+                    continue
+            pending.append(item)
+        return pending
+
+    async def generate(self, item: dict) -> dict:
+        """Run the item's turns; returns ``{"xml", "overlays", "traces"}``."""
+        chat_history = []
+        xml, overlays, state = initial_bpmn_xml, "[]", None
+        traces = []
+        for turn, prompt in enumerate([item["prompt"]] + item["followups"]):
+            probe = _TraceProbe(self.metrics, batch_item=item["id"], batch_turn=turn)
+            chat_history.append([prompt, None])
+            chat_history, new_xml, new_overlays, state = await aget_bpmn_from_gemini_internal(
+                chat_history, state, xml, self.client, True,
+                self.cache, self.router, self.sessions, probe,
+            )
+            record = probe.last.record if probe.last is not None else None
+            if record is not None:
+                traces.append(record)
+            outcome = record["outcome"] if record is not None else "error"
+            if outcome not in _SUCCESS:
+                raise BatchError(f"turn {turn}: {outcome}: {chat_history[-1][1]}")
+            xml, overlays = new_xml, new_overlays
+        return {"xml": xml, "overlays": overlays, "traces": traces}
+
+    async def run(self, items: list, on_result=None) -> dict:
+        """
+        Generate every pending item; returns a summary.  *on_result* is
+        called with each checkpoint record as soon as its item finished.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        pending = self.pending(items)
+        queue = collections.deque(pending)
+        counts = collections.Counter()
+        started = time.perf_counter()
+        checkpoint = open(os.path.join(self.out_dir, CHECKPOINT), "a", encoding="utf-8")
+
+        async def worker():
+            while queue:
+                item = queue.popleft()
+                item_started = time.perf_counter()
+                record = {"id": item["id"], "fingerprint": _fingerprint(item)}
+                try:
+                    result = await self.generate(item)
+                    files = await asyncio.to_thread(
+                        _write_outputs, self.out_dir, item["id"],
+                        result["xml"], result["overlays"],
+                    )
+                    traces = result["traces"]
+                    record.update(
+                        status="cached" if all(t["outcome"] == "cached" for t in traces) else "ok",
+                        files=files,
+                        input_tokens=sum(t.get("input_tokens", 0) for t in traces),
+                        output_tokens=sum(t.get("output_tokens", 0) for t in traces),
+                    )
+                except Exception as exc:
+                    record.update(status="failed", error=str(exc)[:500])
+                record["seconds"] = round(time.perf_counter() - item_started, 3)
+                counts[record["status"]] += 1
+                # One line per finished item: resuming depends on it being on disk
+                checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                if on_result is not None:
+                    on_result(record)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)))))
+        finally:
+            checkpoint.close()
+        elapsed = time.perf_counter() - started
+        return {
+            "items": len(items),
+            "skipped": len(items) - len(pending),
+            "ok": counts["ok"],
+            "cached": counts["cached"],
+            "failed": counts["failed"],
+            "seconds": round(elapsed, 3),
+            "items_per_second": round(len(pending) / elapsed, 3) if elapsed > 0 else None,
+        }
+
+
+def run_batch(items, out_dir, client, **options) -> dict:
+    """Synchronous :meth:`BatchRunner.run` (same options)."""
+    on_result = options.pop("on_result", None)
+    return asyncio.run(BatchRunner(client, out_dir, **options).run(items, on_result))
+
+
+def _client_from_env():
+    """The client app.py would use: fake model, Gemini, or None without a key."""
+    if os.environ.get("TACITFLOW_FAKE_GEMINI") == "1":
+        from fake_gemini import FakeClient
+        return FakeClient.from_env()
+    if os.environ.get("GEMINI_API_KEY"):
+        from google import genai
+        return genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="JSON-lines file or directory of .txt / .md prompts")
+    parser.add_argument("--out", required=True, help="output directory (also holds the checkpoint)")
+    parser.add_argument("--concurrency", type=int,
+                        default=int(os.environ.get("TACITFLOW_BATCH_CONCURRENCY", DEFAULT_CONCURRENCY)))
+    parser.add_argument("--rpm", type=float, default=float(os.environ.get("TACITFLOW_BATCH_RPM", 0)) or None,
+                        help="max. requests per minute")
+    parser.add_argument("--tpm", type=float, default=float(os.environ.get("TACITFLOW_BATCH_TPM", 0)) or None,
+                        help="max. tokens per minute")
+    parser.add_argument("--skip-failed", action="store_true", help="do not retry items that failed before")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the response cache")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=os.environ.get("TACITFLOW_LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    client = _client_from_env()
+    if client is None:
+        print("GEMINI_API_KEY not set (or TACITFLOW_FAKE_GEMINI=1 for a dry run).", file=sys.stderr)
+        return 2
+    items = load_items(args.source)
+
+    def report(record):
+        status = record["status"]
+        detail = record.get("error") if status == "failed" else ", ".join(record["files"])
+        print(f"{status:7} {record['id']} ({record['seconds']:.1f}s) {detail}",
+              file=sys.stderr, flush=True)
+
+    summary = run_batch(
+        items, args.out, client,
+        concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+        cache=None if args.no_cache else ResponseCache.from_env(),
+        retry_failed=not args.skip_failed, on_result=report,
+    )
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,515 @@
+"""
+benchmark.py
+------------
+Offline performance benchmarks – no API key, no network.
+
+Gemini is replaced by fake_gemini.FakeClient replaying recorded replies
+(``ReplayResponder``) with configurable latency and chunking.  The default
+recordings are synthetic diagrams of three sizes; ``--recordings`` replays
+real ones (JSON lines, see ``ReplayResponder``).
+
+Suites
+  • ``parse``        throughput of the reply pipeline: incremental
+                     JSON / fence parsing, graph → XML, repair, validation,
+                     edit application (MB/s and nodes/s);
+  • ``handler``      ``get_bpmn_from_gemini_internal`` end to end with a
+                     zero-latency model – pure handler overhead, per phase;
+  • ``concurrency``  many sessions at once with a realistic model latency,
+                     in process (asyncio) and through the Gradio app over
+                     HTTP on localhost;
+  • ``memory``       memory held per session (tracemalloc) and stored bytes.
+
+Usage
+    python benchmark.py                       # all suites → benchmark-results.json
+    python benchmark.py --suites parse,handler --sizes small,medium
+    python benchmark.py --compare old.json    # print regressions vs an earlier run
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from bpmn_edits import apply_edits
+from bpmn_graph import graph_to_xml, normalize_graph
+from bpmn_validate import repair_xml, validate_xml
+from fake_gemini import FakeClient, ReplayResponder
+from frontend import initial_bpmn_xml
+from gemini_handler import (
+    _FenceParser,
+    _JsonFieldParser,
+    astream_bpmn_from_gemini_internal,
+    get_bpmn_from_gemini_internal,
+)
+from gemini_router import Router
+from metrics import Metrics
+from session_store import SessionStore
+
+SIZES = {"small": 10, "medium": 100, "large": 1000, "xlarge": 3000}   # tasks
+SUITES = ("parse", "handler", "concurrency", "memory")
+_DI_RE = re.compile(r"\s*<bpmndi:BPMNDiagram\b.*</bpmndi:BPMNDiagram>", re.DOTALL)
+
+
+# ------------------------------------------------------------------------
+#  Synthetic recordings
+# ------------------------------------------------------------------------
+def synthetic_graph(tasks: int, lanes: int = 3) -> dict:
+    """
+    A pool with *lanes* lanes and a chain of *tasks* tasks; every fifth
+    task is an exclusive split into two branches joined again.
+    """
+    lane_ids = [f"Lane_{i}" for i in range(1, lanes + 1)]
+    nodes = [{"id": "Start_1", "type": "startEvent", "name": "Start", "lane": lane_ids[0]}]
+    flows = []
+    last = "Start_1"
+
+    def link(source, target, **extra):
+        flows.append({"id": f"Flow_{len(flows) + 1}", "source": source, "target": target, **extra})
+
+    i = 0
+    while i < tasks:
+        lane = lane_ids[(i // 5) % lanes]
+        if i % 5 == 4 and i + 2 <= tasks:
+            split, join = f"Split_{i}", f"Join_{i}"
+            nodes.append({"id": split, "type": "exclusiveGateway", "name": f"Check {i}?", "lane": lane})
+            nodes.append({"id": join, "type": "exclusiveGateway", "lane": lane})
+            link(last, split)
+            for branch, label in ((i, "yes"), (i + 1, "no")):
+                task = f"Task_{branch}"
+                nodes.append({"id": task, "type": "userTask", "name": f"Handle case {branch}", "lane": lane})
+                link(split, task, name=label)
+                link(task, join)
+            last = join
+            i += 2
+            continue
+        task = f"Task_{i}"
+        nodes.append({"id": task, "type": "task", "name": f"Process step {i}", "lane": lane})
+        link(last, task)
+        last = task
+        i += 1
+    nodes.append({"id": "End_1", "type": "endEvent", "name": "Done", "lane": lane_ids[0]})
+    link(last, "End_1")
+    return {
+        "processes": [{"id": "Process_1", "name": "Benchmark", "participant": "Pool_1"}],
+        "lanes": [{"id": lane, "name": f"Role {n}", "process": "Process_1"}
+                  for n, lane in enumerate(lane_ids, start=1)],
+        "nodes": nodes,
+        "flows": flows,
+    }
+
+
+def _comments(graph: dict, count: int = 5) -> list:
+    tasks = [n["id"] for n in graph["nodes"] if n["type"].endswith("ask")][:count]
+    return [{"id": t, "text": f"Consider automating {t}", "markerClass": "overlay-warn"} for t in tasks]
+
+
+def synthetic_recordings(size: str) -> dict:
+    """
+    Replies for one diagram size: the first-turn graph reply, the same
+    diagram as fenced XML (no DI, as the model sends it) and a follow-up
+    edit reply.
+    """
+    graph = normalize_graph(synthetic_graph(SIZES[size]))
+    comments = _comments(graph)
+    xml = graph_to_xml(graph)
+    edits = [
+        {"op": "rename", "id": "Task_0", "name": "Receive order"},
+        {"op": "add_node", "id": "Task_Extra", "type": "task", "name": "Archive", "lane": "Lane_1"},
+        {"op": "add_flow", "source": "Task_0", "target": "Task_Extra"},
+    ]
+    return {
+        "graph": graph,
+        "xml": xml,
+        "first": json.dumps({"graph": graph, "comments": comments}),
+        "first_xml": (
+            f"```xml\n{_DI_RE.sub('', xml)}\n```\n\n```json\n{json.dumps(comments)}\n```"
+        ),
+        "followup": json.dumps({"edits": edits, "comments": comments[:1]}),
+        "edits": edits,
+    }
+
+
+def _responder(recordings: dict) -> ReplayResponder:
+    return ReplayResponder([
+        {"turn": "first", "reply": recordings["first"]},
+        {"turn": "followup", "reply": recordings["followup"]},
+    ])
+
+
+# ------------------------------------------------------------------------
+#  Helpers
+# ------------------------------------------------------------------------
+def _timeit(fn, min_time=0.3, min_runs=3, max_runs=200) -> float:
+    """Median seconds per call of *fn*."""
+    runs = []
+    started = time.perf_counter()
+    while len(runs) < min_runs or (time.perf_counter() - started < min_time and len(runs) < max_runs):
+        t = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t)
+    return statistics.median(runs)
+
+
+def _percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50_ms": round(pick(0.5) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def _phase_means(metrics: Metrics) -> dict:
+    return {
+        f"{h['labels']['phase']}_ms": round(h["mean"] * 1000, 3)
+        for h in metrics.snapshot()["histograms"]
+        if h["name"] == "tacitflow_phase_seconds" and h["count"]
+    }
+
+
+def _feed(parser, text, chunk_size):
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return parser
+
+
+def _chat(prompt: str) -> list:
+    return [[prompt, None]]
+
+
+# ------------------------------------------------------------------------
+#  Suites
+# ------------------------------------------------------------------------
+def bench_parse(size: str, rec: dict, chunk_size: int) -> dict:
+    """Throughput of every local step a reply goes through."""
+    nodes = len(rec["graph"]["nodes"])
+    no_di = _DI_RE.sub("", rec["xml"])
+    steps = {
+        "json_stream_parse": (lambda: _feed(_JsonFieldParser(), rec["first"], chunk_size), rec["first"]),
+        "fence_stream_parse": (lambda: _feed(_FenceParser(), rec["first_xml"], chunk_size), rec["first_xml"]),
+        "normalize_graph": (lambda: normalize_graph(json.loads(rec["first"])["graph"]), rec["first"]),
+        "graph_to_xml": (lambda: graph_to_xml(rec["graph"]), rec["xml"]),
+        "repair_valid_xml": (lambda: repair_xml(rec["xml"]), rec["xml"]),
+        "repair_xml_without_di": (lambda: repair_xml(no_di), no_di),
+        "validate_xml": (lambda: validate_xml(rec["xml"]), rec["xml"]),
+        "apply_edits": (lambda: apply_edits(rec["xml"], rec["edits"]), rec["xml"]),
+    }
+    results = {}
+    for name, (fn, text) in steps.items():
+        seconds = _timeit(fn)
+        results[name] = {
+            "ms": round(seconds * 1000, 3),
+            "mb_per_s": round(len(text.encode("utf-8")) / seconds / 1e6, 2),
+            "nodes_per_s": round(nodes / seconds),
+        }
+    return {"size": size, "nodes": nodes, "reply_bytes": len(rec["first"]), "steps": results}
+
+
+def bench_handler(size: str, rec: dict, chunk_size: int, repeat: int) -> dict:
+    """Handler overhead: every millisecond here is ours, not the model's."""
+    metrics = Metrics()
+    client = FakeClient(responder=_responder(rec), chunk_size=chunk_size)
+    sessions = SessionStore()
+    router = Router()
+    first, followup = [], []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        history, xml, _, state = get_bpmn_from_gemini_internal(
+            _chat("Describe the benchmark process"), None, initial_bpmn_xml, client, True,
+            None, router, sessions, metrics,
+        )
+        first.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        get_bpmn_from_gemini_internal(
+            history + [["rename the first task", None]], state, xml, client, True,
+            None, router, sessions, metrics,
+        )
+        followup.append(time.perf_counter() - t)
+        client.calls.clear()
+    return {
+        "size": size,
+        "requests": 2 * repeat,
+        "first_turn": _percentiles(first),
+        "followup": _percentiles(followup),
+        "phases_mean": _phase_means(metrics),
+    }
+
+
+def bench_concurrency_inprocess(rec: dict, levels: list, latency: float, chunk_size: int,
+                                chunk_delay: float, rounds: int) -> list:
+    """Concurrent sessions on one event loop (no HTTP)."""
+    results = []
+    for level in levels:
+        client = FakeClient(responder=_responder(rec), latency=latency,
+                            chunk_size=chunk_size, chunk_delay=chunk_delay)
+        sessions, router = SessionStore(), Router()
+
+        async def user():
+            times = []
+            for _ in range(rounds):
+                t = time.perf_counter()
+                async for _ in astream_bpmn_from_gemini_internal(
+                    _chat("Describe the benchmark process"), None, initial_bpmn_xml, client,
+                    True, None, router, sessions, Metrics(),
+                ):
+                    pass
+                times.append(time.perf_counter() - t)
+            return times
+
+        async def run():
+            return await asyncio.gather(*(user() for _ in range(level)))
+
+        started = time.perf_counter()
+        samples = [s for times in asyncio.run(run()) for s in times]
+        wall = time.perf_counter() - started
+        results.append({
+            "mode": "inprocess", "sessions": level, "requests": len(samples),
+            "throughput_rps": round(len(samples) / wall, 2), **_percentiles(samples),
+        })
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_concurrency_app(rec: dict, levels: list, latency: float, chunk_size: int,
+                          chunk_delay: float, rounds: int) -> list:
+    """Concurrent users through the Gradio app (HTTP on localhost)."""
+    import uvicorn
+    from gradio_client import Client
+
+    replay = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False)
+    replay.close()
+    _responder(rec).save(replay.name)
+    os.environ.update({
+        "TACITFLOW_FAKE_GEMINI": "1",
+        "TACITFLOW_FAKE_REPLAY": replay.name,
+        "TACITFLOW_FAKE_LATENCY": str(latency),
+        "TACITFLOW_FAKE_CHUNK_SIZE": str(chunk_size),
+        "TACITFLOW_FAKE_CHUNK_DELAY": str(chunk_delay),
+        "TACITFLOW_CACHE": "0",
+        "TACITFLOW_SESSION_PATH": "",
+        "NO_PROXY": "127.0.0.1,localhost",
+    })
+    # Gradio creates asyncio primitives when the UI is built and needs a
+    # current loop; an earlier asyncio.run() leaves the main thread without one
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    import app
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        app.create_server(), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    url = f"http://127.0.0.1:{port}/"
+
+    def user(_):
+        client = Client(url, verbose=False)
+        times = []
+        for _ in range(rounds):
+            t = time.perf_counter()
+            client.predict(
+                _chat("Describe the benchmark process"), initial_bpmn_xml, api_name="/partial"
+            )
+            times.append(time.perf_counter() - t)
+        return times
+
+    results = []
+    try:
+        for level in levels:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=level) as pool:
+                samples = [s for times in pool.map(user, range(level)) for s in times]
+            wall = time.perf_counter() - started
+            results.append({
+                "mode": "gradio", "sessions": level, "requests": len(samples),
+                "throughput_rps": round(len(samples) / wall, 2), **_percentiles(samples),
+            })
+    finally:
+        server.should_exit = True
+        os.unlink(replay.name)
+    return results
+
+
+def bench_memory(size: str, rec: dict, sessions_count: int) -> dict:
+    """Bytes retained per session after its first turn."""
+    client = FakeClient(responder=_responder(rec), chunk_size=4096)
+    sessions, router, metrics = SessionStore(max_sessions=sessions_count + 1), Router(), Metrics()
+    run = lambda: get_bpmn_from_gemini_internal(
+        _chat("Describe the benchmark process"), None, initial_bpmn_xml, client, True,
+        None, router, sessions, metrics,
+    )
+    run()                                   # warm up imports and the event loop
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(sessions_count):
+        run()
+    client.calls.clear()
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = sessions.stats()
+    return {
+        "size": size,
+        "sessions": sessions_count,
+        "retained_bytes_per_session": round((after - before) / sessions_count),
+        "stored_bytes_per_session": round(stats["bytes"] / max(1, stats["entries"])),
+        "peak_bytes": peak - before,
+    }
+
+
+# ------------------------------------------------------------------------
+#  Runner
+# ------------------------------------------------------------------------
+def _meta(args) -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def _flatten(data, prefix="") -> dict:
+    """Numeric leaves keyed by path; list items keyed by size / mode+sessions."""
+    flat = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flat.update(_flatten(value, f"{prefix}{key}."))
+    elif isinstance(data, list):
+        for item in data:
+            tag = item.get("size") or f"{item.get('mode')}x{item.get('sessions')}"
+            flat.update(_flatten(item, f"{prefix}{tag}."))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        flat[prefix.rstrip(".")] = data
+    return flat
+
+
+def compare(old: dict, new: dict, threshold: float = 0.10) -> list:
+    """
+    Lines describing metrics that moved by more than *threshold* (relative).
+    Times and bytes are better when lower; rates (``_per_s``, ``_rps``)
+    when higher.
+    """
+    before, after = _flatten(old.get("results", {})), _flatten(new.get("results", {}))
+    lines = []
+    for key in sorted(before.keys() & after.keys()):
+        a, b = before[key], after[key]
+        if not a or abs(b - a) / abs(a) <= threshold:
+            continue
+        higher_is_better = key.endswith(("_per_s", "_rps"))
+        worse = (b < a) if higher_is_better else (b > a)
+        lines.append(f"{'REGRESSION' if worse else 'improved  '} {key}: {a:g} → {b:g} "
+                     f"({(b - a) / a:+.0%})")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--suites", default=",".join(SUITES))
+    parser.add_argument("--sizes", default="small,medium,large")
+    parser.add_argument("--recordings", help="JSON-lines replies to replay in handler/concurrency suites")
+    parser.add_argument("--chunk-size", type=int, default=400, help="characters per streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between chunks (concurrency)")
+    parser.add_argument("--latency", type=float, default=0.5, help="model latency in seconds (concurrency)")
+    parser.add_argument("--concurrency", default="1,8,32,64", help="concurrent sessions to test")
+    parser.add_argument("--rounds", type=int, default=3, help="requests per session (concurrency)")
+    parser.add_argument("--repeat", type=int, default=10, help="requests per size (handler)")
+    parser.add_argument("--sessions", type=int, default=200, help="sessions (memory)")
+    parser.add_argument("--no-app", action="store_true", help="skip the Gradio/HTTP concurrency run")
+    parser.add_argument("--out", default="benchmark-results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    suites = [s for s in args.suites.split(",") if s]
+    sizes = [s for s in args.sizes.split(",") if s]
+    levels = [int(n) for n in args.concurrency.split(",") if n]
+    recordings = {size: synthetic_recordings(size) for size in sizes}
+    if args.recordings:
+        replay = ReplayResponder.load(args.recordings)
+        first = [r["reply"] for r in replay.recordings if r.get("turn") != "followup"]
+        follow = [r["reply"] for r in replay.recordings if r.get("turn") == "followup"]
+        recordings["recorded"] = dict(
+            recordings[sizes[0]], first=first[0], followup=follow[0] if follow else "{}"
+        )
+        sizes.append("recorded")
+
+    results = {}
+    log = lambda msg: print(msg, file=sys.stderr, flush=True)
+    if "parse" in suites:
+        results["parse"] = []
+        for size in sizes:
+            if size == "recorded":
+                continue
+            log(f"parse {size}…")
+            results["parse"].append(bench_parse(size, recordings[size], args.chunk_size))
+    if "handler" in suites:
+        results["handler"] = []
+        for size in sizes:
+            log(f"handler {size}…")
+            results["handler"].append(
+                bench_handler(size, recordings[size], args.chunk_size, args.repeat)
+            )
+    if "concurrency" in suites:
+        rec = recordings["medium" if "medium" in recordings else sizes[0]]
+        log("concurrency (in process)…")
+        results["concurrency"] = bench_concurrency_inprocess(
+            rec, levels, args.latency, args.chunk_size, args.chunk_delay, args.rounds
+        )
+        if not args.no_app:
+            log("concurrency (Gradio app)…")
+            results["concurrency"] += bench_concurrency_app(
+                rec, levels, args.latency, args.chunk_size, args.chunk_delay, args.rounds
+            )
+    if "memory" in suites:
+        results["memory"] = []
+        for size in sizes:
+            if size == "recorded":
+                continue
+            log(f"memory {size}…")
+            count = max(10, args.sessions // (10 if size in ("large", "xlarge") else 1))
+            results["memory"].append(bench_memory(size, recordings[size], count))
+
+    report = {"meta": _meta(args), "results": results}
+    with open(args.out, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2)
+    log(f"results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            lines = compare(json.load(fh), report)
+        print("\n".join(lines) or "no change above 10 %")
+        return 1 if any(line.startswith("REGRESSION") for line in lines) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
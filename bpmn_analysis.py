@@ -0,0 +1,380 @@
+"""
+bpmn_analysis.py
+----------------
+Structural review of a BPMN diagram without a model call.
+
+Review requests ("comments", "review", …) used to send the whole diagram
+to Gemini for every finding.  Many findings follow from the graph alone;
+:func:`analyze_graph` computes them in linear time (split / join matching
+remembers the join each node leads to, so no path is walked twice) –
+milliseconds for thousands of elements:
+
+  • elements no start event reaches;
+  • dead ends (no outgoing flow, not an end event) and loops from which no
+    path leads to an end event;
+  • gateways that decide nothing (one outgoing, at most one incoming flow)
+    or that split and join at once;
+  • splits joined by a gateway of another type – a parallel split merged
+    by an exclusive gateway, an exclusive split joined by a parallel one;
+  • exclusive / inclusive branches with neither label nor condition;
+  • lanes without tasks.
+
+:func:`to_overlays` turns the findings into the overlay specs the model
+produces (``{id, text, markerClass, position}``).  A quick check ("check
+the diagram") is answered from them alone; a full review tells the model
+what is already known and merges both (``TACITFLOW_ANALYSIS``).
+"""
+
+import os
+import re
+from collections import defaultdict, deque
+
+from bpmn_model import GATEWAY_TYPES, TASK_TYPES, read_graph
+
+MARKER_CLASS = "structural-issue"
+POSITION = {"top": -34, "left": 0}     # above the element, clear of the model's notes
+QUICK_MAX_WORDS = 12
+_MAX_NESTING = 200                     # split inside split; deeper is not matched
+
+# kind → summary label, in reporting order
+KINDS = {
+    "no_start": "process(es) without a start event",
+    "unreachable": "unreachable element(s)",
+    "dead_end": "dead end(s)",
+    "no_exit": "loop(s) without an exit",
+    "mismatch": "split / join mismatch(es)",
+    "gateway": "gateway(s) that decide nothing or split and join at once",
+    "unlabeled": "unlabeled branch(es)",
+    "empty_lane": "lane(s) without tasks",
+}
+
+_JOIN_FOR_SPLIT = {
+    "parallelGateway": "parallelGateway",
+    "exclusiveGateway": "exclusiveGateway",
+    "inclusiveGateway": "inclusiveGateway",
+    "eventBasedGateway": "exclusiveGateway",
+}
+
+_REVIEW_RE = re.compile(
+    r"\b(comments?|review|feedback|critique|critici[sz]e|analy[sz]e|analysis|assess(ment)?|"
+    r"check|validate|verify|lint)\b",
+    re.IGNORECASE,
+)
+_QUICK_RE = re.compile(
+    r"^\W*(please\s+)?((do|run)\s+a\s+)?("
+    r"(quick\s+(check|review)|lint)(\s+(of|on)\s+((the|my|this)\s+)?(diagram|model|process|bpmn))?|"
+    r"(check|validate|verify|lint)\s+((the|my|this)\s+)?(diagram|model|process|bpmn|structure)|"
+    r"(any\s+)?structur(e|al)\s+(check|issues|problems|errors|review)"
+    # nothing but politeness after it – a question goes to the model
+    r")(\s*,?\s+(please|for\s+me|now|thanks|thank\s+you))*\W*$",
+    re.IGNORECASE,
+)
+# "add comments about …" asks for a review, "add a review step" for an edit
+_EDIT_RE = re.compile(
+    r"^\W*(please\s+)?("
+    r"(add|insert|make)\b(?!(\s+\S+){0,3}?\s+(comments?|notes?|annotations?|remarks|review)\b"
+    r"(?!\s+(step|task|activity)))|"
+    r"create|rename|remove|delete|move|change|replace|"
+    r"connect|put|split|merge|swap|use)\b",
+    re.IGNORECASE,
+)
+
+
+def review_kind(prompt: str):
+    """
+    ``"quick"`` for a request the local findings answer on their own,
+    ``"review"`` for one the model answers with the findings merged in,
+    None for anything else (or with ``TACITFLOW_ANALYSIS=0``).
+    ``TACITFLOW_ANALYSIS=local`` answers every review locally.
+    """
+    mode = os.environ.get("TACITFLOW_ANALYSIS", "combine").lower()
+    prompt = prompt or ""
+    if mode in ("0", "off", "false") or _EDIT_RE.search(prompt):
+        return None
+    if _QUICK_RE.search(prompt) and len(prompt.split()) <= QUICK_MAX_WORDS:
+        return "quick"
+    if not _REVIEW_RE.search(prompt):
+        return None
+    return "quick" if mode == "local" else "review"
+
+
+# ------------------------------------------------------------------------
+#  Analysis
+# ------------------------------------------------------------------------
+def _label(node) -> str:
+    return f"“{node['name']}”" if node.get("name") else node["id"]
+
+
+def analyze_xml(xml: str) -> list:
+    """:func:`analyze_graph` of a BPMN document (raises ``ET.ParseError``)."""
+    return analyze_graph(read_graph(xml))
+
+
+def analyze_graph(graph: dict) -> list:
+    """
+    Structural findings for a graph as returned by ``bpmn_model.read_graph``.
+
+    Returns
+    -------
+    list[dict]
+        ``{"id", "kind", "text"}`` per finding, ordered by :data:`KINDS`
+        and then by document order.
+    """
+    nodes = {n["id"]: n for n in graph["nodes"] if n.get("id")}
+    outgoing, incoming = defaultdict(list), defaultdict(list)
+    for flow in graph["flows"]:
+        if (
+            flow.get("type") == "sequenceFlow"
+            and flow.get("source") in nodes and flow.get("target") in nodes
+        ):
+            outgoing[flow["source"]].append(flow)
+            incoming[flow["target"]].append(flow)
+    findings = []
+
+    def report(element_id, kind, text):
+        findings.append({"id": element_id, "kind": kind, "text": text})
+
+    # -------------------- reachability --------------------------------
+    # Entries of each container (a process, or the subProcess nodes sit in):
+    # its start events, else the nodes without incoming flow
+    boundaries = defaultdict(list)
+    starts, loose = defaultdict(list), defaultdict(list)
+    for node in nodes.values():
+        container = (node.get("process"), node.get("parent"))
+        if node["type"] == "boundaryEvent":
+            if node.get("attachedTo") in nodes:
+                boundaries[node["attachedTo"]].append(node["id"])
+        elif node["type"] == "startEvent" or (
+            node["type"] == "intermediateCatchEvent" and node.get("event") == "link"
+        ):
+            starts[container].append(node["id"])
+        elif not incoming[node["id"]]:
+            loose[container].append(node["id"])
+
+    def entries(container):
+        return starts.get(container) or loose.get(container, [])
+
+    roots = []
+    for process in graph["processes"]:
+        container = (process["id"], None)
+        if not starts.get(container) and loose.get(container):
+            report(loose[container][0], "no_start",
+                   f"Process {process.get('name') or process['id']} has no start event")
+        roots.extend(entries(container))
+
+    def successors(nid):
+        for flow in outgoing[nid]:
+            yield flow["target"]
+        yield from boundaries.get(nid, ())
+        if nodes[nid]["type"] == "subProcess":
+            yield from entries((nodes[nid].get("process"), nid))
+
+    def spread(seeds, allowed, seen):
+        queue = deque(s for s in seeds if s not in seen)
+        seen.update(queue)
+        while queue:
+            for nxt in successors(queue.popleft()):
+                if nxt not in seen and allowed(nxt):
+                    seen.add(nxt)
+                    queue.append(nxt)
+        return seen
+
+    reached = spread(roots, lambda nid: True, set())
+    unreached = [nid for nid in nodes if nid not in reached]
+    if unreached:
+        covered = set()
+        heads = [
+            nid for nid in unreached
+            if not incoming[nid] and nodes[nid]["type"] != "boundaryEvent"
+        ]
+        for head in heads + unreached:
+            if head in covered:
+                continue
+            before = len(covered)
+            spread([head], lambda nid: nid not in reached, covered)
+            following = len(covered) - before - 1
+            report(head, "unreachable",
+                   "Unreachable – no path from a start event leads here"
+                   + (f" (nor to the {following} element(s) after it)" if following else ""))
+
+    # -------------------- dead ends and loops without exit -------------
+    def terminal(node):
+        return node["type"] == "endEvent" or (
+            node["type"] == "intermediateThrowEvent" and node.get("event") == "link"
+        )
+
+    dead = [
+        nid for nid, node in nodes.items()
+        if not outgoing[nid] and not terminal(node)
+        and not (node["type"] == "boundaryEvent" and node.get("event") == "compensate")
+    ]
+    for nid in dead:
+        node = nodes[nid]
+        report(nid, "dead_end",
+               f"Dead end – {_label(node)} has no outgoing flow and is not an end event")
+
+    def backwards(seeds, allowed):
+        seen = set(seeds)
+        queue = deque(seeds)
+        while queue:
+            for flow in incoming[queue.popleft()]:
+                prev = flow["source"]
+                if prev not in seen and allowed(prev):
+                    seen.add(prev)
+                    queue.append(prev)
+        return seen
+
+    finishing = backwards([nid for nid, node in nodes.items() if terminal(node)], lambda _: True)
+    stuck = backwards(dead, lambda nid: nid not in finishing)
+    for nid, node in nodes.items():
+        if (
+            nid in reached and nid not in finishing and nid not in stuck
+            and (not incoming[nid] or any(f["source"] in finishing for f in incoming[nid]))
+        ):
+            report(nid, "no_exit",
+                   f"Loop without exit – no path from {_label(node)} reaches an end event")
+
+    # -------------------- gateways -------------------------------------
+    splits = {}
+    for nid, node in nodes.items():
+        if node["type"] not in GATEWAY_TYPES:
+            continue
+        ins, outs = len(incoming[nid]), len(outgoing[nid])
+        if outs == 1 and ins <= 1:
+            report(nid, "gateway",
+                   f"Gateway {_label(node)} has a single outgoing flow and decides nothing – "
+                   "add the missing branch or remove it")
+        elif outs > 1 and ins > 1:
+            report(nid, "gateway",
+                   f"Gateway {_label(node)} joins and splits at once – use two gateways")
+        elif outs > 1:
+            splits[nid] = node
+
+    joins, reach = {}, {}
+
+    def join_of(split_id, depth=0):
+        """The gateway all branches of *split_id* meet at first, or None."""
+        if split_id in joins:
+            return joins[split_id]
+        joins[split_id] = None          # guards against cycles
+        if depth > _MAX_NESTING:
+            return None
+        met = {walk(flow["target"], depth) for flow in outgoing[split_id]}
+        joins[split_id] = met.pop() if len(met) == 1 else None
+        return joins[split_id]
+
+    def walk(start, depth):
+        """First join reached from *start*; remembered for every node passed."""
+        path, passed, current = [], set(), start
+        while current is not None and current not in reach:
+            if current in passed:
+                current = None          # a loop without a join
+                break
+            path.append(current)
+            passed.add(current)
+            if nodes[current]["type"] in GATEWAY_TYPES and len(incoming[current]) > 1:
+                break
+            if current in splits:
+                inner = join_of(current, depth + 1)
+                after = outgoing[inner] if inner is not None else ()
+                current = after[0]["target"] if len(after) == 1 else None
+            elif len(outgoing[current]) == 1:
+                current = outgoing[current][0]["target"]
+            else:
+                current = None
+        found = reach.get(current, current)
+        for nid in path:
+            reach[nid] = found
+        return found
+
+    for split_id, split in splits.items():
+        join_id = join_of(split_id)
+        expected = _JOIN_FOR_SPLIT.get(split["type"])
+        if join_id is None or expected is None:
+            continue
+        join = nodes[join_id]
+        if join["type"] in (expected, "complexGateway"):
+            continue
+        if split["type"] == "parallelGateway" and join["type"] == "exclusiveGateway":
+            text = (f"Exclusive gateway merges the parallel branches of {_label(split)} – "
+                    "everything after it runs once per branch; use a parallel join")
+        elif join["type"] == "parallelGateway":
+            text = (f"Parallel join waits for every branch of {_label(split)}, but only "
+                    "some are taken – the process deadlocks here; join with the split's type")
+        else:
+            text = (f"{join['type']} joins the branches of the {split['type']} "
+                    f"{_label(split)} – use the same gateway type")
+        report(join_id, "mismatch", text)
+
+    # -------------------- unlabeled branches ---------------------------
+    for split_id, split in splits.items():
+        if split["type"] not in ("exclusiveGateway", "inclusiveGateway"):
+            continue
+        flows = outgoing[split_id]
+        bare = [
+            f for f in flows
+            if not (f.get("name") or f.get("condition") or f.get("default"))
+        ]
+        if len(bare) == len(flows):
+            report(split_id, "unlabeled",
+                   f"None of the {len(flows)} branches of {_label(split)} is labeled – "
+                   "name the condition of each")
+        else:
+            for flow in bare:
+                if flow.get("id"):
+                    report(flow["id"], "unlabeled",
+                           f"Branch of {_label(split)} has no label or condition – "
+                           "label it or make it the default flow")
+
+    # -------------------- lanes ----------------------------------------
+    staffed = {n.get("lane") for n in nodes.values() if n["type"] in TASK_TYPES}
+    parents = {lane.get("parent") for lane in graph["lanes"]}
+    for lane in graph["lanes"]:
+        if lane.get("id") and lane["id"] not in staffed and lane["id"] not in parents:
+            report(lane["id"], "empty_lane",
+                   f"Lane {_label(lane)} has no tasks – remove it or assign its work")
+
+    order = {kind: i for i, kind in enumerate(KINDS)}
+    findings.sort(key=lambda f: order[f["kind"]])
+    return findings
+
+
+# ------------------------------------------------------------------------
+#  Presentation
+# ------------------------------------------------------------------------
+def to_overlays(findings: list, limit: int = None) -> list:
+    """
+    Overlay specs for *findings*, one per element (texts joined), at most
+    *limit* of them.
+    """
+    merged = {}
+    for finding in findings:
+        spec = merged.get(finding["id"])
+        if spec is None:
+            if limit is not None and len(merged) >= limit:
+                continue
+            merged[finding["id"]] = {
+                "id": finding["id"], "text": finding["text"],
+                "markerClass": MARKER_CLASS, "position": dict(POSITION),
+            }
+        else:
+            spec["text"] += "; " + finding["text"]
+    return list(merged.values())
+
+
+def summarize_findings(findings: list) -> str:
+    """Bullet list of finding counts per kind for the chat."""
+    if not findings:
+        return "No structural problems found."
+    counts = defaultdict(int)
+    for finding in findings:
+        counts[finding["kind"]] += 1
+    return "\n".join(f"• {counts[kind]} {label}" for kind, label in KINDS.items() if counts[kind])
+
+
+def describe_findings(findings: list, limit: int = 50) -> str:
+    """One ``- id: text`` line per finding, for the model's prompt."""
+    lines = [f"- {f['id']}: {f['text']}" for f in findings[:limit]]
+    if len(findings) > limit:
+        lines.append(f"- … and {len(findings) - limit} more")
+    return "\n".join(lines)
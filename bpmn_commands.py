@@ -0,0 +1,327 @@
+"""
+bpmn_commands.py
+----------------
+Recognises simple edit commands and turns them into an edit list
+(bpmn_edits.py) without asking the model.
+
+Many follow-ups are mechanical – "rename Check stock to Verify stock",
+"delete the Approve step" – yet each cost a full Gemini round trip of
+10–30 s.  :func:`plan_command` matches the prompt against a few command
+patterns and resolves the elements it names in the current diagram:
+
+  • rename X to Y (tasks, events, gateways, lanes);
+  • delete / remove X – a step with one outgoing flow is bridged, so the
+    flow that led into it now leads to its successor;
+  • swap the yes/no labels (of X) – or the labels of any two-way gateway;
+  • add an end event (called N) after X;
+  • add / insert a task (called) N after / before X.
+
+It only answers when it is sure: the whole prompt must be one command,
+every element reference must resolve to exactly one element and a new
+name must read like one – a few words, a single clause, not a wish such
+as "something clearer" (quoted names are taken as typed).  Everything
+else returns None and goes to the model.  ``TACITFLOW_LOCAL_EDITS=0``
+switches the fast path off.
+"""
+
+import os
+import re
+
+from bpmn_model import GATEWAY_TYPES
+
+_QUOTES = "\"'“”‘’`"
+_KIND_WORDS = r"(?:task|step|activity|event|gateway|decision|lane|node|element|box)"
+_PREFIX = r"^\s*(?:please\s+|pls\s+|now\s+|can\s+you\s+|could\s+you\s+)*"
+_TASK_TYPES = {
+    "task": "task", "step": "task", "activity": "task", "user task": "userTask",
+    "manual task": "manualTask", "service task": "serviceTask", "script task": "scriptTask",
+    "send task": "sendTask", "receive task": "receiveTask",
+}
+
+_RENAME_RE = re.compile(
+    _PREFIX + r"(?:rename|relabel|change\s+the\s+(?:name|label)\s+of)\s+(?P<rest>.+)$",
+    re.IGNORECASE,
+)
+_RENAME_TO_RE = re.compile(r"\s+(?:to|as|into)\s+", re.IGNORECASE)
+_DELETE_RE = re.compile(
+    _PREFIX + r"(?:delete|remove|drop)\s+(?P<ref>.+)$", re.IGNORECASE,
+)
+_SWAP_RE = re.compile(
+    _PREFIX + r"(?:swap|switch|flip|invert|exchange)\s+(?:the\s+)?(?:"
+    r"(?P<yesno>yes\s*(?:/|and|&)\s*no|no\s*(?:/|and|&)\s*yes)"
+    r"(?:\s+(?:branch\s+)?(?:labels?|branches|conditions))?"
+    r"|(?:branch\s+)?(?:labels?|branches|conditions))"
+    r"(?:\s+(?:of|on|at|for)\s+(?P<ref>.+))?$",
+    re.IGNORECASE,
+)
+_END_RE = re.compile(
+    _PREFIX + r"(?:add|insert|put)\s+(?:an?\s+)?(?:new\s+)?end(?:\s+event)?"
+    r"(?:\s+(?:called|named|labell?ed)\s+(?P<name>.+?))?\s+after\s+(?P<ref>.+)$",
+    re.IGNORECASE,
+)
+_INSERT_RE = re.compile(
+    _PREFIX + r"(?:add|insert)\s+(?:an?\s+)?(?:new\s+)?"
+    r"(?P<kind>" + "|".join(sorted(_TASK_TYPES, key=len, reverse=True)) + r")\s+"
+    r"(?:(?:called|named|labell?ed)\s+)?(?P<name>.+?)\s+(?P<where>after|before)\s+(?P<ref>.+)$",
+    re.IGNORECASE,
+)
+_MAX_NAME_WORDS = 8
+# A second clause ("… and then delete X") or a wish instead of a name
+_CLAUSE_RE = re.compile(r"\s(?:and|then|also|but)\s|[,;.]", re.IGNORECASE)
+_VAGUE_RE = re.compile(
+    r"^(?:(?:a|an|the|some)\s+)?(?:something|anything|better|clearer|shorter|simpler|"
+    r"nicer|more|less)\b",
+    re.IGNORECASE,
+)
+_YES = {"yes", "y", "true", "ok", "approved", "valid"}
+_NO = {"no", "n", "false", "not ok", "rejected", "invalid"}
+
+
+def local_edits_enabled() -> bool:
+    return os.environ.get("TACITFLOW_LOCAL_EDITS", "1").lower() not in ("0", "off", "false")
+
+
+# ------------------------------------------------------------------------
+#  Element references
+# ------------------------------------------------------------------------
+def _clean(text: str) -> str:
+    """Text of a name as typed: no surrounding quotes, spaces or full stop."""
+    text = text.strip().rstrip(".!").strip()
+    if len(text) > 1 and text[0] in _QUOTES and text[-1] in _QUOTES:
+        text = text[1:-1]
+    return text.strip(_QUOTES + " ")
+
+
+def _name(text: str):
+    """
+    New element name from *text*, or None unless it plainly is one.  A
+    quoted name is taken as typed.
+    """
+    text = text.strip().rstrip(".!").strip()
+    quoted = len(text) > 1 and text[0] in _QUOTES and text[-1] in _QUOTES
+    name = _clean(text)
+    if not name or len(name) > 120:
+        return None
+    if not quoted and (
+        len(name.split()) > _MAX_NAME_WORDS or _CLAUSE_RE.search(name) or _VAGUE_RE.match(name)
+    ):
+        return None
+    return name
+
+
+def _norm(text: str) -> str:
+    return " ".join(re.sub(r"[^\w?]+", " ", (text or "").lower()).split())
+
+
+class _Index:
+    """Element lookup by id or name over a ``read_graph`` result."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.nodes = {n["id"]: n for n in graph["nodes"] if n.get("id")}
+        self.lanes = {lane["id"]: lane for lane in graph["lanes"] if lane.get("id")}
+        self.outgoing, self.incoming = {}, {}
+        for flow in graph["flows"]:
+            if flow.get("type") == "sequenceFlow" and flow.get("id"):
+                self.outgoing.setdefault(flow.get("source"), []).append(flow)
+                self.incoming.setdefault(flow.get("target"), []).append(flow)
+
+    def find(self, ref: str, lanes: bool = False, partial: bool = True):
+        """
+        The one element *ref* names, or None when unknown or ambiguous.
+        With *partial*, a unique name starting with the words of *ref*
+        counts as well ("the Approve step" → "Approve order").
+        """
+        pools = [self.nodes, self.lanes] if lanes else [self.nodes]
+        ref = _clean(ref)
+        for pool in pools:
+            if ref in pool:
+                return pool[ref]
+        candidates = [_norm(ref)]
+        bare = re.sub(r"^the\s+", "", candidates[0])
+        stripped = re.sub(rf"\s+{_KIND_WORDS}$", "", bare)
+        stripped = re.sub(rf"^{_KIND_WORDS}\s+", "", stripped)
+        candidates += [c for c in (bare, stripped) if c and c not in candidates]
+        elements = [e for pool in pools for e in pool.values()]
+        for wanted in candidates:
+            exact = [e for e in elements if _norm(e.get("name")) == wanted]
+            if exact:
+                return exact[0] if len(exact) == 1 else None
+        wanted = candidates[-1]
+        if not partial or not wanted:
+            return None
+        pattern = re.compile(rf"{re.escape(wanted)}(?: |$)")
+        matches = [e for e in elements if pattern.match(_norm(e.get("name")))]
+        return matches[0] if len(matches) == 1 else None
+
+    def label(self, elem) -> str:
+        return f"“{elem['name']}”" if elem.get("name") else elem["id"]
+
+    def new_id(self, kind: str) -> str:
+        """A fresh id in bpmn-js style (``Activity_…`` / ``Event_…``)."""
+        prefix = "Event" if kind.endswith("Event") else "Activity"
+        number = len(self.nodes) + 1
+        while f"{prefix}_{number}" in self.nodes or f"{prefix}_{number}" in self.lanes:
+            number += 1
+        return f"{prefix}_{number}"
+
+
+# ------------------------------------------------------------------------
+#  Commands
+# ------------------------------------------------------------------------
+def _rename(index, match):
+    # "rename Go to market to Launch": the one split whose left side names
+    # an element wins
+    rest = match.group("rest")
+    splits = list(_RENAME_TO_RE.finditer(rest))
+    for partial in (False, True):
+        found = []
+        for sep in splits:
+            elem = index.find(rest[:sep.start()], lanes=True, partial=partial)
+            if elem is not None:
+                found.append((elem, _name(rest[sep.end():])))
+        if found:
+            break
+    if len(found) != 1:
+        return None
+    elem, name = found[0]
+    if name is None:
+        return None
+    return (
+        [{"op": "rename", "id": elem["id"], "name": name}],
+        f"renamed {index.label(elem)} to “{name}”",
+    )
+
+
+def _delete(index, match):
+    node = index.find(match.group("ref"))
+    if node is None:
+        return None
+    ins = index.incoming.get(node["id"], [])
+    outs = index.outgoing.get(node["id"], [])
+    edits = []
+    if ins and len(outs) == 1 and node["type"] not in GATEWAY_TYPES:
+        # Bridge the gap: what led into the step now leads to its successor
+        successor = outs[0]["target"]
+        if successor == node["id"]:
+            return None
+        edits = [{"op": "reconnect", "id": flow["id"], "target": successor} for flow in ins]
+    elif len(outs) > 1 or (node["type"] in GATEWAY_TYPES and ins and outs):
+        return None                      # which branch survives is the model's call
+    edits.append({"op": "remove", "id": node["id"]})
+    bridged = " and reconnected its flow" if len(edits) > 1 else ""
+    return edits, f"deleted {index.label(node)}{bridged}"
+
+
+def _swap(index, match):
+    yes_no = bool(match.group("yesno"))
+    if match.group("ref"):
+        gateway = index.find(match.group("ref"))
+        if gateway is None or gateway["type"] not in GATEWAY_TYPES:
+            return None
+        gateways = [gateway]
+    else:
+        gateways = [n for n in index.nodes.values() if n["type"] in GATEWAY_TYPES]
+    pairs = []
+    for gateway in gateways:
+        flows = index.outgoing.get(gateway["id"], [])
+        if len(flows) != 2 or not all(f.get("name") or f.get("condition") for f in flows):
+            continue
+        names = {_norm(f.get("name") or f.get("condition")) for f in flows}
+        if yes_no and not (names & _YES and names & _NO):
+            continue
+        pairs.append((gateway, flows))
+    if len(pairs) != 1:
+        return None
+    gateway, (first, second) = pairs[0]
+    edits = []
+    for flow, other in ((first, second), (second, first)):
+        edits.append({"op": "rename", "id": flow["id"], "name": other.get("name", "")})
+        if first.get("condition") or second.get("condition"):
+            edits.append({"op": "set_condition", "id": flow["id"],
+                          "condition": other.get("condition", "")})
+    return edits, f"swapped the branch labels of {index.label(gateway)}"
+
+
+def _add_end(index, match):
+    node = index.find(match.group("ref"))
+    if node is None or node["type"] == "endEvent":
+        return None
+    if index.outgoing.get(node["id"]) and node["type"] not in GATEWAY_TYPES:
+        return None                      # would fork the flow – leave it to the model
+    name = _name(match.group("name")) if match.group("name") else "End"
+    if name is None:
+        return None
+    end_id = index.new_id("endEvent")
+    add = {"op": "add_node", "id": end_id, "type": "endEvent", "name": name,
+           "lane": node.get("lane"), "process": node.get("process"), "parent": node.get("parent")}
+    edits = [
+        {key: value for key, value in add.items() if value},
+        {"op": "add_flow", "source": node["id"], "target": end_id},
+    ]
+    return edits, f"added the end event “{name}” after {index.label(node)}"
+
+
+def _insert(index, match):
+    node = index.find(match.group("ref"))
+    name = _name(match.group("name"))
+    if node is None or name is None:
+        return None
+    after = match.group("where").lower() == "after"
+    flows = index.outgoing.get(node["id"], []) if after else index.incoming.get(node["id"], [])
+    if len(flows) > 1 or (after and node["type"] == "endEvent") or (
+        not after and node["type"] == "startEvent"
+    ):
+        return None
+    kind = _TASK_TYPES[" ".join(match.group("kind").lower().split())]
+    task_id = index.new_id(kind)
+    add = {"op": "add_node", "id": task_id, "type": kind, "name": name,
+           "lane": node.get("lane"), "process": node.get("process"), "parent": node.get("parent")}
+    edits = [{key: value for key, value in add.items() if value}]
+    if after:
+        edits += [{"op": "reconnect", "id": f["id"], "source": task_id} for f in flows]
+        edits.append({"op": "add_flow", "source": node["id"], "target": task_id})
+    else:
+        edits += [{"op": "reconnect", "id": f["id"], "target": task_id} for f in flows]
+        edits.append({"op": "add_flow", "source": task_id, "target": node["id"]})
+    where = "after" if after else "before"
+    return edits, f"added “{name}” {where} {index.label(node)}"
+
+
+# Order matters: "add an end event after X" before the generic insert
+_COMMANDS = [
+    ("rename", _RENAME_RE, _rename),
+    ("swap_labels", _SWAP_RE, _swap),
+    ("add_end", _END_RE, _add_end),
+    ("insert", _INSERT_RE, _insert),
+    ("delete", _DELETE_RE, _delete),
+]
+
+
+def plan_command(prompt: str, graph: dict):
+    """
+    Edit list for a simple command in *prompt* against *graph* (as
+    returned by ``bpmn_model.read_graph``).
+
+    Returns
+    -------
+    tuple | None
+        ``(intent, edits, summary)`` – the command's name, the edit list
+        for ``bpmn_edits.apply_edits`` and a sentence for the chat – or
+        None if the prompt is not a command this module is sure about.
+    """
+    if not prompt or "\n" in prompt.strip():
+        return None
+    text = " ".join(prompt.split())
+    if len(text) > 200:
+        return None
+    for intent, pattern, plan in _COMMANDS:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        planned = plan(_Index(graph), match)
+        if planned is None:
+            return None
+        edits, summary = planned
+        return intent, edits, summary
+    return None
@@ -0,0 +1,479 @@
+"""
+bpmn_edits.py
+-------------
+Applies a structured edit list to the current BPMN XML on the server.
+
+On follow-up turns Gemini no longer re-sends the whole diagram; it replies
+with a short JSON array of operations instead, e.g.
+
+    [
+      {"op": "add_node", "id": "Task_Ship", "type": "task", "name": "Ship goods", "lane": "Lane_1"},
+      {"op": "add_flow", "source": "Task_Pack", "target": "Task_Ship"},
+      {"op": "rename", "id": "Gateway_1", "name": "In stock?"},
+      {"op": "remove", "id": "Task_Old"}
+    ]
+
+Operations (see ``EDIT_OPERATIONS``) only touch the semantic model; the
+layout engine (bpmn_layout.py) then runs in incremental mode, so existing
+shapes stay put, new ones are placed next to their neighbours and touched
+flows are re-routed.
+"""
+
+import uuid
+import xml.etree.ElementTree as ET
+
+from bpmn_layout import layout_graph, read_layout, write_di
+from bpmn_model import (
+    EVENT_KINDS,
+    EVENT_TYPES,
+    FLOW_NODE_TYPES,
+    GATEWAY_TYPES,
+    XSI_NS,
+    is_bpmn,
+    local_name,
+    parse_xml,
+    q,
+    read_graph,
+    to_xml,
+)
+
+EDIT_OPERATIONS = {
+    "add_node": "id?, type, name?, lane?, process?, parent?, event?, attachedTo?",
+    "add_flow": "id?, source, target, name?, condition?, default?",
+    "remove": "id",
+    "rename": "id, name",
+    "set_type": "id, type, event?",
+    "move": "id, lane",
+    "add_lane": "id?, name, process?",
+    "reconnect": "id, source?, target?",
+    "set_condition": "id, condition",
+}
+
+_FIELDS = sorted({
+    f.strip().rstrip("?") for spec in EDIT_OPERATIONS.values() for f in spec.split(",")
+})
+
+# Gemini structured-output schema for an edit list: one flat object per
+# operation carrying the union of the fields above.
+EDIT_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "op": {"type": "STRING", "enum": list(EDIT_OPERATIONS)},
+            **{
+                field: (
+                    {"type": "BOOLEAN"} if field == "default" else
+                    {"type": "STRING", "enum": sorted(EVENT_KINDS)} if field == "event" else
+                    {"type": "STRING"}
+                )
+                for field in _FIELDS
+            },
+        },
+        "required": ["op"],
+    },
+}
+
+
+class EditError(ValueError):
+    """An edit operation that cannot be applied to the diagram."""
+
+
+# ------------------------------------------------------------------------
+#  Mutable view of one document
+# ------------------------------------------------------------------------
+class _Diagram:
+    """Indexes over an ElementTree root so edits can find things quickly."""
+
+    def __init__(self, root):
+        self.root = root
+        self.by_id = {}
+        self.parent = {}
+        for parent in root.iter():
+            for child in parent:
+                self.parent[child] = parent
+            if parent.get("id"):
+                self.by_id[parent.get("id")] = parent
+
+    # ---------------- lookups ----------------
+    def get(self, elem_id, *kinds):
+        elem = self.by_id.get(elem_id)
+        if elem is None or not is_bpmn(elem):
+            raise EditError(f"unknown element id '{elem_id}'")
+        if kinds and local_name(elem.tag) not in kinds:
+            raise EditError(f"'{elem_id}' is a {local_name(elem.tag)}, not a {'/'.join(kinds)}")
+        return elem
+
+    def node(self, node_id):
+        return self.get(node_id, *FLOW_NODE_TYPES)
+
+    def process_of(self, elem):
+        while elem is not None and not is_bpmn(elem, "process"):
+            elem = self.parent.get(elem)
+        return elem
+
+    def processes(self):
+        return self.root.findall(q("bpmn", "process"))
+
+    def lanes_of(self, process):
+        return list(process.iter(q("bpmn", "lane")))
+
+    def lane_of(self, node_id):
+        for lane in self.root.iter(q("bpmn", "lane")):
+            for ref in lane.findall(q("bpmn", "flowNodeRef")):
+                if (ref.text or "").strip() == node_id:
+                    return lane
+        return None
+
+    def flows_touching(self, node_id):
+        return [
+            f for f in self.root.iter()
+            if is_bpmn(f, "sequenceFlow", "messageFlow")
+            and node_id in (f.get("sourceRef"), f.get("targetRef"))
+        ]
+
+    def new_id(self, kind):
+        prefix = {
+            "sequenceFlow": "Flow", "messageFlow": "Flow", "lane": "Lane",
+            "participant": "Participant", "collaboration": "Collaboration",
+        }.get(kind)
+        if prefix is None:
+            prefix = (
+                "Event" if kind in EVENT_TYPES else
+                "Gateway" if kind in GATEWAY_TYPES else "Activity"
+            )
+        while True:
+            candidate = f"{prefix}_{uuid.uuid4().hex[:7]}"
+            if candidate not in self.by_id:
+                return candidate
+
+    def claim_id(self, wanted, kind):
+        if wanted:
+            if wanted in self.by_id:
+                raise EditError(f"id '{wanted}' already exists")
+            return wanted
+        return self.new_id(kind)
+
+    # ---------------- tree helpers ----------------
+    def add(self, parent, tag, index=None, **attrs):
+        elem = ET.Element(tag, {k: v for k, v in attrs.items() if v not in (None, "")})
+        if index is None:
+            parent.append(elem)
+        else:
+            parent.insert(index, elem)
+        self.parent[elem] = parent
+        if elem.get("id"):
+            self.by_id[elem.get("id")] = elem
+        return elem
+
+    def drop(self, elem):
+        parent = self.parent.get(elem)
+        if parent is not None and elem in list(parent):
+            parent.remove(elem)
+        for sub in elem.iter():
+            if sub.get("id") and self.by_id.get(sub.get("id")) is sub:
+                del self.by_id[sub.get("id")]
+
+    def set_ref(self, node, tag_local, flow_id, present=True):
+        """Add/remove an ``<bpmn:incoming>``/``<bpmn:outgoing>`` child."""
+        tag = q("bpmn", tag_local)
+        for ref in node.findall(tag):
+            if (ref.text or "").strip() == flow_id:
+                if present:
+                    return
+                node.remove(ref)
+        if not present:
+            return
+        index = 0
+        for i, child in enumerate(node):
+            if local_name(child.tag) in ("documentation", "extensionElements", "incoming", "outgoing"):
+                index = i + 1
+        self.add(node, tag, index).text = flow_id
+
+
+# ------------------------------------------------------------------------
+#  Operations
+# ------------------------------------------------------------------------
+def _op_add_node(d, edit):
+    kind = edit.get("type") or "task"
+    if kind not in FLOW_NODE_TYPES:
+        raise EditError(f"unsupported node type '{kind}'")
+    node_id = d.claim_id(edit.get("id"), kind)
+
+    lane = d.get(edit["lane"], "lane") if edit.get("lane") else None
+    if kind == "boundaryEvent":
+        host = d.node(edit.get("attachedTo") or "")
+        container = d.parent[host]
+    elif edit.get("parent"):
+        container = d.get(edit["parent"], "subProcess")
+    elif lane is not None:
+        container = d.process_of(lane)
+    elif edit.get("process"):
+        container = d.get(edit["process"], "process")
+    else:
+        processes = d.processes()
+        if not processes:
+            raise EditError("diagram has no process to add to")
+        container = processes[0]
+
+    # Keep flow nodes ahead of sequence flows for readability
+    index = len(container)
+    for i, child in enumerate(container):
+        if is_bpmn(child, "sequenceFlow"):
+            index = i
+            break
+    node = d.add(
+        container, q("bpmn", kind), index, id=node_id, name=edit.get("name"),
+        attachedToRef=edit.get("attachedTo") if kind == "boundaryEvent" else None,
+    )
+    if edit.get("event") and kind in EVENT_TYPES:
+        _add_event_definition(d, node, kind, edit["event"])
+
+    if lane is None and kind != "boundaryEvent" and not edit.get("parent"):
+        lanes = d.lanes_of(container) if is_bpmn(container, "process") else []
+        lane = lanes[0] if len(lanes) == 1 else None
+    if lane is not None:
+        d.add(lane, q("bpmn", "flowNodeRef")).text = node_id
+
+
+def _op_add_flow(d, edit):
+    src = d.node(edit.get("source") or "")
+    tgt = d.node(edit.get("target") or "")
+    src_proc, tgt_proc = d.process_of(src), d.process_of(tgt)
+
+    if src_proc is not tgt_proc:
+        collab = d.root.find(q("bpmn", "collaboration"))
+        if collab is None:
+            raise EditError("message flows need a collaboration with participants")
+        flow = d.add(
+            collab, q("bpmn", "messageFlow"), id=d.claim_id(edit.get("id"), "messageFlow"),
+            name=edit.get("name"), sourceRef=src.get("id"), targetRef=tgt.get("id"),
+        )
+    else:
+        container = d.parent[src] if not is_bpmn(src, "boundaryEvent") else src_proc
+        flow = d.add(
+            container, q("bpmn", "sequenceFlow"), id=d.claim_id(edit.get("id"), "sequenceFlow"),
+            name=edit.get("name"), sourceRef=src.get("id"), targetRef=tgt.get("id"),
+        )
+        d.set_ref(src, "outgoing", flow.get("id"))
+        d.set_ref(tgt, "incoming", flow.get("id"))
+        if edit.get("condition"):
+            _op_set_condition(d, {"id": flow.get("id"), "condition": edit["condition"]})
+        if edit.get("default"):
+            src.set("default", flow.get("id"))
+
+
+def _op_remove(d, edit):
+    elem = d.get(edit.get("id") or "")
+    kind = local_name(elem.tag)
+    elem_id = elem.get("id")
+
+    if kind in FLOW_NODE_TYPES:
+        for flow in d.flows_touching(elem_id):
+            _op_remove(d, {"id": flow.get("id")})
+        for other in list(d.root.iter(q("bpmn", "boundaryEvent"))):
+            if other.get("attachedToRef") == elem_id:
+                _op_remove(d, {"id": other.get("id")})
+        for lane in d.root.iter(q("bpmn", "lane")):
+            for ref in lane.findall(q("bpmn", "flowNodeRef")):
+                if (ref.text or "").strip() == elem_id:
+                    lane.remove(ref)
+    elif kind in ("sequenceFlow", "messageFlow"):
+        for end, ref in (("sourceRef", "outgoing"), ("targetRef", "incoming")):
+            node = d.by_id.get(elem.get(end) or "")
+            if node is not None:
+                d.set_ref(node, ref, elem_id, present=False)
+                if node.get("default") == elem_id:
+                    del node.attrib["default"]
+    elif kind != "lane":
+        raise EditError(f"cannot remove a {kind}")
+    d.drop(elem)
+
+
+def _op_rename(d, edit):
+    elem = d.get(edit.get("id") or "")
+    if edit.get("name"):
+        elem.set("name", edit["name"])
+    else:
+        elem.attrib.pop("name", None)
+
+
+def _op_set_type(d, edit):
+    node = d.node(edit.get("id") or "")
+    kind = edit.get("type")
+    if kind not in FLOW_NODE_TYPES:
+        raise EditError(f"unsupported node type '{kind}'")
+    node.tag = q("bpmn", kind)       # the layout resizes the shape around its centre
+    if kind not in EVENT_TYPES or edit.get("event"):
+        for child in list(node):
+            if local_name(child.tag).endswith("EventDefinition"):
+                node.remove(child)
+    if edit.get("event") and kind in EVENT_TYPES:
+        _add_event_definition(d, node, kind, edit["event"])
+
+
+def _add_event_definition(d, node, kind, event):
+    if event not in EVENT_KINDS:
+        raise EditError(f"unknown event kind '{event}'")
+    d.add(node, q("bpmn", f"{event}EventDefinition"),
+          id=d.new_id(kind).replace("Event_", "EventDefinition_"))
+
+
+def _op_move(d, edit):
+    node = d.node(edit.get("id") or "")
+    lane = d.get(edit.get("lane") or "", "lane")
+    node_id = node.get("id")
+    old = d.lane_of(node_id)
+    if old is lane:
+        return
+    if old is not None:
+        for ref in old.findall(q("bpmn", "flowNodeRef")):
+            if (ref.text or "").strip() == node_id:
+                old.remove(ref)
+    # The layout re-places the shape once it no longer sits in its lane band
+    d.add(lane, q("bpmn", "flowNodeRef")).text = node_id
+
+
+def _ensure_participant(d, process):
+    """Wrap *process* in a collaboration/pool so it can hold lanes."""
+    collab = d.root.find(q("bpmn", "collaboration"))
+    if collab is None:
+        collab = d.add(d.root, q("bpmn", "collaboration"), 0, id=d.new_id("collaboration"))
+    for part in collab.findall(q("bpmn", "participant")):
+        if part.get("processRef") == process.get("id"):
+            return part
+    return d.add(
+        collab, q("bpmn", "participant"), id=d.new_id("participant"),
+        name=process.get("name"), processRef=process.get("id"),
+    )
+
+
+def _op_add_lane(d, edit):
+    if edit.get("process"):
+        process = d.get(edit["process"], "process")
+    else:
+        processes = d.processes()
+        if not processes:
+            raise EditError("diagram has no process to add a lane to")
+        process = processes[0]
+    _ensure_participant(d, process)
+
+    lane_set = process.find(q("bpmn", "laneSet"))
+    if lane_set is None:
+        lane_set = d.add(process, q("bpmn", "laneSet"), 0, id=f"LaneSet_{uuid.uuid4().hex[:7]}")
+    existing = lane_set.findall(q("bpmn", "lane"))
+    lane = d.add(lane_set, q("bpmn", "lane"), id=d.claim_id(edit.get("id"), "lane"),
+                 name=edit.get("name"))
+
+    if not existing:
+        # First lane takes over every node already in the pool
+        for node in process:
+            if is_bpmn(node, *FLOW_NODE_TYPES):
+                d.add(lane, q("bpmn", "flowNodeRef")).text = node.get("id")
+
+
+def _op_reconnect(d, edit):
+    flow = d.get(edit.get("id") or "", "sequenceFlow", "messageFlow")
+    for end, ref in (("source", "outgoing"), ("target", "incoming")):
+        if not edit.get(end):
+            continue
+        new = d.node(edit[end])
+        old = d.by_id.get(flow.get(f"{end}Ref") or "")
+        if is_bpmn(flow, "sequenceFlow"):
+            if old is not None:
+                d.set_ref(old, ref, flow.get("id"), present=False)
+            d.set_ref(new, ref, flow.get("id"))
+        flow.set(f"{end}Ref", new.get("id"))
+
+
+def _op_set_condition(d, edit):
+    flow = d.get(edit.get("id") or "", "sequenceFlow")
+    cond = flow.find(q("bpmn", "conditionExpression"))
+    if not edit.get("condition"):
+        if cond is not None:
+            flow.remove(cond)
+        return
+    if cond is None:
+        cond = d.add(flow, q("bpmn", "conditionExpression"))
+        cond.set(f"{{{XSI_NS}}}type", "bpmn:tFormalExpression")
+    cond.text = edit["condition"]
+
+
+_OPERATIONS = {
+    "add_node": _op_add_node,
+    "add_flow": _op_add_flow,
+    "remove": _op_remove,
+    "rename": _op_rename,
+    "set_type": _op_set_type,
+    "move": _op_move,
+    "add_lane": _op_add_lane,
+    "reconnect": _op_reconnect,
+    "set_condition": _op_set_condition,
+}
+
+
+# ------------------------------------------------------------------------
+#  Public entry point
+# ------------------------------------------------------------------------
+def _typed(edit: dict) -> dict:
+    """
+    *edit* with numbers as text; raises :class:`EditError` for a field of
+    the wrong type (the model may send ``"id": {}`` or ``"name": ["x"]``).
+    """
+    typed = {}
+    for field, value in edit.items():
+        if value is None or field == "default" or (field != "op" and field not in _FIELDS):
+            typed[field] = value
+        elif isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise EditError(f"field '{field}' must be text, got {type(value).__name__}")
+        else:
+            typed[field] = str(value)
+    return typed
+
+
+def apply_edits(xml: str, edits: list) -> tuple:
+    """
+    Apply *edits* to *xml*.
+
+    Parameters
+    ----------
+    xml : str
+        Current BPMN 2.0 XML (with DI).
+    edits : list[dict]
+        Operations as described in ``EDIT_OPERATIONS``; each needs an
+        ``"op"`` key.
+
+    Returns
+    -------
+    tuple
+        ``(new_xml, problems)`` – *problems* lists a human-readable reason
+        for every edit that was skipped (or whose unknown event kind was
+        dropped); the remaining edits still apply.
+    """
+    d = _Diagram(parse_xml(xml))
+    problems = []
+    for edit in edits or []:
+        if not isinstance(edit, dict):
+            problems.append(f"ignored malformed edit {edit!r}")
+            continue
+        try:
+            edit = _typed(edit)
+        except EditError as exc:
+            problems.append(f"{edit.get('op')}: {exc}")
+            continue
+        handler = _OPERATIONS.get(edit.get("op"))
+        if edit.get("event") and edit["event"] not in EVENT_KINDS:
+            problems.append(
+                f"{edit.get('op')} {edit.get('id') or ''}: unknown event kind "
+                f"'{edit['event']}', dropped it".replace("  ", " ")
+            )
+            edit = {k: v for k, v in edit.items() if k != "event"}
+        try:
+            if handler is None:
+                raise EditError(f"unknown operation '{edit.get('op')}'")
+            handler(d, edit)
+        except (EditError, KeyError) as exc:
+            problems.append(f"{edit.get('op')} {edit.get('id') or ''}: {exc}".replace("  ", " "))
+
+    write_di(d.root, layout_graph(read_graph(d.root), read_layout(d.root)))
+    return to_xml(d.root), problems
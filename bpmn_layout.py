@@ -0,0 +1,657 @@
+"""
+bpmn_layout.py
+--------------
+Automatic layout for BPMN diagrams, so Gemini only has to describe the
+process (``bpmn:process`` / ``bpmn:collaboration``) and never coordinates.
+
+  • Layered (Sugiyama-style) placement: cycles broken by DFS, layers by
+    longest path, rows chosen per lane so the happy path stays on one line
+    and branches open up underneath.
+  • Pools stack vertically, lanes become horizontal bands sized to their
+    content; collapsed sub-processes get their own drill-down plane.
+  • Orthogonal edge routing (``route_edge``).
+  • Incremental mode: given the previous layout, existing shapes keep their
+    bounds, new shapes are placed next to their neighbours and containers
+    grow to fit – the user's mental map survives follow-up edits.
+
+Everything runs in linear-ish time on plain dicts, so diagrams with
+hundreds of nodes lay out in a few milliseconds.
+"""
+
+import xml.etree.ElementTree as ET
+
+from bpmn_model import (
+    EVENT_TYPES,
+    GATEWAY_TYPES,
+    local_name,
+    parse_xml,
+    q,
+    read_graph,
+    to_xml,
+)
+
+# Default shape sizes (bpmn-js defaults)
+TASK_SIZE = (100, 80)
+EVENT_SIZE = (36, 36)
+GATEWAY_SIZE = (50, 50)
+
+POOL_X = 160          # left edge of every pool
+POOL_LABEL = 30       # width of the participant name band
+POOL_GAP = 60         # vertical gap between pools
+TOP_Y = 80            # top edge of the first pool / band
+LEFT_PAD = 50         # pool label band → first column
+RIGHT_PAD = 50        # last column → pool edge
+COL_GAP = 60          # horizontal gap between columns
+ROW_H = 110           # vertical pitch of rows inside a lane
+LANE_MIN_H = 150
+LANE_PAD = 20
+V_GAP = 40            # vertical nudge when a slot is taken
+
+
+def shape_size(node_type: str) -> tuple:
+    """Default ``(width, height)`` of a flow node shape."""
+    if node_type in EVENT_TYPES:
+        return EVENT_SIZE
+    if node_type in GATEWAY_TYPES:
+        return GATEWAY_SIZE
+    return TASK_SIZE
+
+
+def route_edge(src: list, tgt: list, source_type: str = "", message: bool = False) -> list:
+    """
+    Orthogonal waypoints between two ``[x, y, w, h]`` boxes.
+
+    Forward flows leave to the right (gateways leave from top/bottom when
+    the target is on another row, boundary events from the bottom);
+    backward flows loop underneath both shapes; message flows run
+    vertically between pools.
+    """
+    sx, sy, sw, sh = src
+    tx, ty, tw, th = tgt
+    scx, scy = sx + sw / 2, sy + sh / 2
+    tcx, tcy = tx + tw / 2, ty + th / 2
+
+    if message:
+        start_y = sy + sh if tcy > scy else sy
+        end_y = ty if tcy > scy else ty + th
+        if abs(scx - tcx) < 1:
+            return [(scx, start_y), (tcx, end_y)]
+        mid_y = (start_y + end_y) / 2
+        return [(scx, start_y), (scx, mid_y), (tcx, mid_y), (tcx, end_y)]
+
+    if source_type == "boundaryEvent" and tcy > sy + sh:
+        return [(scx, sy + sh), (scx, tcy), (tx if tx >= scx else tx + tw, tcy)]
+
+    if tx >= sx + sw:
+        if abs(scy - tcy) < 1:
+            return [(sx + sw, scy), (tx, tcy)]
+        if source_type in GATEWAY_TYPES:
+            start_y = sy + sh if tcy > scy else sy
+            return [(scx, start_y), (scx, tcy), (tx, tcy)]
+        mid_x = (sx + sw + tx) / 2
+        return [(sx + sw, scy), (mid_x, scy), (mid_x, tcy), (tx, tcy)]
+
+    # Backward flow: go round underneath
+    below = max(sy + sh, ty + th) + V_GAP
+    return [(scx, sy + sh), (scx, below), (tcx, below), (tcx, ty + th)]
+
+
+# ------------------------------------------------------------------------
+#  Layering
+# ------------------------------------------------------------------------
+def _layers(order: list, succ: dict) -> dict:
+    """
+    Longest-path layer index per node after removing DFS back edges.
+    *order* fixes the traversal order (sources first) so results are
+    deterministic.
+    """
+    order_set = set(order)
+    succ = {n: [m for m in succ.get(n, ()) if m in order_set] for n in order}
+    indeg = {n: 0 for n in order}
+    for n in order:
+        for m in succ[n]:
+            indeg[m] += 1
+    roots = [n for n in order if indeg[n] == 0] + [n for n in order if indeg[n]]
+
+    # Iterative DFS, dropping edges that point back onto the stack
+    state = {}
+    dag = {n: [] for n in order}
+    for root in roots:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(succ[root]))]
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                state[node] = 2
+                stack.pop()
+            elif state.get(child) == 1:
+                continue                                  # back edge
+            else:
+                dag[node].append(child)
+                if child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(succ[child])))
+
+    indeg = {n: 0 for n in order}
+    for n in order:
+        for m in dag[n]:
+            indeg[m] += 1
+    layer = {n: 0 for n in order}
+    ready = [n for n in order if indeg[n] == 0]
+    while ready:
+        n = ready.pop()
+        for m in dag[n]:
+            layer[m] = max(layer[m], layer[n] + 1)
+            indeg[m] -= 1
+            if indeg[m] == 0:
+                ready.append(m)
+    return layer
+
+
+# ------------------------------------------------------------------------
+#  Fresh layout of one level (top level or inside a sub-process)
+# ------------------------------------------------------------------------
+def _fresh_level(graph: dict, parent) -> dict:
+    nodes = [n for n in graph["nodes"] if n.get("parent") == parent]
+    kind = {n["id"]: n["type"] for n in nodes}
+    hosts = {n["id"]: n["attachedTo"] for n in nodes if n.get("attachedTo")}
+    placeable = [n for n in nodes if n["id"] not in hosts]
+
+    succ, pred = {}, {}
+    for f in graph["flows"]:
+        if f["type"] != "sequenceFlow" or f.get("source") not in kind or f.get("target") not in kind:
+            continue
+        src = hosts.get(f["source"], f["source"])
+        if src == f["target"]:
+            continue
+        succ.setdefault(src, []).append(f["target"])
+        pred.setdefault(f["target"], []).append(f["source"])
+
+    shapes = {}
+    y = TOP_Y
+    processes = graph["processes"] if parent is None else [{"id": None}]
+    for proc in processes:
+        members = [
+            n for n in placeable
+            if parent is not None or n.get("process") == proc["id"]
+        ]
+        lanes = [] if parent is not None else [
+            lane["id"] for lane in graph["lanes"] if lane.get("process") == proc["id"]
+        ]
+        pooled = parent is None and bool(proc.get("participant"))
+        starts = sorted((n["id"] for n in members), key=lambda i: kind[i] != "startEvent")
+        layer = _layers(starts, succ)
+
+        # ---- rows: per (lane, layer) slot, following predecessors ----
+        lane_of = {
+            n["id"]: (n.get("lane") if n.get("lane") in lanes else (lanes[0] if lanes else None))
+            for n in members
+        }
+        by_layer = {}
+        for n in members:
+            by_layer.setdefault(layer[n["id"]], []).append(n["id"])
+        row, taken = {}, set()
+        for index in sorted(by_layer):
+            def wish(node_id):
+                rows = [
+                    row[hosts.get(p, p)] + (1 if p in hosts else 0)
+                    for p in pred.get(node_id, ())
+                    if hosts.get(p, p) in row and lane_of.get(hosts.get(p, p)) == lane_of[node_id]
+                ]
+                return (min(rows) if rows else 0, sum(rows) / len(rows) if rows else 0)
+
+            for node_id in sorted(by_layer[index], key=wish):
+                r = wish(node_id)[0]
+                while (lane_of[node_id], index, r) in taken:
+                    r += 1
+                taken.add((lane_of[node_id], index, r))
+                row[node_id] = r
+
+        # ---- columns ----
+        widths = {}
+        for node_id, li in layer.items():
+            widths[li] = max(widths.get(li, 0), shape_size(kind[node_id])[0])
+        centers, x = {}, POOL_X + (POOL_LABEL + LEFT_PAD if pooled or lanes else LEFT_PAD)
+        for li in sorted(widths):
+            centers[li] = x + widths[li] / 2
+            x += widths[li] + COL_GAP
+        right = x - COL_GAP + RIGHT_PAD
+
+        # ---- lane bands ----
+        band_top = y
+        bands = {}
+        for lane_id in (lanes or [None]):
+            rows = 1 + max((row[i] for i in row if lane_of[i] == lane_id), default=0)
+            height = max(LANE_MIN_H, rows * ROW_H + 2 * LANE_PAD)
+            bands[lane_id] = (band_top, height, rows)
+            band_top += height
+
+        for node_id in row:
+            top, height, rows = bands[lane_of[node_id]]
+            w, h = shape_size(kind[node_id])
+            cy = top + (height - rows * ROW_H) / 2 + row[node_id] * ROW_H + ROW_H / 2
+            shapes[node_id] = [centers[layer[node_id]] - w / 2, cy - h / 2, w, h]
+
+        if pooled:
+            shapes[proc["participant"]] = [POOL_X, y, right - POOL_X, band_top - y]
+        for lane_id in lanes:
+            top, height, _ = bands[lane_id]
+            shapes[lane_id] = [POOL_X + POOL_LABEL, top, right - POOL_X - POOL_LABEL, height]
+        y = band_top + POOL_GAP
+
+    _attach_boundary_events(shapes, nodes, hosts, kind)
+    return shapes
+
+
+def _attach_boundary_events(shapes, nodes, hosts, kind):
+    """Sit boundary events on the bottom edge of their host, right to left."""
+    count = {}
+    for n in nodes:
+        host = shapes.get(hosts.get(n["id"]))
+        if host is None or n["id"] in shapes:
+            continue
+        k = count.get(hosts[n["id"]], 0)
+        count[hosts[n["id"]]] = k + 1
+        w, h = shape_size(kind[n["id"]])
+        shapes[n["id"]] = [host[0] + host[2] - (k + 1) * (w + 6), host[1] + host[3] - h / 2, w, h]
+
+
+# ------------------------------------------------------------------------
+#  Incremental merge with a previous layout
+# ------------------------------------------------------------------------
+def _overlaps(box, others):
+    x, y, w, h = box
+    return any(
+        x < ox + ow and ox < x + w and y < oy + oh and oy < y + h
+        for ox, oy, ow, oh in others
+    )
+
+
+def _merge_level(graph: dict, parent, fresh: dict, previous: dict) -> dict:
+    nodes = [n for n in graph["nodes"] if n.get("parent") == parent]
+    kind = {n["id"]: n["type"] for n in nodes}
+    hosts = {n["id"]: n["attachedTo"] for n in nodes if n.get("attachedTo")}
+    shapes = {}
+
+    # ---- containers: pools and lanes keep previous bounds ----
+    containers = []
+    if parent is None:
+        pool_bottom = max(
+            (previous[p["participant"]][1] + previous[p["participant"]][3]
+             for p in graph["processes"] if p.get("participant") in previous),
+            default=None,
+        )
+        for proc in graph["processes"]:
+            part = proc.get("participant")
+            lanes = [lane["id"] for lane in graph["lanes"] if lane.get("process") == proc["id"]]
+            members = [n["id"] for n in nodes if n.get("process") == proc["id"]]
+            pinned = [previous[m] for m in members if m in previous]
+            if part and part in previous:
+                shapes[part] = list(previous[part])
+            elif part:
+                if pinned:
+                    x0 = min(b[0] for b in pinned) - POOL_LABEL - LEFT_PAD
+                    y0 = min(b[1] for b in pinned) - 2 * LANE_PAD
+                    x1 = max(b[0] + b[2] for b in pinned) + RIGHT_PAD
+                    y1 = max(b[1] + b[3] for b in pinned) + 2 * LANE_PAD
+                    shapes[part] = [x0, y0, x1 - x0, max(y1 - y0, LANE_MIN_H)]
+                else:
+                    fx, fy, fw, fh = fresh[part]
+                    top = fy if pool_bottom is None else pool_bottom + POOL_GAP
+                    shapes[part] = [fx, top, fw, fh]
+                pool_bottom = max(pool_bottom or 0, shapes[part][1] + shapes[part][3])
+
+            frame = shapes.get(part)
+            next_top = frame[1] if frame else None
+            for lane_id in lanes:
+                if lane_id in previous:
+                    shapes[lane_id] = list(previous[lane_id])
+                    next_top = shapes[lane_id][1] + shapes[lane_id][3]
+            for lane_id in lanes:
+                if lane_id in shapes:
+                    continue
+                if frame is None:
+                    shapes[lane_id] = list(fresh[lane_id])
+                    continue
+                only = len(lanes) == 1
+                height = frame[3] if only else LANE_MIN_H
+                shapes[lane_id] = [frame[0] + POOL_LABEL, next_top, frame[2] - POOL_LABEL, height]
+                next_top += height
+            containers.append((part, lanes, members))
+
+    lane_of = {n["id"]: n.get("lane") for n in nodes}
+
+    def inside_lane(node_id, box):
+        lane = shapes.get(lane_of.get(node_id))
+        if lane is None:
+            return True
+        cy = box[1] + box[3] / 2
+        return lane[1] <= cy <= lane[1] + lane[3]
+
+    # ---- pinned nodes: same centre, size follows the (possibly new) type ----
+    for n in nodes:
+        old = previous.get(n["id"])
+        if old is None or n["id"] in hosts:
+            continue
+        w, h = shape_size(n["type"]) if n["type"] != "subProcess" else old[2:]
+        box = [old[0] + old[2] / 2 - w / 2, old[1] + old[3] / 2 - h / 2, w, h]
+        if inside_lane(n["id"], box):
+            shapes[n["id"]] = box
+
+    # ---- new nodes: keep their fresh offset to an already placed neighbour ----
+    neighbours = {}
+    for f in graph["flows"]:
+        if f["type"] == "sequenceFlow":
+            neighbours.setdefault(f.get("target"), []).append(f.get("source"))
+            neighbours.setdefault(f.get("source"), []).append(f.get("target"))
+    boxes = [b for i, b in shapes.items() if i in kind]
+    pending = [n["id"] for n in nodes if n["id"] not in shapes and n["id"] not in hosts]
+    for _ in range(len(pending) + 1):
+        progress = False
+        for node_id in list(pending):
+            anchor = next(
+                (hosts.get(a, a) for a in neighbours.get(node_id, ())
+                 if hosts.get(a, a) in shapes and hosts.get(a, a) in fresh),
+                None,
+            )
+            if anchor is None:
+                continue
+            fb, ab, mine = fresh[anchor], shapes[anchor], fresh[node_id]
+            box = [ab[0] + mine[0] - fb[0], ab[1] + mine[1] - fb[1], mine[2], mine[3]]
+            _place(box, shapes.get(lane_of.get(node_id)), boxes)
+            shapes[node_id] = box
+            boxes.append(box)
+            pending.remove(node_id)
+            progress = True
+        if not progress:
+            break
+    for node_id in pending:
+        w, h = shape_size(kind[node_id])
+        right = max((b[0] + b[2] for b in boxes), default=POOL_X + POOL_LABEL)
+        first = boxes[0] if boxes else [0, TOP_Y + LANE_MIN_H / 2, 0, 0]
+        box = [right + COL_GAP, first[1] + first[3] / 2 - h / 2, w, h]
+        _place(box, shapes.get(lane_of.get(node_id)), boxes)
+        shapes[node_id] = box
+        boxes.append(box)
+
+    # Boundary events: keep previous spot if the host did not move
+    for n in nodes:
+        host = n.get("attachedTo")
+        if n["id"] in hosts and n["id"] in previous and previous.get(host) == shapes.get(host):
+            shapes[n["id"]] = list(previous[n["id"]])
+    _attach_boundary_events(shapes, nodes, hosts, kind)
+
+    if containers:
+        _fit_containers(shapes, containers, lane_of)
+    return shapes
+
+
+def _place(box, lane, boxes):
+    """Clamp *box* into its lane band, then push it down until it is free."""
+    if lane is not None:
+        low, high = lane[1] + LANE_PAD / 2, lane[1] + lane[3] - box[3] - LANE_PAD / 2
+        box[1] = max(low, min(box[1], high)) if high >= low else lane[1] + (lane[3] - box[3]) / 2
+    while _overlaps(box, boxes):
+        box[1] += box[3] + V_GAP
+
+
+def _fit_containers(shapes, containers, lane_of):
+    """Grow lanes and pools so every node sits inside; push later pools down."""
+    shift_below = 0.0
+    for part, lanes, members in sorted(
+        containers, key=lambda c: shapes[c[0]][1] if c[0] in shapes else 0
+    ):
+        if shift_below:
+            for i in [part] + lanes + members:
+                if i in shapes:
+                    shapes[i][1] += shift_below
+        boxes = [shapes[m] for m in members if m in shapes]
+        if not boxes or part not in shapes:
+            continue
+        px, py, pw, ph = shapes[part]
+        x0 = min(px, min(b[0] for b in boxes) - POOL_LABEL - LANE_PAD)
+        x1 = max(px + pw, max(b[0] + b[2] for b in boxes) + RIGHT_PAD)
+
+        ordered = sorted((l for l in lanes if l in shapes), key=lambda l: shapes[l][1])
+        if not ordered:
+            y0 = min(py, min(b[1] for b in boxes) - LANE_PAD)
+            y1 = max(py + ph, max(b[1] + b[3] for b in boxes) + LANE_PAD)
+            grow = (y1 - y0) - ph
+            shapes[part] = [x0, y0, x1 - x0, y1 - y0]
+            shift_below += max(0.0, grow)
+            continue
+
+        shift = 0.0
+        for lane_id in ordered:
+            lane = shapes[lane_id]
+            lane[1] += shift
+            mine = [m for m in members if lane_of.get(m) == lane_id and m in shapes]
+            for m in mine:
+                shapes[m][1] += shift
+            bottom = max((shapes[m][1] + shapes[m][3] for m in mine), default=lane[1]) + LANE_PAD
+            grow = max(0.0, bottom - (lane[1] + lane[3]))
+            shapes[lane_id] = [x0 + POOL_LABEL, lane[1], x1 - x0 - POOL_LABEL, lane[3] + grow]
+            shift += grow
+        top = shapes[ordered[0]][1]
+        bottom = shapes[ordered[-1]][1] + shapes[ordered[-1]][3]
+        shapes[part] = [x0, min(py, top), x1 - x0, bottom - min(py, top)]
+        shift_below += shift
+
+
+# ------------------------------------------------------------------------
+#  Edges
+# ------------------------------------------------------------------------
+def _touches(point, box, slack=2.0):
+    x, y = point
+    return (box[0] - slack <= x <= box[0] + box[2] + slack
+            and box[1] - slack <= y <= box[1] + box[3] + slack)
+
+
+def _route_level(graph, shapes, kind, previous_edges, message_flows):
+    edges = {}
+    for f in graph["flows"]:
+        is_message = f["type"] == "messageFlow"
+        if is_message != message_flows:
+            continue
+        src, tgt = shapes.get(f.get("source")), shapes.get(f.get("target"))
+        if src is None or tgt is None:
+            continue
+        old = previous_edges.get(f["id"])
+        if old and len(old) >= 2 and _touches(old[0], src) and _touches(old[-1], tgt):
+            edges[f["id"]] = [tuple(p) for p in old]
+        else:
+            edges[f["id"]] = route_edge(src, tgt, kind.get(f.get("source"), ""), is_message)
+    return edges
+
+
+# ------------------------------------------------------------------------
+#  Public API
+# ------------------------------------------------------------------------
+def layout_graph(graph: dict, previous: dict = None) -> dict:
+    """
+    Compute DI geometry for a semantic graph (see ``bpmn_model.read_graph``).
+
+    Parameters
+    ----------
+    graph : dict
+        Processes, lanes, nodes and flows.
+    previous : dict | None
+        Earlier result of :func:`read_layout` / :func:`layout_graph`.  Shapes
+        found there keep their position.
+
+    Returns
+    -------
+    dict
+        ``{"shapes": {id: [x, y, w, h]}, "edges": {id: [(x, y), …]},
+        "planes": {subProcess_id: {"shapes": …, "edges": …}}}`` – the top
+        level plus one drill-down plane per sub-process with children.
+    """
+    previous = previous or {"shapes": {}, "edges": {}}
+    old_shapes, old_edges = previous.get("shapes", {}), previous.get("edges", {})
+    kind = {n["id"]: n["type"] for n in graph["nodes"]}
+
+    def level(parent):
+        shapes = _fresh_level(graph, parent)
+        if any(i in old_shapes for i in shapes):
+            shapes = _merge_level(graph, parent, shapes, old_shapes)
+        return shapes
+
+    top = level(None)
+    layout = {
+        "shapes": top,
+        "edges": {
+            **_route_level(graph, top, kind, old_edges, False),
+            **_route_level(graph, top, kind, old_edges, True),
+        },
+        "planes": {},
+    }
+    parents = {n["parent"] for n in graph["nodes"] if n.get("parent")}
+    for parent in sorted(parents):
+        shapes = level(parent)
+        layout["planes"][parent] = {
+            "shapes": shapes,
+            "edges": _route_level(graph, shapes, kind, old_edges, False),
+        }
+    return layout
+
+
+def read_layout(xml_or_root) -> dict:
+    """Existing DI of a document as ``{"shapes": …, "edges": …}`` (all planes)."""
+    root = (
+        parse_xml(xml_or_root) if isinstance(xml_or_root, (str, bytes))
+        else xml_or_root
+    )
+    shapes, edges = {}, {}
+    for shape in root.iter(q("bpmndi", "BPMNShape")):
+        b = shape.find(q("dc", "Bounds"))
+        if b is not None and shape.get("bpmnElement"):
+            shapes[shape.get("bpmnElement")] = [
+                float(b.get(k, 0)) for k in ("x", "y", "width", "height")
+            ]
+    for edge in root.iter(q("bpmndi", "BPMNEdge")):
+        points = [
+            (float(p.get("x", 0)), float(p.get("y", 0)))
+            for p in edge.findall(q("di", "waypoint"))
+        ]
+        if points and edge.get("bpmnElement"):
+            edges[edge.get("bpmnElement")] = points
+    return {"shapes": shapes, "edges": edges}
+
+
+def _fmt(value: float) -> str:
+    return str(int(round(value)))
+
+
+def _carry(old: dict, elem_id: str, attrs: dict) -> dict:
+    """*attrs* plus any extra attributes the previous DI element had."""
+    before = old.get(elem_id)
+    if before is None:
+        return attrs
+    extra = {k: v for k, v in before.attrib.items() if k not in ("id", "bpmnElement")}
+    return {**extra, **attrs}
+
+
+def _carry_label(before, new, bounds):
+    """Copy the ``BPMNLabel`` of *before* into *new* if the geometry is unchanged."""
+    if before is None:
+        return
+    label = before.find(q("bpmndi", "BPMNLabel"))
+    if label is None:
+        return
+    if bounds is not None:
+        old_bounds = before.find(q("dc", "Bounds"))
+        if old_bounds is None or any(
+            _fmt(float(old_bounds.get(k, 0))) != bounds.get(k)
+            for k in ("x", "y", "width", "height")
+        ):
+            return
+    else:
+        old_points = [(p.get("x"), p.get("y")) for p in before.findall(q("di", "waypoint"))]
+        new_points = [(p.get("x"), p.get("y")) for p in new.findall(q("di", "waypoint"))]
+        if [tuple(_fmt(float(v)) for v in p) for p in old_points] != new_points:
+            return
+    new.append(label)
+
+
+def write_di(root: ET.Element, layout: dict) -> ET.Element:
+    """
+    Replace every ``bpmndi:BPMNDiagram`` in *root* with *layout*.  Styling
+    attributes (colours etc.) carry over; labels only if their element did
+    not move.
+    """
+    old = {}
+    for diagram in root.findall(q("bpmndi", "BPMNDiagram")):
+        for item in diagram.iter():
+            if item.get("bpmnElement") and item.tag in (
+                q("bpmndi", "BPMNShape"), q("bpmndi", "BPMNEdge")
+            ):
+                old[item.get("bpmnElement")] = item
+        root.remove(diagram)
+    kinds = {e.get("id"): local_name(e.tag) for e in root.iter() if e.get("id")}
+
+    def plane(diagram_id, plane_id, element_id, geometry):
+        diagram = ET.SubElement(root, q("bpmndi", "BPMNDiagram"), id=diagram_id)
+        plane_el = ET.SubElement(
+            diagram, q("bpmndi", "BPMNPlane"), id=plane_id, bpmnElement=element_id or ""
+        )
+        for elem_id, (x, y, w, h) in geometry["shapes"].items():
+            attrs = {"id": f"{elem_id}_di", "bpmnElement": elem_id}
+            kind = kinds.get(elem_id)
+            if kind in ("participant", "lane"):
+                attrs["isHorizontal"] = "true"
+            elif kind == "subProcess":
+                attrs["isExpanded"] = "false"
+            elif kind == "exclusiveGateway":
+                attrs["isMarkerVisible"] = "true"
+            shape = ET.SubElement(plane_el, q("bpmndi", "BPMNShape"), _carry(old, elem_id, attrs))
+            bounds = ET.SubElement(shape, q("dc", "Bounds"),
+                                   x=_fmt(x), y=_fmt(y), width=_fmt(w), height=_fmt(h))
+            _carry_label(old.get(elem_id), shape, bounds)
+        for elem_id, points in geometry["edges"].items():
+            edge = ET.SubElement(plane_el, q("bpmndi", "BPMNEdge"),
+                                 _carry(old, elem_id, {"id": f"{elem_id}_di", "bpmnElement": elem_id}))
+            for px, py in points:
+                ET.SubElement(edge, q("di", "waypoint"), x=_fmt(px), y=_fmt(py))
+            _carry_label(old.get(elem_id), edge, None)
+
+    main = root.find(q("bpmn", "collaboration"))
+    if main is None:
+        main = root.find(q("bpmn", "process"))
+    plane("BPMNDiagram_1", "BPMNPlane_1", main.get("id") if main is not None else "", layout)
+    for parent, geometry in layout["planes"].items():
+        plane(f"BPMNDiagram_{parent}", f"BPMNPlane_{parent}", parent, geometry)
+    return root
+
+
+def has_complete_di(root: ET.Element) -> bool:
+    """True if every flow node and sequence flow already has DI."""
+    layout = read_layout(root)
+    graph = read_graph(root)
+    return (
+        all(n["id"] in layout["shapes"] for n in graph["nodes"])
+        and all(f["id"] in layout["edges"] for f in graph["flows"])
+    )
+
+
+def layout_xml(xml: str, previous_xml: str = None) -> str:
+    """
+    Lay out *xml* and return it with fresh DI.
+
+    Shapes present in *previous_xml* (the diagram currently on screen) or
+    already in *xml* keep their bounds; everything else is placed by the
+    layered layout.  Raises ``ParseError`` if *xml* is malformed.
+    """
+    root = parse_xml(xml)
+    previous = read_layout(root)
+    if previous_xml:
+        try:
+            earlier = read_layout(previous_xml)
+        except ET.ParseError:
+            earlier = {"shapes": {}, "edges": {}}
+        previous["shapes"].update(earlier["shapes"])
+        previous["edges"].update(earlier["edges"])
+    write_di(root, layout_graph(read_graph(root), previous))
+    return to_xml(root)
@@ -0,0 +1,270 @@
+"""
+bpmn_model.py
+-------------
+Semantic view of a BPMN 2.0 document.
+
+  • Parses the XML shown in the editor into a small, JSON-friendly graph
+    (processes, lanes, nodes, flows) with all ``bpmndi`` geometry left out.
+  • Renders that graph as a compact text summary, which is what Gemini
+    sees on follow-up turns instead of the full XML.
+  • Shared XML helpers (namespaces, parse / serialise) used by the edit,
+    layout and validation modules.
+"""
+
+import io
+import xml.etree.ElementTree as ET
+
+BPMN_NS = "http://www.omg.org/spec/BPMN/20100524/MODEL"
+BPMNDI_NS = "http://www.omg.org/spec/BPMN/20100524/DI"
+DC_NS = "http://www.omg.org/spec/DD/20100524/DC"
+DI_NS = "http://www.omg.org/spec/DD/20100524/DI"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+NAMESPACES = {
+    "bpmn": BPMN_NS,
+    "bpmndi": BPMNDI_NS,
+    "dc": DC_NS,
+    "di": DI_NS,
+    "xsi": XSI_NS,
+}
+for _prefix, _uri in NAMESPACES.items():
+    ET.register_namespace(_prefix, _uri)
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+EVENT_TYPES = {
+    "startEvent", "endEvent", "intermediateCatchEvent",
+    "intermediateThrowEvent", "boundaryEvent",
+}
+TASK_TYPES = {
+    "task", "userTask", "serviceTask", "manualTask", "scriptTask",
+    "businessRuleTask", "sendTask", "receiveTask", "callActivity",
+    "subProcess",
+}
+GATEWAY_TYPES = {
+    "exclusiveGateway", "parallelGateway", "inclusiveGateway",
+    "eventBasedGateway", "complexGateway",
+}
+FLOW_NODE_TYPES = EVENT_TYPES | TASK_TYPES | GATEWAY_TYPES
+# ``<kind>EventDefinition`` children an event may carry
+EVENT_KINDS = {
+    "timer", "message", "signal", "error", "escalation",
+    "conditional", "compensate", "cancel", "link", "terminate",
+}
+
+
+def q(prefix: str, local: str) -> str:
+    """Clark-notation tag, e.g. ``q("bpmn", "task")`` → ``{…MODEL}task``."""
+    return f"{{{NAMESPACES[prefix]}}}{local}"
+
+
+def local_name(tag: str) -> str:
+    """Strip the ``{namespace}`` part of an ElementTree tag."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def is_bpmn(elem, *local: str) -> bool:
+    """True if *elem* lives in the BPMN model namespace (and has one of *local*)."""
+    tag = elem.tag
+    if not isinstance(tag, str) or not tag.startswith(f"{{{BPMN_NS}}}"):
+        return False
+    return not local or local_name(tag) in local
+
+
+# ------------------------------------------------------------------------
+#  Parse / serialise
+# ------------------------------------------------------------------------
+def parse_xml(xml: str) -> ET.Element:
+    """
+    Parse *xml* into an ElementTree root.  Extra namespace prefixes used by
+    the document (camunda:, bioc:, …) are registered so they survive a
+    round trip instead of coming back as ``ns0:``.
+
+    Raises ``xml.etree.ElementTree.ParseError`` on malformed input.
+    """
+    data = xml.encode("utf-8") if isinstance(xml, str) else xml
+    root = None
+    for event, item in ET.iterparse(io.BytesIO(data), events=("start-ns", "start")):
+        if event == "start-ns":
+            prefix, uri = item
+            if prefix and uri not in NAMESPACES.values():
+                ET.register_namespace(prefix, uri)
+        elif root is None:
+            root = item
+    return root
+
+
+def to_xml(root: ET.Element) -> str:
+    """Serialise *root* with consistent indentation and an XML declaration."""
+    ET.indent(root, space="  ")
+    return XML_DECLARATION + ET.tostring(root, encoding="unicode") + "\n"
+
+
+# ------------------------------------------------------------------------
+#  Semantic graph
+# ------------------------------------------------------------------------
+def _event_kind(elem) -> str:
+    """``timer`` for an event holding a timerEventDefinition, etc."""
+    for child in elem:
+        name = local_name(child.tag) if isinstance(child.tag, str) else ""
+        if name.endswith("EventDefinition"):
+            return name[: -len("EventDefinition")]
+    return ""
+
+
+def _condition_text(flow) -> str:
+    cond = flow.find(q("bpmn", "conditionExpression"))
+    return (cond.text or "").strip() if cond is not None else ""
+
+
+def read_graph(xml_or_root) -> dict:
+    """
+    Extract the semantic content of a BPMN document.
+
+    Returns
+    -------
+    dict
+        ``{"processes": [...], "lanes": [...], "nodes": [...], "flows": [...]}``
+        where every entry is a plain dict with only non-empty keys:
+
+        * process: ``id``, ``name``, ``participant``
+        * lane:    ``id``, ``name``, ``process``, ``parent`` (enclosing lane)
+        * node:    ``id``, ``type``, ``name``, ``process``, ``lane``,
+                   ``parent`` (enclosing subProcess), ``event``,
+                   ``attachedTo``
+        * flow:    ``id``, ``type`` (sequenceFlow | messageFlow),
+                   ``source``, ``target``, ``name``, ``condition``,
+                   ``default``
+    """
+    root = (
+        parse_xml(xml_or_root) if isinstance(xml_or_root, (str, bytes))
+        else xml_or_root
+    )
+    graph = {"processes": [], "lanes": [], "nodes": [], "flows": []}
+
+    participants = {}
+    for part in root.iter(q("bpmn", "participant")):
+        if part.get("processRef"):
+            participants[part.get("processRef")] = part
+
+    def compact(entry):
+        return {k: v for k, v in entry.items() if v not in (None, "", False)}
+
+    def walk(container, process_id, parent_id, lane_of, defaults):
+        for elem in container:
+            if not is_bpmn(elem):
+                continue
+            kind = local_name(elem.tag)
+            if kind in FLOW_NODE_TYPES:
+                graph["nodes"].append(compact({
+                    "id": elem.get("id"),
+                    "type": kind,
+                    "name": elem.get("name", ""),
+                    "process": process_id,
+                    "lane": lane_of.get(elem.get("id")),
+                    "parent": parent_id,
+                    "event": _event_kind(elem) if kind in EVENT_TYPES else "",
+                    "attachedTo": elem.get("attachedToRef"),
+                }))
+                if elem.get("default"):
+                    defaults.add(elem.get("default"))
+                if kind == "subProcess":
+                    walk(elem, process_id, elem.get("id"), lane_of, defaults)
+            elif kind == "sequenceFlow":
+                graph["flows"].append(compact({
+                    "id": elem.get("id"),
+                    "type": "sequenceFlow",
+                    "source": elem.get("sourceRef"),
+                    "target": elem.get("targetRef"),
+                    "name": elem.get("name", ""),
+                    "condition": _condition_text(elem),
+                }))
+
+    for process in root.iter(q("bpmn", "process")):
+        pid = process.get("id")
+        part = participants.get(pid)
+        graph["processes"].append(compact({
+            "id": pid,
+            "name": process.get("name") or (part.get("name") if part is not None else ""),
+            "participant": part.get("id") if part is not None else None,
+        }))
+
+        lane_of, lane_parent = {}, {}
+        for lane in process.iter(q("bpmn", "lane")):
+            for child_set in lane.findall(q("bpmn", "childLaneSet")):
+                for child in child_set.findall(q("bpmn", "lane")):
+                    lane_parent[child.get("id")] = lane.get("id")
+            graph["lanes"].append(compact({
+                "id": lane.get("id"), "name": lane.get("name", ""), "process": pid,
+                "parent": lane_parent.get(lane.get("id")),
+            }))
+            for ref in lane.findall(q("bpmn", "flowNodeRef")):
+                if ref.text:
+                    lane_of[ref.text.strip()] = lane.get("id")
+
+        defaults = set()
+        walk(process, pid, None, lane_of, defaults)
+        for flow in graph["flows"]:
+            if flow["id"] in defaults:
+                flow["default"] = True
+
+    for msg in root.iter(q("bpmn", "messageFlow")):
+        graph["flows"].append(compact({
+            "id": msg.get("id"),
+            "type": "messageFlow",
+            "source": msg.get("sourceRef"),
+            "target": msg.get("targetRef"),
+            "name": msg.get("name", ""),
+        }))
+    return graph
+
+
+def summarize_graph(graph: dict) -> str:
+    """
+    Compact, line-oriented description of *graph* for the follow-up prompt.
+
+    Example::
+
+        PROCESS Process_1 "Order handling"
+          LANE Lane_1 "Clerk"
+          NODE StartEvent_1 startEvent "Order received" lane=Lane_1
+          NODE Gateway_1 exclusiveGateway "Valid?" lane=Lane_1
+        FLOWS
+          Flow_3 Gateway_1 -> Task_2 "yes"
+    """
+    def quoted(text):
+        return f' "{text}"' if text else ""
+
+    lines = []
+    for proc in graph["processes"]:
+        lines.append(f"PROCESS {proc['id']}{quoted(proc.get('name'))}")
+        for lane in graph["lanes"]:
+            if lane.get("process") == proc["id"]:
+                lines.append(f"  LANE {lane['id']}{quoted(lane.get('name'))}")
+        for node in graph["nodes"]:
+            if node.get("process") != proc["id"]:
+                continue
+            extras = [
+                f"{key}={node[key]}"
+                for key in ("event", "lane", "parent", "attachedTo")
+                if node.get(key)
+            ]
+            lines.append(
+                f"  NODE {node['id']} {node['type']}{quoted(node.get('name'))}"
+                + (" " + " ".join(extras) if extras else "")
+            )
+    if graph["flows"]:
+        lines.append("FLOWS")
+        for flow in graph["flows"]:
+            arrow = "~>" if flow["type"] == "messageFlow" else "->"
+            extras = []
+            if flow.get("condition"):
+                extras.append(f"if={flow['condition']!r}")
+            if flow.get("default"):
+                extras.append("default")
+            lines.append(
+                f"  {flow['id']} {flow.get('source')} {arrow} {flow.get('target')}"
+                f"{quoted(flow.get('name'))}"
+                + (" " + " ".join(extras) if extras else "")
+            )
+    return "\n".join(lines)
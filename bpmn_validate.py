@@ -0,0 +1,302 @@
+"""
+bpmn_validate.py
+----------------
+Fast validation and local repair of BPMN XML produced by the model.
+
+A malformed reply used to be replaced by the blank template, which threw
+the user's diagram away and cost another full generation.  ``repair_xml``
+instead fixes what can be fixed on the server:
+
+  • chatter around the XML, a bare ``<bpmn:process>`` fragment without
+    ``<bpmn:definitions>`` and undeclared standard namespace prefixes;
+  • output truncated mid-document (open elements are closed);
+  • duplicate ids, flows / lane refs / attachments pointing at missing
+    elements, stale ``incoming``/``outgoing`` refs;
+  • missing or partial DI (completed by the layout engine).
+
+Only what is left over is reported back, so the caller can send the model
+one targeted correction request instead of a full re-generation.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+
+from bpmn_layout import has_complete_di, layout_graph, read_layout, write_di
+from bpmn_model import (
+    FLOW_NODE_TYPES,
+    NAMESPACES,
+    XML_DECLARATION,
+    is_bpmn,
+    local_name,
+    parse_xml,
+    q,
+    read_graph,
+    to_xml,
+)
+
+_TAG_RE = re.compile(r"<(/?)([A-Za-z_][\w.-]*(?::[\w.-]+)?)((?:[^>\"']|\"[^\"]*\"|'[^']*')*?)(/?)>")
+_PREFIX_RE = re.compile(r"</?([A-Za-z_][\w.-]*):|\s([A-Za-z_][\w.-]*):[\w.-]+\s*=")
+_ROOT_RE = re.compile(r"<((?:[\w.-]+:)?definitions)\b")
+
+
+# ------------------------------------------------------------------------
+#  Text-level repairs (before the document can be parsed)
+# ------------------------------------------------------------------------
+def _extract(text: str) -> str:
+    """Cut prose / fences around the XML (everything outside ``<…>``)."""
+    start = text.find("<")
+    end = text.rfind(">")
+    if start < 0 or end < start:
+        return ""
+    text = text[start:end + 1]
+    if text.startswith("<?xml"):
+        text = text[text.find("?>") + 2:].lstrip()
+    return text
+
+
+def _namespace_decls() -> str:
+    return " ".join(f'xmlns:{p}="{uri}"' for p, uri in NAMESPACES.items())
+
+
+def _wrap_fragment(text: str, repairs: list) -> str:
+    """Wrap process / collaboration elements that lack a definitions root."""
+    if _ROOT_RE.search(text[:2000]):
+        return text
+    repairs.append("wrapped the reply in <bpmn:definitions>")
+    return (
+        f'<bpmn:definitions {_namespace_decls()} id="Definitions_1" '
+        'targetNamespace="http://bpmn.io/schema/bpmn">\n'
+        f"{text}\n</bpmn:definitions>"
+    )
+
+
+def _declare_namespaces(text: str, repairs: list) -> str:
+    """Add ``xmlns:`` declarations for standard prefixes used but never bound."""
+    root = _ROOT_RE.search(text)
+    if root is None:
+        return text
+    used = {a or b for a, b in _PREFIX_RE.findall(text)} - {"xmlns", "xml"}
+    declared = set(re.findall(r"xmlns:([\w.-]+)\s*=", text))
+    missing = sorted(p for p in used - declared if p in NAMESPACES)
+    if not missing:
+        return text
+    repairs.append(f"declared missing namespace prefix(es): {', '.join(missing)}")
+    decls = "".join(f' xmlns:{p}="{NAMESPACES[p]}"' for p in missing)
+    return text[:root.end()] + decls + text[root.end():]
+
+
+def _close_truncated(text: str, repairs: list) -> str:
+    """
+    Drop a partial trailing tag and close every element still open – the
+    usual shape of a reply cut off by the output token limit.
+    """
+    text = text[:text.rfind(">") + 1]
+    stack = []
+    for match in _TAG_RE.finditer(text):
+        closing, name, _, empty = match.groups()
+        if empty:
+            continue
+        if not closing:
+            stack.append(name)
+        elif name in stack:
+            while stack and stack.pop() != name:
+                pass
+    if stack:
+        repairs.append(f"closed {len(stack)} element(s) left open by truncated output")
+    return text + "".join(f"</{name}>" for name in reversed(stack))
+
+
+def _parse(text: str, repairs: list):
+    """Parse *text*, applying the text-level repairs only if parsing fails."""
+    error = None
+    for fix in (None, _declare_namespaces, _close_truncated):
+        if fix is not None:
+            text = fix(text, repairs)
+        try:
+            return parse_xml(text), text
+        except ET.ParseError as exc:
+            error = exc
+    raise error
+
+
+# ------------------------------------------------------------------------
+#  Tree-level checks
+# ------------------------------------------------------------------------
+def _parents(root) -> dict:
+    return {child: parent for parent in root.iter() for child in parent}
+
+
+def _check_tree(root, fix: bool) -> tuple:
+    """
+    One pass over the semantic model.  Returns ``(issues, changed)``; with
+    *fix* the issues are repaired in place as they are found.
+    """
+    issues = []
+    parent = _parents(root)
+    semantic = [e for e in root.iter() if is_bpmn(e)]
+
+    # ---- duplicate ids ----
+    seen = set()
+    for elem in semantic:
+        elem_id = elem.get("id")
+        if not elem_id:
+            continue
+        if elem_id in seen:
+            if fix:
+                n = 2
+                while f"{elem_id}_{n}" in seen:
+                    n += 1
+                elem.set("id", f"{elem_id}_{n}")
+                issues.append(f"renamed duplicate id '{elem_id}' to '{elem_id}_{n}'")
+                elem_id = elem.get("id")
+            else:
+                issues.append(f"duplicate id '{elem_id}'")
+        seen.add(elem_id)
+
+    nodes = {e.get("id"): e for e in semantic if local_name(e.tag) in FLOW_NODE_TYPES}
+    processes = {e.get("id") for e in semantic if is_bpmn(e, "process")}
+    participants = {e.get("id") for e in semantic if is_bpmn(e, "participant")}
+    endpoints = {"sequenceFlow": nodes, "messageFlow": set(nodes) | participants}
+
+    def drop(elem, why):
+        issues.append(why)
+        if fix and elem in parent:
+            parent[elem].remove(elem)
+
+    # ---- dangling references (boundary events first: their flows go too) ----
+    for elem in semantic:
+        if is_bpmn(elem, "boundaryEvent") and elem.get("attachedToRef") not in nodes:
+            elem_id = elem.get("id")
+            nodes.pop(elem_id, None)
+            endpoints["messageFlow"].discard(elem_id)
+            drop(elem, f"boundaryEvent '{elem.get('id')}' is attached to missing '{elem.get('attachedToRef')}'")
+    for elem in semantic:
+        kind = local_name(elem.tag)
+        if kind in endpoints:
+            for ref in ("sourceRef", "targetRef"):
+                if elem.get(ref) not in endpoints[kind]:
+                    drop(elem, f"{kind} '{elem.get('id')}' has dangling {ref} '{elem.get(ref)}'")
+                    break
+        elif kind == "flowNodeRef" and (elem.text or "").strip() not in nodes:
+            drop(elem, f"lane refers to missing node '{(elem.text or '').strip()}'")
+        elif kind == "participant" and elem.get("processRef") and elem.get("processRef") not in processes:
+            issues.append(f"participant '{elem.get('id')}' refers to missing process '{elem.get('processRef')}'")
+            if fix:
+                del elem.attrib["processRef"]
+
+    if not nodes:
+        issues.append("diagram contains no flow elements")
+    changed = bool(issues)
+    if fix and _sync_flow_refs(root):
+        issues.append("removed stale incoming/outgoing/default references")
+        changed = True
+    return issues, changed
+
+
+def _sync_flow_refs(root) -> bool:
+    """
+    Drop ``incoming``/``outgoing`` refs and ``default`` attributes that do
+    not match a sequence flow of the node (missing refs are harmless).
+    Returns True if anything was removed.
+    """
+    refs = {"incoming": set(), "outgoing": set()}
+    for flow in root.iter(q("bpmn", "sequenceFlow")):
+        refs["outgoing"].add((flow.get("sourceRef"), flow.get("id")))
+        refs["incoming"].add((flow.get("targetRef"), flow.get("id")))
+    changed = False
+    for elem in root.iter():
+        if not is_bpmn(elem) or local_name(elem.tag) not in FLOW_NODE_TYPES:
+            continue
+        node_id = elem.get("id")
+        for ref in [c for c in elem if is_bpmn(c, "incoming", "outgoing")]:
+            if (node_id, (ref.text or "").strip()) not in refs[local_name(ref.tag)]:
+                elem.remove(ref)
+                changed = True
+        if elem.get("default") and (node_id, elem.get("default")) not in refs["outgoing"]:
+            del elem.attrib["default"]
+            changed = True
+    return changed
+
+
+# ------------------------------------------------------------------------
+#  Public API
+# ------------------------------------------------------------------------
+def validate_xml(xml: str) -> list:
+    """
+    Check *xml* without changing it.
+
+    Returns
+    -------
+    list[str]
+        Problems found: malformed / truncated XML, missing namespaces,
+        duplicate ids, dangling references, elements without DI.  Empty if
+        the document is ready for bpmn-js.
+    """
+    try:
+        root = parse_xml(xml)
+    except ET.ParseError as exc:
+        return [f"XML is not well-formed ({exc})"]
+    if not is_bpmn(root, "definitions"):
+        return ["root element is not bpmn:definitions"]
+    issues, _ = _check_tree(root, fix=False)
+    layout = read_layout(root)
+    graph = read_graph(root)
+    missing = [n["id"] for n in graph["nodes"] if n["id"] not in layout["shapes"]]
+    missing += [f["id"] for f in graph["flows"] if f["id"] not in layout["edges"]]
+    if missing:
+        issues.append(f"{len(missing)} element(s) without DI")
+    return issues
+
+
+def repair_xml(xml: str, previous_xml: str = None) -> tuple:
+    """
+    Validate *xml* and repair it locally where possible.
+
+    Parameters
+    ----------
+    xml : str
+        Model output (may include chatter, be truncated, lack DI …).
+    previous_xml : str | None
+        Diagram currently on screen; its shapes keep their position when DI
+        has to be (re)computed.
+
+    Returns
+    -------
+    tuple
+        ``(fixed_xml, repairs, problems)`` – *fixed_xml* is None if the
+        reply cannot be turned into a usable diagram, in which case
+        *problems* says why (suitable for a correction request).
+    """
+    repairs = []
+    text = _extract(xml or "")
+    if not text:
+        return None, repairs, ["the reply contains no XML"]
+    text = _wrap_fragment(text, repairs)
+    try:
+        root, text = _parse(text, repairs)
+    except ET.ParseError as exc:
+        return None, repairs, [f"XML is not well-formed ({exc})"]
+    if not is_bpmn(root, "definitions"):
+        return None, repairs, ["root element is not bpmn:definitions"]
+
+    issues, changed = _check_tree(root, fix=True)
+    if "diagram contains no flow elements" in issues:
+        return None, repairs, ["the diagram contains no flow elements"]
+    repairs += issues
+
+    if changed or not has_complete_di(root):
+        previous = read_layout(root)
+        if previous["shapes"] and not changed:
+            repairs.append("laid out elements without DI")
+        if previous_xml:
+            try:
+                earlier = read_layout(previous_xml)
+                previous["shapes"].update(earlier["shapes"])
+                previous["edges"].update(earlier["edges"])
+            except ET.ParseError:
+                pass
+        write_di(root, layout_graph(read_graph(root), previous))
+        return to_xml(root), repairs, []
+    if repairs:
+        return to_xml(root), repairs, []
+    return XML_DECLARATION + text.strip() + "\n", repairs, []
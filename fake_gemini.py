@@ -0,0 +1,305 @@
+"""
+fake_gemini.py
+--------------
+Local stand-in for ``google.genai.Client`` so the app, the router and the
+handlers can be exercised without an API key or network access.
+
+Only the surface the app uses is implemented: ``client.chats.create`` /
+``client.aio.chats.create`` returning chats with ``send_message_stream``
+and ``get_history``.  Latency, hung calls and server errors can be
+injected per model:
+
+    client = FakeClient(latency={"gemini-2.5-pro": 2.0}, failure_rate=0.1)
+
+By default every reply is a small valid diagram (a start event, one task
+per sentence of the prompt, an end event) in the JSON graph format, or
+fenced XML when ``TACITFLOW_OUTPUT_FORMAT=xml``; outline and part requests
+of gemini_decompose.py get an outline of ten steps per part and parts with
+the requested boundary markers.  Pass ``responder`` to script replies:
+``responder(model, history, message) -> str``, or replay recorded ones
+with :class:`ReplayResponder`.  The last chunk carries
+``usage_metadata`` with token counts estimated at four characters per
+token.
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from google.genai import errors
+
+from gemini_decompose import CONTINUE, ENTER, OUTLINE_HEADER, PART_HEADER
+
+
+def _steps(text: str, limit: int) -> list:
+    return [s.strip() for s in re.split(r"[.;\n]+|\bthen\b", text) if s.strip()][:limit]
+
+
+def _outline_reply(message: str) -> str:
+    """Outline of a decomposed request: one part per ten sentences, in order."""
+    steps = _steps(message[len(OUTLINE_HEADER):], 400)
+    chunks = [steps[i:i + 10] for i in range(0, len(steps), 10)] or [["Do the work"]]
+    parts = [
+        {"id": f"P{i}", "name": chunk[0][:40], "scope": "; ".join(chunk)}
+        for i, chunk in enumerate(chunks, start=1)
+    ]
+    links = [{"source": a["id"], "target": b["id"]} for a, b in zip(parts, parts[1:])]
+    return json.dumps({"processes": [{"id": "Process_1"}], "lanes": [], "parts": parts,
+                       "links": links})
+
+
+def _part_reply(message: str) -> str:
+    """One part of a decomposed request, with the boundary markers it asks for."""
+    scope = message.split("Draw ONLY part", 1)[1].split("\n", 1)[0]
+    scope = scope.split(": ", 1)[1] if ": " in scope else scope
+    entered = f'id "{ENTER}"' in message
+    continues = re.findall(rf'id "({CONTINUE}_\w+)"', message)
+    nodes = [{"id": ENTER if entered else "Start_1", "type": "startEvent",
+              "name": "" if entered else "Start"}]
+    nodes += [
+        {"id": f"Task_{i}", "type": "task", "name": step[:40]}
+        for i, step in enumerate(_steps(scope, 20) or ["Do the work"], start=1)
+    ]
+    nodes += [{"id": c, "type": "endEvent"} for c in continues] or [
+        {"id": "End_1", "type": "endEvent", "name": "Done"}
+    ]
+    last = len(nodes) - max(1, len(continues))
+    flows = [{"source": a["id"], "target": b["id"]} for a, b in zip(nodes[:last], nodes[1:last])]
+    flows += [{"source": nodes[last - 1]["id"], "target": end["id"]} for end in nodes[last:]]
+    return json.dumps({"graph": {"nodes": nodes, "flows": flows}, "comments": []})
+
+
+def default_reply(model: str, history: list, message: str) -> str:
+    """A minimal, well-formed reply for *message* (first turn or follow-up)."""
+    if message.startswith(OUTLINE_HEADER):
+        return _outline_reply(message)
+    if message.startswith(PART_HEADER):
+        return _part_reply(message)
+    follow_up = bool(history)
+    structured = os.environ.get("TACITFLOW_OUTPUT_FORMAT", "graph").lower() != "xml"
+    if follow_up:
+        return (
+            json.dumps({"edits": [], "comments": []}) if structured
+            else "```edits\n[]\n```\n\n```json\n[]\n```"
+        )
+
+    request = message.split("\n\nRemember:")[0]
+    steps = _steps(request, 8)
+    nodes = [{"id": "Start_1", "type": "startEvent", "name": "Start"}]
+    nodes += [
+        {"id": f"Task_{i}", "type": "task", "name": step[:40]}
+        for i, step in enumerate(steps or ["Do the work"], start=1)
+    ]
+    nodes.append({"id": "End_1", "type": "endEvent", "name": "Done"})
+    flows = [
+        {"id": f"Flow_{i}", "source": a["id"], "target": b["id"]}
+        for i, (a, b) in enumerate(zip(nodes, nodes[1:]), start=1)
+    ]
+    if structured:
+        return json.dumps({"graph": {"nodes": nodes, "flows": flows}, "comments": []})
+
+    elements = "".join(
+        f'    <bpmn:{n["type"]} id="{n["id"]}" name="{n["name"]}" />\n' for n in nodes
+    ) + "".join(
+        f'    <bpmn:sequenceFlow id="{f["id"]}" sourceRef="{f["source"]}" targetRef="{f["target"]}" />\n'
+        for f in flows
+    )
+    return (
+        "```xml\n"
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<bpmn:definitions xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL" '
+        'id="Definitions_1" targetNamespace="http://bpmn.io/schema/bpmn">\n'
+        '  <bpmn:process id="Process_1" isExecutable="false">\n'
+        f"{elements}"
+        "  </bpmn:process>\n"
+        "</bpmn:definitions>\n"
+        "```\n\n```json\n[]\n```"
+    )
+
+
+class ReplayResponder:
+    """
+    Replays recorded replies.
+
+    *recordings* is a list of ``{"reply": str, "match": str, "turn": str}``
+    dicts; ``match`` (optional) must occur in the message and ``turn``
+    (``"first"`` / ``"followup"``, optional) restricts a recording to
+    first turns or follow-ups.  The first matching recording wins; without
+    a match, replies of the right turn kind are handed out round-robin.
+    """
+
+    def __init__(self, recordings):
+        self.recordings = list(recordings)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Read recordings from a JSON-lines file."""
+        with open(path, encoding="utf-8") as fh:
+            return cls(json.loads(line) for line in fh if line.strip())
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as fh:
+            for recording in self.recordings:
+                fh.write(json.dumps(recording, ensure_ascii=False) + "\n")
+
+    def __call__(self, model, history, message):
+        turn = "followup" if history else "first"
+        usable = [r for r in self.recordings if r.get("turn", turn) == turn]
+        for recording in usable:
+            if recording.get("match") and recording["match"] in message:
+                return recording["reply"]
+        if not usable:
+            return default_reply(model, history, message)
+        with self._lock:
+            self._next += 1
+            return usable[(self._next - 1) % len(usable)]["reply"]
+
+
+class FakeClient:
+    """
+    Parameters
+    ----------
+    responder : callable | None
+        ``responder(model, history, message) -> str``; default
+        :func:`default_reply`.
+    latency : float | dict
+        Seconds before the first chunk, globally or per model name.
+    chunk_size : int
+        Characters per streamed chunk.
+    chunk_delay : float
+        Seconds between chunks.
+    failure_rate, hang_rate : float
+        Probability that a call fails with a 503 / never answers.
+    seed : int | None
+        Seed for the failure / hang dice.
+    """
+
+    def __init__(self, responder=None, latency=0.0, chunk_size=400, chunk_delay=0.0,
+                 failure_rate=0.0, hang_rate=0.0, seed=None):
+        self.responder = responder or default_reply
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.calls = []                  # (model, message) per request
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chats = SimpleNamespace(create=self._create_chat)
+        self.aio = SimpleNamespace(chats=SimpleNamespace(create=self._create_async_chat))
+
+    @classmethod
+    def from_env(cls):
+        """
+        ``TACITFLOW_FAKE_LATENCY`` / ``_CHUNK_SIZE`` / ``_CHUNK_DELAY`` /
+        ``_FAILURE_RATE`` / ``_HANG_RATE``, and ``_REPLAY`` (JSON-lines
+        file of recordings for :class:`ReplayResponder`).
+        """
+        env = os.environ.get
+        replay = env("TACITFLOW_FAKE_REPLAY")
+        return cls(
+            responder=ReplayResponder.load(replay) if replay else None,
+            latency=float(env("TACITFLOW_FAKE_LATENCY", 0.5)),
+            chunk_size=int(env("TACITFLOW_FAKE_CHUNK_SIZE", 400)),
+            chunk_delay=float(env("TACITFLOW_FAKE_CHUNK_DELAY", 0.02)),
+            failure_rate=float(env("TACITFLOW_FAKE_FAILURE_RATE", 0)),
+            hang_rate=float(env("TACITFLOW_FAKE_HANG_RATE", 0)),
+        )
+
+    def _create_chat(self, model, config=None, history=None):
+        return FakeChat(self, model, history)
+
+    def _create_async_chat(self, model, config=None, history=None):
+        return FakeAsyncChat(self, model, history)
+
+    def _plan(self, model, history, message):
+        """Decide the outcome of one call: ``(delay, fate, chunks)``."""
+        with self._lock:
+            self.calls.append((model, message))
+            roll = self._random.random()
+        delay = self.latency.get(model, 0.0) if isinstance(self.latency, dict) else self.latency
+        if roll < self.failure_rate:
+            return delay, "fail", []
+        if roll < self.failure_rate + self.hang_rate:
+            return delay, "hang", []
+        text = self.responder(model, history, message)
+        size = max(1, self.chunk_size)
+        return delay, "ok", [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+def _chunks(history, message, chunks):
+    """Chunk objects as the SDK streams them; usage rides on the last one."""
+    prompt = len(message) + sum(len(json.dumps(h, default=str)) for h in history)
+    usage = SimpleNamespace(
+        prompt_token_count=prompt // 4,
+        candidates_token_count=sum(len(c) for c in chunks) // 4,
+        cached_content_token_count=None,
+        thoughts_token_count=None,
+    )
+    return [
+        SimpleNamespace(text=chunk, usage_metadata=usage if i == len(chunks) - 1 else None)
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def _overloaded():
+    return errors.ServerError(503, {"error": {"message": "fake overload", "status": "UNAVAILABLE"}})
+
+
+class FakeChat:
+    """Synchronous chat (``client.chats.create``)."""
+
+    def __init__(self, client, model, history=None):
+        self._client = client
+        self._model = model
+        self._history = list(history or [])
+
+    def get_history(self, curated=False):
+        return list(self._history)
+
+    def send_message_stream(self, message):
+        delay, fate, chunks = self._client._plan(self._model, self._history, message)
+        time.sleep(delay)
+        if fate == "fail":
+            raise _overloaded()
+        if fate == "hang":
+            time.sleep(3600)
+        for i, chunk in enumerate(_chunks(self._history, message, chunks)):
+            if i:
+                time.sleep(self._client.chunk_delay)
+            yield chunk
+        self._history += [
+            {"role": "user", "parts": [{"text": message}]},
+            {"role": "model", "parts": [{"text": "".join(chunks)}]},
+        ]
+
+
+class FakeAsyncChat(FakeChat):
+    """Async chat (``client.aio.chats.create``), same behaviour."""
+
+    async def send_message_stream(self, message):
+        delay, fate, chunks = self._client._plan(self._model, self._history, message)
+
+        async def stream():
+            await asyncio.sleep(delay)
+            if fate == "fail":
+                raise _overloaded()
+            if fate == "hang":
+                await asyncio.sleep(3600)
+            for i, chunk in enumerate(_chunks(self._history, message, chunks)):
+                if i:
+                    await asyncio.sleep(self._client.chunk_delay)
+                yield chunk
+            self._history += [
+                {"role": "user", "parts": [{"text": message}]},
+                {"role": "model", "parts": [{"text": "".join(chunks)}]},
+            ]
+
+        return stream()
@@ -2,6 +2,8 @@
 # -------------------------------------------------------------------
 # (only the head_html string changed – everything else is untouched)
 
+from frontend_assets import SCRIPT, STYLESHEETS, asset_url
+
 initial_bpmn_xml = """<?xml version="1.0" encoding="UTF-8"?>
 <bpmn:definitions xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
                   xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL"
@@ -23,19 +25,20 @@ initial_bpmn_xml = """<?xml version="1.0" encoding="UTF-8"?>
 </bpmn:definitions>
 """
 
+_stylesheet_links = "\n".join(
+    f'    <link rel="stylesheet" href="{asset_url(css)}">' for css in STYLESHEETS
+)
+
 # -------------------------------------------------------------------
 # Everything below lives in <head>.  The CSS additions and new JS
 # sections are clearly marked with  >>> NEW <<< comments.
 # -------------------------------------------------------------------
 head_html = f"""
 <head>
-    <!-- bpmn-js Modeler CSS -->
-    <link rel="stylesheet" href="https://unpkg.com/bpmn-js@18.6.2/dist/assets/bpmn-js.css">
-    <link rel="stylesheet" href="https://unpkg.com/bpmn-js@18.6.2/dist/assets/diagram-js.css">
-    <link rel="stylesheet" href="https://unpkg.com/bpmn-js@18.6.2/dist/assets/bpmn-font/css/bpmn.css">
-
-    <!-- bpmn-js Modeler JS -->
-    <script src="https://unpkg.com/bpmn-js@18.6.2/dist/bpmn-modeler.development.js"></script>
+    <!-- bpmn-js Modeler CSS (self-hosted, see frontend_assets.py) -->
+{_stylesheet_links}
+    <!-- bpmn-js Modeler JS – production build -->
+    <script id="bpmn-js-script" src="{asset_url(SCRIPT)}"></script>
 
     <style>
         /* -----------------------------------------------------------------
@@ -72,6 +75,11 @@ head_html = f"""
         .needs-discussion:not(.djs-connection) .djs-visual > :nth-child(1) {{
             stroke: rgba(66,180,21,.7) !important;
         }}
+        /* structural findings computed locally (bpmn_analysis.py) */
+        .diagram-note.structural-issue {{ background-color: rgba(230,126,34,.85); }}
+        .structural-issue:not(.djs-connection) .djs-visual > :nth-child(1) {{
+            stroke: rgba(230,126,34,.85) !important;
+        }}
     </style>
 
     <script>
@@ -83,48 +91,297 @@ head_html = f"""
 
         // >>> NEW <<< : overlay bookkeeping
         let pendingOverlaySpecs = [];   // specs waiting for a diagram to load
-        const currentOverlayIds  = [];  // overlay handles so we can remove them
+        const currentOverlays = new Map();  // spec key → {{ elementId, overlayId, markerClass }}
+
+        // Render scheduling: mutations are debounced and coalesced, and an
+        // update that arrives while a render runs is applied right after it
+        const RENDER_DEBOUNCE_MS = 120;
+        const MAX_INCREMENTAL_CHANGES = 400;    // above this a full import is faster
+        let renderTimer = null;
+        let rendering = false;
+        let renderQueued = false;
+        let lastRenderedXml = null;
+        let lastOverlayRaw = null;
 
         /* -----------------------------------------------------------------
-           2.  Utility — add / refresh overlays
+           2.  Utility — keyed overlay diff (only changed notes are touched)
         ------------------------------------------------------------------*/
+        function overlayKey(spec) {{
+            return JSON.stringify([spec.id, spec.text || '', spec.position || null, spec.markerClass || '']);
+        }}
+
         function applyOverlays(specs = []) {{
             if (!bpmnModeler) return;
             const overlays = bpmnModeler.get('overlays');
             const canvas   = bpmnModeler.get('canvas');
+            const registry = bpmnModeler.get('elementRegistry');
 
-            // Remove previous note overlays & markers
-            currentOverlayIds.forEach(id => overlays.remove(id));
-            currentOverlayIds.length = 0;  // reset array
+            const wanted = new Map();
+            (Array.isArray(specs) ? specs : []).forEach(spec => {{
+                if (spec && spec.id && registry.get(spec.id)) wanted.set(overlayKey(spec), spec);
+            }});
 
-            canvas.removeMarker && canvas._eventBus && canvas._eventBus.fire; // keep tree-shakers happy :-)
+            // Remove notes that are gone (or went with a removed / replaced element)
+            for (const [key, entry] of currentOverlays) {{
+                if (wanted.has(key) && registry.get(entry.elementId) && overlays.get(entry.overlayId)) continue;
+                overlays.remove(entry.overlayId);
+                currentOverlays.delete(key);
+                const markerStillUsed = [...currentOverlays.values()].some(
+                    e => e.elementId === entry.elementId && e.markerClass === entry.markerClass);
+                if (entry.markerClass && !markerStillUsed && registry.get(entry.elementId))
+                    canvas.removeMarker(entry.elementId, entry.markerClass);
+            }}
 
-            specs.forEach(spec => {{
-                if (!spec || !spec.id) return;
-                const html       = `<div class="diagram-note">${{spec.text || 'Note'}}</div>`;
-                const position   = spec.position || {{ bottom:0, right:0 }};
-                const overlayId  = overlays.add(spec.id, 'note', {{ position, html }});
-                currentOverlayIds.push(overlayId);
+            // Add the new ones
+            for (const [key, spec] of wanted) {{
+                if (currentOverlays.has(key)) continue;
+                const html = document.createElement('div');
+                html.className = spec.markerClass === 'structural-issue'
+                    ? 'diagram-note structural-issue' : 'diagram-note';
+                html.textContent = spec.text || 'Note';       // model output is text, never markup
+                const position  = spec.position || {{ bottom:0, right:0 }};
+                const overlayId = overlays.add(spec.id, 'note', {{ position, html }});
+                if (spec.markerClass) canvas.addMarker(spec.id, spec.markerClass);
+                currentOverlays.set(key, {{ elementId: spec.id, overlayId, markerClass: spec.markerClass }});
+            }}
+        }}
 
-                if (spec.markerClass)
-                    canvas.addMarker(spec.id, spec.markerClass);
-            }});
+        /* -----------------------------------------------------------------
+           3.  Incremental update through the modeler API
+               Returns false when the change is outside what can be patched
+               (pools / lanes / sub-processes changed, element types changed,
+               very large change sets …) – the caller then imports the XML.
+        ------------------------------------------------------------------*/
+        const CONTAINER_TYPES = ['bpmn:Participant', 'bpmn:Lane', 'bpmn:SubProcess',
+                                 'bpmn:Transaction', 'bpmn:AdHocSubProcess'];
+        const CONNECTION_TYPES = ['bpmn:SequenceFlow', 'bpmn:MessageFlow'];
+
+        const eventTypes = bo => (bo.eventDefinitions || []).map(d => d.$type).join(',');
+        const conditionOf = bo => (bo.conditionExpression && bo.conditionExpression.body) || '';
+        const near = (a, b) => Math.abs(a - b) < 1;
+        const sameBounds = (a, b) => near(a.x, b.x) && near(a.y, b.y)
+                                     && near(a.width, b.width) && near(a.height, b.height);
+        const sameWaypoints = (a, b) => a.length === b.length
+                                        && a.every((p, i) => near(p.x, b[i].x) && near(p.y, b[i].y));
+
+        // Tasks, events, gateways and call activities can be patched in place
+        const isFlowNode = type => /(Task|Event|Gateway)$/.test(type) || type === 'bpmn:CallActivity';
+
+        // Signature of everything except name / geometry; a difference means
+        // the element cannot be patched in place
+        function shapeSignature(bo) {{
+            return [bo.$type, eventTypes(bo), bo.attachedToRef ? bo.attachedToRef.id : '',
+                    bo.$parent ? bo.$parent.id : ''].join('|');
+        }}
+
+        async function patchDiagram(xml) {{
+            const moddle   = bpmnModeler.get('moddle');
+            const registry = bpmnModeler.get('elementRegistry');
+            const canvas   = bpmnModeler.get('canvas');
+
+            const {{ rootElement: definitions }} = await moddle.fromXML(xml, 'bpmn:Definitions');
+            const diagrams = definitions.diagrams || [];
+            if (diagrams.length !== 1 || !diagrams[0].plane) return false;
+            const plane = diagrams[0].plane;
+            const root  = canvas.getRootElement();
+            if (!plane.bpmnElement || !root || root.businessObject.id !== plane.bpmnElement.id) return false;
+
+            // New diagram: id → DI
+            const shapes = new Map(), edges = new Map();
+            for (const di of plane.planeElement || []) {{
+                if (!di.bpmnElement) return false;
+                (di.$type === 'bpmndi:BPMNEdge' ? edges : shapes).set(di.bpmnElement.id, di);
+            }}
+
+            // Current diagram
+            const current = registry.filter(e => e !== root && e.type !== 'label');
+            const currentIds = new Set(current.map(e => e.id));
+
+            // Containers must be unchanged (same set, same bounds)
+            const oldContainers = current.filter(e => CONTAINER_TYPES.includes(e.type));
+            const newContainers = [...shapes.values()].filter(di => CONTAINER_TYPES.includes(di.bpmnElement.$type));
+            if (oldContainers.length !== newContainers.length) return false;
+            for (const di of newContainers) {{
+                const el = registry.get(di.bpmnElement.id);
+                if (!el || el.type !== di.bpmnElement.$type || !sameBounds(el, di.bounds)) return false;
+            }}
+
+            // Plan
+            const removed = current.filter(e => !shapes.has(e.id) && !edges.has(e.id));
+            const addedShapes = [], addedEdges = [], changedEdges = [];
+            for (const [id, di] of shapes) {{
+                const bo = di.bpmnElement;
+                if (CONTAINER_TYPES.includes(bo.$type)) continue;
+                if (!isFlowNode(bo.$type)) {{
+                    // annotations, data objects …: only tolerated if untouched
+                    const el = registry.get(id);
+                    if (!el || !sameBounds(el, di.bounds)) return false;
+                    continue;
+                }}
+                const el = registry.get(id);
+                if (!el) addedShapes.push(di);
+                else if (shapeSignature(el.businessObject) !== shapeSignature(bo)) return false;
+            }}
+            for (const [id, di] of edges) {{
+                const bo = di.bpmnElement;
+                const el = registry.get(id);
+                if (!CONNECTION_TYPES.includes(bo.$type)) {{
+                    if (!el || !sameWaypoints(el.waypoints, di.waypoint)) return false;
+                    continue;
+                }}
+                if (!el) addedEdges.push(di);
+                else if (el.type !== bo.$type || el.source.id !== bo.sourceRef.id
+                         || el.target.id !== bo.targetRef.id) {{
+                    // reconnected: replace the flow
+                    removed.push(el);
+                    addedEdges.push(di);
+                }}
+                else changedEdges.push([el, di]);
+            }}
+            const total = current.length + addedShapes.length + addedEdges.length;
+            const changes = removed.length + addedShapes.length + addedEdges.length;
+            if (changes > MAX_INCREMENTAL_CHANGES || changes > Math.max(20, total / 2)) return false;
+
+            const modeling     = bpmnModeler.get('modeling');
+            const bpmnFactory  = bpmnModeler.get('bpmnFactory');
+            const elementFactory = bpmnModeler.get('elementFactory');
+
+            // a.  Removals
+            const stillThere = removed.filter(e => registry.get(e.id));
+            if (stillThere.length) modeling.removeElements(stillThere);
+
+            // b.  New shapes (hosts before boundary events)
+            addedShapes.sort((a, b) => (a.bpmnElement.attachedToRef ? 1 : 0) - (b.bpmnElement.attachedToRef ? 1 : 0));
+            for (const di of addedShapes) {{
+                const bo = di.bpmnElement;
+                const attrs = {{ id: bo.id }};
+                if (bo.name) attrs.name = bo.name;
+                if (bo.cancelActivity === false) attrs.cancelActivity = false;
+                const businessObject = bpmnFactory.create(bo.$type, attrs);
+                if (bo.eventDefinitions && bo.eventDefinitions.length) {{
+                    businessObject.eventDefinitions = bo.eventDefinitions.map(d => {{
+                        const def = bpmnFactory.create(d.$type);
+                        def.$parent = businessObject;
+                        return def;
+                    }});
+                }}
+                const shape = elementFactory.createShape({{
+                    type: bo.$type, businessObject, width: di.bounds.width, height: di.bounds.height,
+                }});
+                const center = {{ x: di.bounds.x + di.bounds.width / 2, y: di.bounds.y + di.bounds.height / 2 }};
+                if (bo.attachedToRef) {{
+                    const host = registry.get(bo.attachedToRef.id);
+                    if (!host) return false;
+                    modeling.createShape(shape, center, host, {{ attach: true }});
+                }} else {{
+                    const parent = containerFor(bo.$parent, registry, root);
+                    if (!parent) return false;
+                    modeling.createShape(shape, center, parent);
+                }}
+            }}
+
+            // c.  Existing shapes: name, position, size
+            for (const [id, di] of shapes) {{
+                const el = registry.get(id);
+                const bo = di.bpmnElement;
+                if (!el || !isFlowNode(bo.$type) || !currentIds.has(id)) continue;
+                if ((el.businessObject.name || '') !== (bo.name || ''))
+                    modeling.updateProperties(el, {{ name: bo.name || undefined }});
+                if (!near(el.width, di.bounds.width) || !near(el.height, di.bounds.height))
+                    modeling.resizeShape(el, {{ x: el.x, y: el.y, width: di.bounds.width, height: di.bounds.height }});
+                if (!near(el.x, di.bounds.x) || !near(el.y, di.bounds.y))
+                    modeling.moveShape(el, {{ x: di.bounds.x - el.x, y: di.bounds.y - el.y }});
+            }}
+            // Lane / pool names may change without geometry changes
+            for (const di of newContainers) {{
+                const el = registry.get(di.bpmnElement.id);
+                if ((el.businessObject.name || '') !== (di.bpmnElement.name || ''))
+                    modeling.updateProperties(el, {{ name: di.bpmnElement.name || undefined }});
+            }}
+
+            // d.  New flows
+            for (const di of addedEdges) {{
+                const bo = di.bpmnElement;
+                const source = registry.get(bo.sourceRef.id), target = registry.get(bo.targetRef.id);
+                if (!source || !target) return false;
+                const attrs = {{ id: bo.id }};
+                if (bo.name) attrs.name = bo.name;
+                if (conditionOf(bo))
+                    attrs.conditionExpression = bpmnFactory.create('bpmn:FormalExpression', {{ body: conditionOf(bo) }});
+                const businessObject = bpmnFactory.create(bo.$type, attrs);
+                const parent = bo.$type === 'bpmn:MessageFlow' ? root : source.parent;
+                const connection = modeling.createConnection(
+                    source, target, {{ type: bo.$type, businessObject }}, parent);
+                modeling.updateWaypoints(connection, di.waypoint.map(p => ({{ x: p.x, y: p.y }})));
+            }}
+
+            // e.  Existing flows: name, condition, route
+            for (const [el, di] of changedEdges) {{
+                const bo = di.bpmnElement;
+                if ((el.businessObject.name || '') !== (bo.name || ''))
+                    modeling.updateProperties(el, {{ name: bo.name || undefined }});
+                if (conditionOf(el.businessObject) !== conditionOf(bo))
+                    modeling.updateProperties(el, {{ conditionExpression: conditionOf(bo)
+                        ? bpmnFactory.create('bpmn:FormalExpression', {{ body: conditionOf(bo) }}) : undefined }});
+                if (!sameWaypoints(el.waypoints, di.waypoint))
+                    modeling.updateWaypoints(el, di.waypoint.map(p => ({{ x: p.x, y: p.y }})));
+            }}
+
+            // f.  Default flows and external label positions
+            for (const [id, di] of shapes) {{
+                const el = registry.get(id);
+                if (!el) continue;
+                const wantDefault = di.bpmnElement.default ? di.bpmnElement.default.id : null;
+                const haveDefault = el.businessObject.default ? el.businessObject.default.id : null;
+                if (wantDefault !== haveDefault) {{
+                    const flow = wantDefault && registry.get(wantDefault);
+                    modeling.updateProperties(el, {{ default: flow ? flow.businessObject : undefined }});
+                }}
+            }}
+            for (const di of [...shapes.values(), ...edges.values()]) {{
+                const el = registry.get(di.bpmnElement.id);
+                const bounds = di.label && di.label.bounds;
+                if (el && el.label && bounds && (!near(el.label.x, bounds.x) || !near(el.label.y, bounds.y)))
+                    modeling.moveShape(el.label, {{ x: bounds.x - el.label.x, y: bounds.y - el.label.y }});
+            }}
+
+            // Server updates are not user edits: keep undo for the user's own
+            bpmnModeler.get('commandStack').clear();
+            return true;
+        }}
+
+        function containerFor(parentBo, registry, root) {{
+            if (!parentBo) return null;
+            if (root.businessObject.id === parentBo.id) return root;
+            const direct = registry.get(parentBo.id);          // expanded sub-process
+            if (direct) return direct;
+            return registry.find(e => e.type === 'bpmn:Participant'
+                && e.businessObject.processRef && e.businessObject.processRef.id === parentBo.id) || null;
         }}
 
         /* -----------------------------------------------------------------
-           3.  Render BPMN
+           4.  Render BPMN: patch in place, full import only as fallback
         ------------------------------------------------------------------*/
         async function renderBpmn(xml) {{
             if (!bpmnModeler || !xml?.trim()) return;
+            const container = document.getElementById('bpmn-canvas');
             try {{
-                await bpmnModeler.importXML(xml);
-                bpmnModeler.get('canvas').zoom('fit-viewport');
+                let patched = false;
+                if (lastRenderedXml !== null) {{
+                    try {{
+                        patched = await patchDiagram(xml);
+                    }} catch (err) {{
+                        console.warn('Incremental update failed, importing the diagram:', err);
+                    }}
+                }}
+                if (!patched) await importKeepingViewport(xml);
+                lastRenderedXml = xml;
+                container.querySelector('.bpmn-error')?.remove();
 
                 // >>> NEW <<<  — now (re)apply overlays
                 applyOverlays(pendingOverlaySpecs);
             }} catch (err) {{
                 console.error('Error rendering BPMN XML:', err);
-                const container = document.getElementById('bpmn-canvas');
                 let errorMsg = container.querySelector('.bpmn-error');
                 if (!errorMsg) {{
                     errorMsg = document.createElement('div');
@@ -135,8 +392,47 @@ head_html = f"""
             }}
         }}
 
+        async function importKeepingViewport(xml) {{
+            const canvas = bpmnModeler.get('canvas');
+            const firstDiagram = lastRenderedXml === null
+                || canvas.getRootElement().children.length <= 1;       // blank template
+            const {{ x, y, width, height }} = canvas.viewbox();
+            await bpmnModeler.importXML(xml);
+            currentOverlays.clear();                                    // import dropped them
+
+            const inner = canvas.viewbox().inner;
+            const visible = inner.x < x + width && inner.x + inner.width > x
+                            && inner.y < y + height && inner.y + inner.height > y;
+            if (firstDiagram || !visible) canvas.zoom('fit-viewport');
+            else canvas.viewbox({{ x, y, width, height }});
+        }}
+
+        function scheduleRender() {{
+            clearTimeout(renderTimer);
+            renderTimer = setTimeout(flushRender, RENDER_DEBOUNCE_MS);
+        }}
+
+        async function flushRender() {{
+            if (rendering) {{                 // picked up when the current render ends
+                renderQueued = true;
+                return;
+            }}
+            const xml = document.querySelector('#bpmn_xml_output textarea')?.value;
+            if (!xml?.trim() || xml === lastRenderedXml || !isModelerInitialized) return;
+            rendering = true;
+            try {{
+                await renderBpmn(xml);
+            }} finally {{
+                rendering = false;
+                if (renderQueued) {{
+                    renderQueued = false;
+                    scheduleRender();
+                }}
+            }}
+        }}
+
         /* -----------------------------------------------------------------
-           4.  Modeler setup (unchanged except final call to renderBpmn)
+           5.  Modeler setup (initial render goes through flushRender)
         ------------------------------------------------------------------*/
         function initializeBpmnModeler() {{
             try {{
@@ -144,25 +440,21 @@ head_html = f"""
                 isModelerInitialized = true;
 
                 // Render initial XML
-                const textarea = document.querySelector('#bpmn_xml_output textarea');
-                if (textarea?.value?.trim()) renderBpmn(textarea.value);
+                flushRender();
             }} catch (err) {{
                 console.error("Failed to initialize BPMN Modeler:", err);
             }}
         }}
 
         /* -----------------------------------------------------------------
-           5.  MutationObservers
+           6.  MutationObservers (debounced; unchanged values are ignored)
         ------------------------------------------------------------------*/
         function setupBpmnWatcher() {{
             const xmlBox     = document.getElementById('bpmn_xml_output');
             const overlayBox = document.getElementById('overlay_specs');
 
             if (xmlBox) {{
-                const obs = new MutationObserver(() => {{
-                    const val = xmlBox.querySelector('textarea')?.value;
-                    if (val?.trim() && isModelerInitialized) renderBpmn(val);
-                }});
+                const obs = new MutationObserver(scheduleRender);
                 obs.observe(xmlBox, {{ childList:true, subtree:true, attributes:true }});
             }}
 
@@ -170,30 +462,61 @@ head_html = f"""
             if (overlayBox) {{
                 const obs2 = new MutationObserver(() => {{
                     const raw = overlayBox.querySelector('textarea')?.value;
+                    if (raw === lastOverlayRaw) return;
+                    lastOverlayRaw = raw;
                     try {{
                         pendingOverlaySpecs = raw ? JSON.parse(raw) : [];
                     }} catch (e) {{
                         console.warn("Overlay JSON parse error:", e);
                         pendingOverlaySpecs = [];
                     }}
-                    if (isModelerInitialized) applyOverlays(pendingOverlaySpecs);
+                    // A render in progress applies them when it finishes
+                    if (isModelerInitialized && !rendering) applyOverlays(pendingOverlaySpecs);
                 }});
                 obs2.observe(overlayBox, {{ childList:true, subtree:true, attributes:true }});
             }}
         }}
 
         /* -----------------------------------------------------------------
-           6.  Boot sequence
+           7.  Boot sequence – driven by readiness, not timers:
+               start as soon as bpmn-js is loaded and Gradio has rendered
+               the canvas; the watchers attach when their boxes appear
         ------------------------------------------------------------------*/
-        function setupBpmn() {{
-            initializeBpmnModeler();
-            setTimeout(setupBpmnWatcher, 500);    // allow DOM to settle
+        function whenElement(selector) {{
+            return new Promise(resolve => {{
+                const found = document.querySelector(selector);
+                if (found) return resolve(found);
+                const obs = new MutationObserver(() => {{
+                    const el = document.querySelector(selector);
+                    if (el) {{
+                        obs.disconnect();
+                        resolve(el);
+                    }}
+                }});
+                obs.observe(document.documentElement, {{ childList:true, subtree:true }});
+            }});
+        }}
+
+        function whenBpmnJs() {{
+            return new Promise((resolve, reject) => {{
+                if (window.BpmnJS) return resolve();
+                const script = document.getElementById('bpmn-js-script');
+                if (!script) return reject(new Error('bpmn-js script tag missing'));
+                script.addEventListener('load', () => resolve(), {{ once:true }});
+                script.addEventListener('error', () => reject(new Error(`could not load ${{script.src}}`)), {{ once:true }});
+            }});
         }}
 
-        if (document.readyState === 'loading')
-            document.addEventListener('DOMContentLoaded', () => setTimeout(setupBpmn, 1000));
-        else
-            setTimeout(setupBpmn, 1000);
+        Promise.all([whenBpmnJs(), whenElement('#bpmn-canvas')])
+            .then(() => {{
+                initializeBpmnModeler();
+                Promise.all([whenElement('#bpmn_xml_output'), whenElement('#overlay_specs')])
+                    .then(() => {{
+                        setupBpmnWatcher();
+                        scheduleRender();          // value may have arrived before the watcher
+                    }});
+            }})
+            .catch(err => console.error('BPMN editor could not start:', err));
     </script>
 </head>
 """
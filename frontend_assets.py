@@ -0,0 +1,176 @@
+"""
+frontend_assets.py
+------------------
+Self-hosted bpmn-js assets.
+
+The editor used to load the unminified *development* bundle and its CSS from
+unpkg on every page load – a runtime dependency on a CDN and no editor at
+all in air-gapped deployments.  The production build is now vendored under
+``vendor/bpmn-js/<version>/`` (same layout as the package's ``dist``) and
+served by the app itself:
+
+  • versioned URLs with ``Cache-Control: public, max-age=31536000, immutable``
+    and an ``ETag`` – a returning browser never asks again;
+  • gzip, compressed once per file and kept in memory;
+  • an allow-list of files, nothing else under the directory is exposed.
+
+Vendor the files once (needs network, or a local copy of the npm package):
+
+    python frontend_assets.py                         # from unpkg
+    python frontend_assets.py --from node_modules/bpmn-js/dist
+
+``TACITFLOW_ASSETS`` selects the source: ``auto`` (default – vendored files
+if present, otherwise the production build from the CDN), ``local`` or
+``cdn``.
+"""
+
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import shutil
+import sys
+import threading
+import urllib.request
+
+BPMN_JS_VERSION = "18.6.2"
+
+# Paths relative to bpmn-js' dist directory
+SCRIPT = "bpmn-modeler.production.min.js"
+STYLESHEETS = (
+    "assets/diagram-js.css",
+    "assets/bpmn-js.css",
+    "assets/bpmn-font/css/bpmn.css",
+)
+REQUIRED_FILES = (SCRIPT,) + STYLESHEETS + (
+    "assets/bpmn-font/font/bpmn.woff2",
+    "assets/bpmn-font/font/bpmn.woff",
+)
+OPTIONAL_FILES = (
+    "assets/bpmn-font/font/bpmn.ttf",
+    "assets/bpmn-font/font/bpmn.eot",
+    "assets/bpmn-font/font/bpmn.svg",
+)
+
+VENDOR_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "vendor", "bpmn-js", BPMN_JS_VERSION
+)
+ROUTE = f"/vendor/bpmn-js/{BPMN_JS_VERSION}"
+CDN_URL = f"https://unpkg.com/bpmn-js@{BPMN_JS_VERSION}/dist"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+_COMPRESSIBLE = (".js", ".css", ".svg", ".ttf", ".eot")
+
+
+def vendored() -> bool:
+    """True if every required file is present in :data:`VENDOR_DIR`."""
+    return all(os.path.isfile(os.path.join(VENDOR_DIR, name)) for name in REQUIRED_FILES)
+
+
+def use_local() -> bool:
+    mode = os.environ.get("TACITFLOW_ASSETS", "auto").lower()
+    if mode == "local":
+        return True
+    if mode == "cdn":
+        return False
+    return vendored()
+
+
+def asset_url(name: str) -> str:
+    """URL of *name* (a dist-relative path) for the configured source."""
+    return f"{ROUTE}/{name}" if use_local() else f"{CDN_URL}/{name}"
+
+
+# ------------------------------------------------------------------------
+#  Serving
+# ------------------------------------------------------------------------
+class _AssetCache:
+    """File bytes, their gzip variant and ETag, loaded once per file."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        """``(raw, gzipped | None, etag)`` or None for unknown files."""
+        if name not in REQUIRED_FILES and name not in OPTIONAL_FILES:
+            return None
+        with self._lock:
+            if name in self._files:
+                return self._files[name]
+        path = os.path.join(self.root, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as fh:
+            raw = fh.read()
+        packed = gzip.compress(raw, 9) if name.endswith(_COMPRESSIBLE) else None
+        entry = (raw, packed, '"' + hashlib.sha256(raw).hexdigest()[:32] + '"')
+        with self._lock:
+            self._files[name] = entry
+        return entry
+
+
+def mount_assets(server, root: str = VENDOR_DIR):
+    """Add the asset route to a FastAPI / Starlette *server*."""
+    from starlette.responses import Response
+
+    cache = _AssetCache(root)
+
+    async def serve(request):
+        name = request.path_params["name"]
+        entry = cache.get(name)
+        if entry is None:
+            return Response(status_code=404)
+        raw, packed, etag = entry
+        headers = {"Cache-Control": CACHE_CONTROL, "ETag": etag, "Vary": "Accept-Encoding"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        body = raw
+        if packed is not None and "gzip" in request.headers.get("accept-encoding", ""):
+            body = packed
+            headers["Content-Encoding"] = "gzip"
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if name.endswith(".woff2"):
+            media_type = "font/woff2"
+        return Response(body, media_type=media_type, headers=headers)
+
+    server.add_route(ROUTE + "/{name:path}", serve, methods=["GET", "HEAD"])
+    return server
+
+
+# ------------------------------------------------------------------------
+#  Vendoring
+# ------------------------------------------------------------------------
+def fetch_assets(source: str = None, dest: str = VENDOR_DIR) -> list:
+    """
+    Copy the files into *dest* from a local ``dist`` directory (*source*)
+    or download them from the CDN.  Returns the files written; a missing
+    required file raises.
+    """
+    written = []
+    for name in REQUIRED_FILES + OPTIONAL_FILES:
+        target = os.path.join(dest, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            if source:
+                shutil.copyfile(os.path.join(source, name), target)
+            else:
+                with urllib.request.urlopen(f"{CDN_URL}/{name}", timeout=60) as response, \
+                        open(target, "wb") as fh:
+                    shutil.copyfileobj(response, fh)
+        except OSError:
+            if name in REQUIRED_FILES:
+                raise
+            continue
+        written.append(name)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Vendor bpmn-js {BPMN_JS_VERSION} (production build)")
+    parser.add_argument("--from", dest="source", help="local bpmn-js dist directory instead of the CDN")
+    args = parser.parse_args()
+    for name in fetch_assets(args.source):
+        print(f"{VENDOR_DIR}/{name}")
+    sys.exit(0 if vendored() else 1)
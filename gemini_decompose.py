@@ -0,0 +1,552 @@
+"""
+gemini_decompose.py
+-------------------
+Hierarchical generation for very large processes.
+
+One request for an end-to-end process with dozens of roles and 100+ steps
+produces a single huge reply: slow, and often cut off at the output limit.
+Instead:
+
+  1. an **outline** call returns the processes (pools), lanes and a list
+     of *parts* – sub-processes / lane segments of a dozen steps or so –
+     plus the links between them;
+  2. every part is generated by its own model call, **in parallel**, with
+     the outline as shared context and fixed lane ids;
+  3. the parts are **stitched** locally into one graph: node ids get the
+     part id as prefix (``P2_Task_Check``), the ``Enter`` / ``Continue_<part>``
+     marker events at part boundaries are replaced by sequence flows, and
+     links between different pools become message flows.
+
+Wall-clock time is the outline plus the slowest part, and no single reply
+has to hold the whole diagram.  A part that still fails becomes a
+placeholder task with a comment instead of sinking the diagram.
+
+The stitched result is an ordinary structured reply (``{"graph",
+"comments"}``), so gemini_handler.py validates, lays out and caches it like
+any single-call reply.  ``TACITFLOW_DECOMPOSE``: ``auto`` (default – first
+turns of at least ``TACITFLOW_DECOMPOSE_MIN_WORDS`` words), ``1`` (every
+first turn) or ``0``.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+
+from google.genai import types
+
+from bpmn_graph import GRAPH_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+OUTLINE_HEADER = "OUTLINE REQUEST"
+PART_HEADER = "PART REQUEST"
+ENTER = "Enter"                  # marker start event of a part entered from another
+CONTINUE = "Continue"            # marker end event, "Continue_<part>"
+
+DEFAULT_MIN_WORDS = 150
+DEFAULT_MAX_PARTS = 12
+DEFAULT_PARALLEL = 8
+_PART_ATTEMPTS = 2               # a part whose reply is not valid JSON is asked once more
+
+_STR = {"type": "STRING"}
+
+OUTLINE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "processes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"id": _STR, "name": _STR},
+                "required": ["id"],
+            },
+        },
+        "lanes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"id": _STR, "name": _STR, "process": _STR},
+                "required": ["id", "name"],
+            },
+        },
+        "parts": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id": _STR,
+                    "name": _STR,
+                    "process": _STR,
+                    "lanes": {"type": "ARRAY", "items": _STR},
+                    "scope": _STR,
+                },
+                "required": ["id", "name", "scope"],
+            },
+        },
+        "links": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"source": _STR, "target": _STR, "name": _STR},
+                "required": ["source", "target"],
+            },
+        },
+    },
+    "required": ["parts", "links"],
+    "propertyOrdering": ["processes", "lanes", "parts", "links"],
+}
+
+PART_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "graph": GRAPH_SCHEMA,
+        "comments": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"id": _STR, "text": _STR},
+                "required": ["id", "text"],
+            },
+        },
+    },
+    "required": ["graph", "comments"],
+    "propertyOrdering": ["graph", "comments"],
+}
+
+OUTLINE_PROMPT = f"""You are a senior BPMN architect planning a large BPMN 2.0 diagram that will be
+drawn in several parts by different people at the same time.
+
+Reply with ONE JSON object:
+• `processes`: {{id, name}} – one per pool (organisation / system that runs its own flow);
+  a single process when everything happens inside one organisation.
+• `lanes`: {{id, name, process}} – the roles; short readable ids (Lane_Clerk).
+• `parts`: {{id, name, process, lanes, scope}} – consecutive segments of the process of
+  roughly 8–20 steps each, at most {DEFAULT_MAX_PARTS}.  `id` is short (P1, P2, …), `lanes` the lane
+  ids the part's steps belong to, `scope` 1–4 sentences naming exactly which steps,
+  decisions and outcomes the part covers – the part's author sees nothing else.
+• `links`: {{source, target, name?}} – where the flow passes from one part to the next
+  (part ids).  Between parts of different processes a link is a message.
+
+Every step belongs to exactly one part.  If the whole process has fewer than about 25
+steps, return a single part."""
+
+
+def wants_decomposition(prompt: str) -> bool:
+    """Should this first-turn *prompt* go through the outline / parts path?"""
+    mode = os.environ.get("TACITFLOW_DECOMPOSE", "auto").lower()
+    if mode in ("0", "off", "false"):
+        return False
+    if mode in ("1", "on", "true", "always"):
+        return True
+    min_words = int(os.environ.get("TACITFLOW_DECOMPOSE_MIN_WORDS", DEFAULT_MIN_WORDS))
+    return len((prompt or "").split()) >= min_words
+
+
+# ------------------------------------------------------------------------
+#  Outline
+# ------------------------------------------------------------------------
+def _ident(value, fallback: str) -> str:
+    value = re.sub(r"\W+", "_", str(value or "")).strip("_")
+    return value if value and not value[0].isdigit() else fallback
+
+
+def normalize_outline(data: dict, max_parts: int = DEFAULT_MAX_PARTS) -> dict:
+    """
+    Unique part ids usable as id prefixes, known processes / lanes on every
+    part, links between existing parts only; parts beyond *max_parts* are
+    merged into the last one.
+    """
+    processes = [
+        {"id": _ident(p.get("id"), f"Process_{i}"), "name": p.get("name") or ""}
+        for i, p in enumerate(data.get("processes") or [], start=1)
+    ] or [{"id": "Process_1", "name": ""}]
+    process_ids = [p["id"] for p in processes]
+
+    process_renamed = {
+        p.get("id"): ident for p, ident in zip(data.get("processes") or [], process_ids)
+    }
+
+    lanes, lane_renamed = [], {}
+    for i, lane in enumerate(data.get("lanes") or [], start=1):
+        lane_id = _ident(lane.get("id"), f"Lane_{i}")
+        if lane_id in lane_renamed.values():
+            continue
+        lane_renamed[lane.get("id")] = lane_id
+        process = process_renamed.get(lane.get("process"), process_ids[0])
+        lanes.append({"id": lane_id, "name": lane.get("name") or lane_id, "process": process})
+    lane_process = {lane["id"]: lane["process"] for lane in lanes}
+
+    parts, renamed = [], {}
+    for i, part in enumerate(data.get("parts") or [], start=1):
+        part_id = _ident(part.get("id"), f"P{i}")
+        if part_id in renamed.values():
+            part_id = f"P{i}"
+        renamed[part.get("id")] = part_id
+        part_lanes = [lane_renamed[l] for l in part.get("lanes") or [] if l in lane_renamed]
+        process = process_renamed.get(part.get("process"))
+        if process is None:
+            process = lane_process[part_lanes[0]] if part_lanes else process_ids[0]
+        part_lanes = [l for l in part_lanes if lane_process[l] == process]
+        parts.append({
+            "id": part_id, "name": part.get("name") or part_id, "process": process,
+            "lanes": part_lanes, "scope": part.get("scope") or "",
+        })
+
+    if len(parts) > max_parts:
+        tail = parts[max_parts - 1:]
+        merged = dict(tail[0], scope=" ".join(p["scope"] for p in tail))
+        merged["lanes"] = list(dict.fromkeys(l for p in tail for l in p["lanes"]))
+        for part in tail[1:]:
+            renamed.update({k: merged["id"] for k, v in renamed.items() if v == part["id"]})
+        parts = parts[:max_parts - 1] + [merged]
+
+    links, seen = [], set()
+    for link in data.get("links") or []:
+        source, target = renamed.get(link.get("source")), renamed.get(link.get("target"))
+        if source and target and source != target and (source, target) not in seen:
+            seen.add((source, target))
+            links.append({"source": source, "target": target, "name": link.get("name") or ""})
+    return {"processes": processes, "lanes": lanes, "parts": parts, "links": links}
+
+
+def _part_message(request: str, outline: dict, part: dict) -> str:
+    names = {p["id"]: p["name"] for p in outline["parts"]}
+    overview = "\n".join(
+        f"- {p['id']} \"{p['name']}\": {p['scope']}" for p in outline["parts"]
+    )
+    lanes = [lane for lane in outline["lanes"] if lane["process"] == part["process"]]
+    rules = []
+    if lanes:
+        rules.append(
+            "Put every node in one of these lanes (use the ids): "
+            + ", ".join(f"{l['id']} ({l['name']})" for l in lanes) + "."
+        )
+    incoming = [l for l in outline["links"] if l["target"] == part["id"]]
+    outgoing = [l for l in outline["links"] if l["source"] == part["id"]]
+    if incoming:
+        rules.append(
+            f"This part continues from {', '.join(names[l['source']] for l in incoming)}: "
+            f'begin with a startEvent with id "{ENTER}" instead of a real start event.'
+        )
+    else:
+        rules.append("Begin with the process's start event.")
+    for link in outgoing:
+        rules.append(
+            f"Where the flow continues in part {link['target']} \"{names[link['target']]}\", "
+            f'end that path with an endEvent with id "{CONTINUE}_{link["target"]}".'
+        )
+    if not outgoing:
+        rules.append("End every path with an end event.")
+    return (
+        f"{PART_HEADER}\n"
+        f"The user described this process:\n{request}\n\n"
+        f"It is drawn in parts:\n{overview}\n\n"
+        f"Draw ONLY part {part['id']} \"{part['name']}\": {part['scope']}\n"
+        + "\n".join(f"• {rule}" for rule in rules)
+        + "\n\nReturn the JSON object with the `graph` of this part only and `comments` "
+        "([] unless the user asked for a review)."
+    )
+
+
+# ------------------------------------------------------------------------
+#  Stitching
+# ------------------------------------------------------------------------
+def _placeholder(part: dict, text: str) -> dict:
+    lane = part["lanes"][0] if part["lanes"] else None
+    node = {"id": "Pending", "type": "task", "name": f"{part['name']} ({text})"}
+    if lane:
+        node["lane"] = lane
+    return {"graph": {"nodes": [node], "flows": []}, "comments": []}
+
+
+def stitch(outline: dict, replies: dict, repairs: list = None) -> dict:
+    """
+    Merge the part replies (``{part id: {"graph", "comments"}}``, missing
+    parts become placeholders) into one ``{"graph", "comments"}`` reply.
+    """
+    repairs = [] if repairs is None else repairs
+    lanes = outline["lanes"]
+    lane_by_name = {lane["name"].strip().lower(): lane["id"] for lane in lanes}
+    lane_process = {lane["id"]: lane["process"] for lane in lanes}
+    part_process = {p["id"]: p["process"] for p in outline["parts"]}
+
+    nodes, flows, comments = [], [], []
+    for part in outline["parts"]:
+        pid = part["id"]
+        reply = replies.get(pid) or _placeholder(part, "pending")
+        graph = reply.get("graph") or {}
+        default_lane = part["lanes"][0] if part["lanes"] else next(
+            (l["id"] for l in lanes if l["process"] == part["process"]), None
+        )
+        ids = {}
+        for node in graph.get("nodes") or []:
+            if node.get("id") and node["id"] not in ids:
+                ids[node["id"]] = node["id"] if node["id"].startswith(pid + "_") else f"{pid}_{node['id']}"
+        seen = set()
+        for node in graph.get("nodes") or []:
+            if not node.get("id") or node["id"] in seen:
+                continue
+            seen.add(node["id"])
+            original = node["id"]
+            node = dict(node, id=ids[original])
+            lane = node.get("lane")
+            if lane not in lane_process:
+                lane = lane_by_name.get(str(lane or "").strip().lower(), default_lane)
+            node.pop("lane", None)
+            node.pop("process", None)
+            if lane and lane_process.get(lane) == part["process"]:
+                node["lane"] = lane
+            node["process"] = part["process"]
+            for ref in ("parent", "attachedTo"):
+                if node.get(ref):
+                    node[ref] = ids.get(node[ref], node[ref])
+            node["_part"], node["_local"] = pid, original
+            nodes.append(node)
+        for i, flow in enumerate(graph.get("flows") or [], start=1):
+            if flow.get("source") in ids and flow.get("target") in ids:
+                flows.append(dict(
+                    flow, id=f"{pid}_{flow.get('id') or f'Flow_{i}'}",
+                    source=ids[flow["source"]], target=ids[flow["target"]],
+                ))
+        for comment in reply.get("comments") or []:
+            if isinstance(comment, dict) and comment.get("id") in ids:
+                comments.append(dict(
+                    comment, id=ids[comment["id"]],
+                    markerClass=comment.get("markerClass") or "needs-discussion",
+                ))
+        if pid not in replies:
+            comments.append({
+                "id": f"{pid}_Pending", "text": "Not generated yet – ask again for this part",
+                "markerClass": "needs-discussion",
+            })
+
+    def boundary(pid, marker, event_type, target=None):
+        """Marker node of *pid* for a link, or the best stand-in."""
+        own = [n for n in nodes if n["_part"] == pid]
+        if target is not None:
+            exact = [n for n in own if n["_local"] == f"{marker}_{target}"]
+            if exact:
+                return exact[0], True
+        marked = [n for n in own if n["_local"] == marker or n["_local"].startswith(marker + "_")]
+        if len(marked) == 1 or (marked and target is None):
+            return marked[0], True
+        has_out = {f["source"] for f in flows}
+        has_in = {f["target"] for f in flows}
+        if event_type == "endEvent":
+            loose = [n for n in own if n["id"] not in has_out and n["type"] != "endEvent"
+                     and n["type"] != "boundaryEvent" and not n.get("parent")]
+            if loose:
+                return loose[-1], False
+            ends = [n for n in own if n["type"] == "endEvent" and not n.get("parent")]
+            return (ends[-1], True) if ends else (own[-1] if own else None, False)
+        starts = [n for n in own if n["type"] == "startEvent" and not n.get("parent")]
+        if starts:
+            return starts[0], True
+        loose = [n for n in own if n["id"] not in has_in and n["type"] != "boundaryEvent"
+                 and not n.get("parent")]
+        return (loose[0] if loose else (own[0] if own else None)), False
+
+    removed, stitched = set(), []
+    for index, link in enumerate(outline["links"], start=1):
+        source, target = link["source"], link["target"]
+        exit_node, exit_marker = boundary(source, CONTINUE, "endEvent", target)
+        entry_node, entry_marker = boundary(target, ENTER, "startEvent")
+        if exit_node is None or entry_node is None:
+            repairs.append(f"could not connect part {source} to part {target}")
+            continue
+        if part_process[source] != part_process[target]:
+            # Different pools: keep both events, joined by a message flow
+            if exit_marker and exit_node["type"] == "endEvent":
+                exit_node.setdefault("event", "message")
+            if entry_marker and entry_node["type"] == "startEvent":
+                entry_node.setdefault("event", "message")
+            stitched.append({
+                "id": f"Message_{source}_{target}", "type": "messageFlow",
+                "source": exit_node["id"], "target": entry_node["id"],
+                "name": link.get("name") or "",
+            })
+            continue
+        into_exit = [f for f in flows if f["target"] == exit_node["id"]] if exit_marker else []
+        out_of_entry = [f for f in flows if f["source"] == entry_node["id"]] if entry_marker else []
+        sources = [(f["source"], f.get("name")) for f in into_exit] or [(exit_node["id"], None)]
+        targets = [f["target"] for f in out_of_entry] or [entry_node["id"]]
+        if exit_marker and into_exit:
+            removed.add(exit_node["id"])
+        elif exit_node["type"] == "endEvent":
+            exit_node["type"] = "intermediateThrowEvent"     # the flow goes on
+        if entry_marker and out_of_entry:
+            removed.add(entry_node["id"])
+        elif entry_node["type"] == "startEvent":
+            entry_node["type"] = "intermediateCatchEvent"
+        for k, ((src, name), tgt) in enumerate(
+            ((s, t) for s in sources for t in targets), start=1
+        ):
+            stitched.append({
+                "id": f"Flow_{source}_{target}_{k}", "source": src, "target": tgt,
+                "name": name or link.get("name") or "",
+            })
+
+    nodes = [
+        {k: v for k, v in n.items() if not k.startswith("_")}
+        for n in nodes if n["id"] not in removed
+    ]
+    flows = [
+        f for f in flows + stitched
+        if f["source"] not in removed and f["target"] not in removed
+    ]
+    graph = {
+        "processes": [dict(p) for p in outline["processes"]],
+        "lanes": [dict(lane) for lane in lanes],
+        "nodes": nodes,
+        "flows": flows,
+    }
+    kept = {n["id"] for n in nodes}
+    comments = [c for c in comments if c["id"] in kept]
+    return {"graph": graph, "comments": comments}
+
+
+# ------------------------------------------------------------------------
+#  Model calls
+# ------------------------------------------------------------------------
+class Decomposer:
+    """
+    Runs outline → parallel parts → stitch for one request.
+
+    Parameters
+    ----------
+    client : genai.Client | fake_gemini.FakeClient
+        Calls go through ``client.aio``.
+    router : gemini_router.Router
+        Deadlines, retries and the circuit breaker apply to every call.
+    model : str
+        Model for the outline and the parts.
+    system_prompt : str
+        System instruction of the part calls (the graph-format prompt).
+    trace : metrics.RequestTrace | None
+        Receives tokens, attempts, the ``outline`` / ``parts`` phases and
+        the number of parts.
+    session : str | None
+        Session the calls are queued under when the router has a scheduler.
+    """
+
+    def __init__(self, client, router, model, system_prompt, trace=None, session=None,
+                 max_parts=None, parallel=None):
+        env = os.environ.get
+        self.client = client
+        self.router = router
+        self.model = model
+        self.system_prompt = system_prompt
+        self.trace = trace
+        self.session = session
+        self.max_parts = max_parts or int(env("TACITFLOW_DECOMPOSE_MAX_PARTS", DEFAULT_MAX_PARTS))
+        self.parallel = parallel or int(env("TACITFLOW_DECOMPOSE_PARALLEL", DEFAULT_PARALLEL))
+
+    async def _ask(self, system_instruction, schema, message) -> dict:
+        config = types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            response_mime_type="application/json",
+            response_schema=schema,
+        )
+
+        def make_chat(model):
+            return self.client.aio.chats.create(model=model, config=config, history=[])
+
+        ticket = None
+        if self.router.scheduler is not None:
+            ticket = self.router.scheduler.ticket(
+                self.session, len(system_instruction) + len(message), small=False
+            )
+            await ticket.acquire()
+        text, usage = [], None
+        try:
+            call = self.router.stream(make_chat, self.model, message)
+            async for chunk in call:
+                text.append(chunk.text or "")
+                usage = getattr(chunk, "usage_metadata", None) or usage
+        finally:
+            if ticket is not None:
+                ticket.release(sum(
+                    getattr(usage, attr, None) or 0
+                    for attr in ("prompt_token_count", "candidates_token_count",
+                                 "thoughts_token_count")
+                ))
+        if self.trace is not None:
+            self.trace.usage(usage)
+            self.trace.count("attempts", call.attempts)
+        return json.loads("".join(text))
+
+    async def _part(self, request, outline, part, gate):
+        async with gate:
+            message = _part_message(request, outline, part)
+            for attempt in range(_PART_ATTEMPTS):
+                try:
+                    reply = await self._ask(self.system_prompt, PART_SCHEMA, message)
+                except ValueError as exc:
+                    logger.info("Part %s: unreadable reply (%s)", part["id"], exc)
+                    continue
+                if isinstance(reply, dict) and (reply.get("graph") or {}).get("nodes"):
+                    return reply
+            raise ValueError(f"part {part['id']} returned no usable graph")
+
+    async def run(self, request: str):
+        """
+        Async generator of progress dicts.  ``{"outline": outline}`` once
+        the outline is known, ``{"done": n, "total": m, "reply": partial}``
+        after every finished part (pending parts as placeholders) and
+        finally ``{"reply": reply, "final": True}`` with the stitched reply.
+        Yields nothing if the outline has fewer than two parts – the caller
+        then generates the diagram in one call.
+        """
+        trace = self.trace
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        raw = await self._ask(OUTLINE_PROMPT, OUTLINE_SCHEMA, f"{OUTLINE_HEADER}\n{request}")
+        outline = normalize_outline(raw if isinstance(raw, dict) else {}, self.max_parts)
+        if trace is not None:
+            trace.add("outline", loop.time() - started)
+            trace.set(parts=len(outline["parts"]))
+        if len(outline["parts"]) < 2:
+            return
+        yield {"outline": outline}
+
+        started = loop.time()
+        gate = asyncio.Semaphore(self.parallel)
+        tasks = {
+            asyncio.ensure_future(self._part(request, outline, part, gate)): part["id"]
+            for part in outline["parts"]
+        }
+        replies, failed = {}, []
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pid = tasks[task]
+                    if task.exception() is None:
+                        replies[pid] = task.result()
+                    else:
+                        logger.warning("Part %s failed: %s", pid, task.exception())
+                        failed.append(pid)
+                if pending:
+                    yield {
+                        "done": len(replies) + len(failed), "total": len(tasks),
+                        "reply": stitch(outline, replies),
+                    }
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        if trace is not None:
+            trace.add("parts", loop.time() - started)
+            if failed:
+                trace.count("failed_parts", len(failed))
+
+        part_by_id = {p["id"]: p for p in outline["parts"]}
+        for pid in failed:
+            replies[pid] = _placeholder(part_by_id[pid], "could not be generated")
+            replies[pid]["comments"] = [
+                {"id": "Pending", "text": "Generation failed – ask again for this part"}
+            ]
+        yield {"reply": stitch(outline, replies), "final": True}
@@ -9,10 +9,72 @@ Key additions:
   • Robust parsing of that JSON block; defaults to "[]" if missing.
   • Function signature, imports and client usage remain unchanged so the
     surrounding app code continues to work.
+  • Streaming handler: fences are parsed incrementally so the diagram
+    reaches the canvas as soon as the ```xml block closes.
+  • Follow-up turns send a semantic summary instead of the full XML and
+    receive an ```edits block that is applied locally (bpmn_edits.py).
+  • Optional response cache (response_cache.py) in front of the model call.
+  • Async handlers on ``client.aio`` so waiting on Gemini never pins a thread.
+  • The system prompt is a system instruction (or explicit context cache),
+    so the first turn is a single model call.
+  • Gemini emits semantic BPMN only; DI comes from bpmn_layout.py.
+  • Default output format is a compact JSON graph via structured output
+    (bpmn_graph.py) instead of fenced XML; ``TACITFLOW_OUTPUT_FORMAT=xml``
+    restores the fenced format.
+  • Replies are validated and repaired locally (bpmn_validate.py); only an
+    unusable reply triggers one targeted correction request, and the
+    current diagram is never replaced by the blank template.
+  • Calls go through gemini_router.py: model routing (fast model for small
+    edits), deadlines, jittered retries, optional hedging, circuit breaker.
+  • ``chat_state`` is a session id; the compacted history lives in a
+    session_store.SessionStore, so any worker can continue a session.
+  • No more ``print`` dumps: every request is traced (metrics.py) – phase
+    latencies, tokens, payload bytes and error class go to one structured
+    log line and the ``/metrics`` endpoint.
+  • Very large first diagrams are drawn as an outline plus parts generated
+    in parallel and stitched locally (gemini_decompose.py).
+  • With a quota configured, every call waits for admission by the shared
+    scheduler (gemini_scheduler.py); the queue position is shown in the chat.
+  • Review requests get structural findings computed locally
+    (bpmn_analysis.py): a quick check is answered without a model call, a
+    full review merges them with the model's comments.
+  • Simple edit commands (rename, delete, swap labels, add an end event or
+    a task) are recognised and applied locally (bpmn_commands.py); the
+    request's ``path`` field records which path answered it.
 """
 
-import re
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from google.genai import types
+
+from bpmn_analysis import (
+    analyze_xml,
+    describe_findings,
+    review_kind,
+    summarize_findings,
+    to_overlays,
+)
+from bpmn_commands import local_edits_enabled, plan_command
+from bpmn_edits import EDIT_OPERATIONS, EDIT_SCHEMA, apply_edits
+from bpmn_graph import GRAPH_SCHEMA, graph_to_xml, normalize_graph
+from bpmn_layout import read_layout
+from bpmn_model import read_graph, summarize_graph
+from bpmn_validate import repair_xml
 from frontend import initial_bpmn_xml
+from gemini_decompose import OUTLINE_PROMPT, Decomposer, wants_decomposition
+from gemini_router import DEFAULT_PRO_MODEL, Router
+from metrics import Metrics, RequestTrace
+from response_cache import make_key
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
 
 
 def _build_system_prompt() -> str:
@@ -42,10 +104,10 @@ def _build_system_prompt() -> str:
         • Include an explicit XML declaration line (`<?xml version="1.0" encoding="UTF-8"?>`).  
         • The root element must be `<bpmn:definitions>` with all standard BPMN namespaces.  
         • Every `<bpmn:*>` element needs a unique `id`.  
-        • Add a proper `<bpmndi:BPMNDiagram>` + `<bpmndi:BPMNPlane>` with realistic coordinates so the diagram can render without manual layout.  
+        • Do **NOT** include `<bpmndi:BPMNDiagram>` or any coordinates – the editor lays the diagram out automatically. Output only the semantic elements (`<bpmn:collaboration>`, `<bpmn:process>` and their content).  
         • Keep the diagram **minimal**: use the simplest constructs that convey the logic; avoid superfluous tasks or gateways.  
         • Use explicit start and end events wherever the process begins or ends.  
-        • Use pools/lanes only when roles are relevant; otherwise omit for clarity.  
+        • Use pools/lanes only when roles are relevant; otherwise omit for clarity. Lanes live in a `<bpmn:laneSet>` (with `<bpmn:flowNodeRef>`s) of a process that a `<bpmn:participant>` references.  
         • SequenceFlow labels should be concise and, where obvious, may be omitted.  
         • If the user asks to *modify* an existing diagram, re-use the element IDs that are still valid.
 
@@ -71,13 +133,9 @@ def _build_system_prompt() -> str:
         • **Only create comment objects when the user explicitly asks for comments, feedback, review, critique, or similar. If the user does not request this, return an empty array `[]`.**
 
 
-        ────────────────────────────────────────  MODELLING GUIDELINES  ─────────────────────────────────
-        • Model the *happy path* first; add exceptions only when described.
-        • Prefer XOR gateways for exclusive decisions; use Parallel gateways for splits/joins that are truly concurrent.
-        • Avoid ad-hoc subprocesses unless explicitly requested.
-        • Use clear, action-oriented task names (“Validate Order”, “Send Invoice”).
-        • Do not invent domain steps the user never mentioned.
-        • Keep lane-role names consistent with what the user provides.
+"""
+        + _build_modelling_guidelines()
+        + """
 
         ────────────────────────────────────────  REMEMBER  ─────────────────────────────────────────────
         The only valid response format is:
@@ -91,130 +149,1150 @@ def _build_system_prompt() -> str:
         ```
 
         No extra commentary, no markdown outside the fences."""
+        + _build_edit_protocol()
+    )
+
+
+def _build_modelling_guidelines() -> str:
+    """Modelling rules shared by the XML and the JSON graph formats."""
+    return (
+        """        ────────────────────────────────────────  MODELLING GUIDELINES  ─────────────────────────────────
+        • Model the *happy path* first; add exceptions only when described.
+        • Prefer XOR gateways for exclusive decisions; use Parallel gateways for splits/joins that are truly concurrent.
+        • Avoid ad-hoc subprocesses unless explicitly requested.
+        • Use clear, action-oriented task names (“Validate Order”, “Send Invoice”).
+        • Do not invent domain steps the user never mentioned.
+        • Keep lane-role names consistent with what the user provides."""
+    )
+
+
+def _build_edit_protocol() -> str:
+    """
+    Follow-up turns: the model receives a semantic summary of the diagram
+    and answers with an edit list that is applied locally (bpmn_edits.py).
+    """
+    operations = "\n".join(
+        f"        • {op}: {fields}" for op, fields in EDIT_OPERATIONS.items()
+    )
+    return (
+        """
+
+        ────────────────────────────────────────  FOLLOW-UP TURNS  ──────────────────────────────────────
+        After the first diagram you receive a compact SUMMARY of the current diagram (nodes, flows,
+        lanes – layout is handled by the editor) instead of its XML.  For those turns replace the
+        ```xml``` block with an ```edits``` block holding a JSON array of operations, then the ```json``` block:
+
+        ```edits
+        [
+        {"op": "add_node", "id": "Task_Ship", "type": "task", "name": "Ship goods", "lane": "Lane_1"},
+        {"op": "add_flow", "source": "Task_Pack", "target": "Task_Ship"},
+        {"op": "rename", "id": "Gateway_1", "name": "In stock?"},
+        {"op": "remove", "id": "Task_Old"}
+        ]
+        ```
+
+        Operations (fields marked ? are optional; `type` is a BPMN element name such as task,
+        userTask, exclusiveGateway, endEvent; `event` is e.g. timer, message):
+"""
+        + operations
+        + """
+        • Removing a node also removes its flows.  Re-use the ids from the summary.
+        • Return an empty array `[]` when the diagram itself should not change (e.g. review only).
+        • Only when the user asks to redesign most of the diagram may you return a complete ```xml``` block instead."""
+    )
+
+
+def _build_graph_prompt() -> str:
+    """
+    System prompt for the structured-output format: the reply is one JSON
+    object (schema ``REPLY_SCHEMA``) that bpmn_graph.py serialises to XML,
+    so the model spends no tokens on namespaces, ids of refs or geometry.
+    """
+    operations = "\n".join(
+        f"        • {op}: {fields}" for op, fields in EDIT_OPERATIONS.items()
     )
+    return (
+        """You are a senior BPMN architect.
+        Your task on every request is to **create or modify a BPMN 2.0 diagram** that faithfully represents the business process described by the user.
+
+        ────────────────────────────────────────  OUTPUT FORMAT  ────────────────────────────────────────
+        Reply with ONE JSON object with the fields `graph`, `edits` and `comments`.
+
+        ─ graph ─────────────────────────────────────────────────────────────────────────────────────────
+        The complete diagram as a compact graph; the editor writes the BPMN XML and the layout.
+        • `nodes`: {id, type, name?, lane?, process?, parent?, event?, attachedTo?} – `type` is a BPMN
+          element name (startEvent, task, userTask, exclusiveGateway, endEvent, …), `event` an event
+          definition (timer, message, error, …), `parent` the id of an enclosing subProcess,
+          `attachedTo` the host activity of a boundaryEvent.
+        • `flows`: {id?, source, target, name?, condition?, default?} – flows between different
+          processes become message flows automatically.
+        • `lanes`: {id, name, process?} and `processes`: {id, name?} only when roles or several
+          participants are relevant; a node joins a lane through its `lane` field.
+        • Use short, unique, readable ids (Task_Check, Gateway_Stock).
+
+        ─ comments ──────────────────────────────────────────────────────────────────────────────────────
+        An array of overlay notes {id, text, markerClass, position?}:
+        • **id** - the element id the comment refers to.
+        • **text** - ≤ 60-char note written in second person (“Clarify …”, “Check …”).
+        • **markerClass** - always `"needs-discussion"`.
+        • **position** - optional object with any combination of `top`, `left`, `right`, `bottom` (integers, px offsets).
+        • **Only create comments when the user explicitly asks for comments, feedback, review, critique, or similar; otherwise return `[]`.**
+
+        """
+        + _build_modelling_guidelines()
+        + """
+
+        ────────────────────────────────────────  FOLLOW-UP TURNS  ──────────────────────────────────────
+        After the first diagram you receive a compact SUMMARY of the current diagram instead of the
+        graph.  Then leave out `graph` and return `edits`, a list of operations applied to the diagram
+        (fields marked ? are optional):
+"""
+        + operations
+        + """
+        • Removing a node also removes its flows.  Re-use the ids from the summary.
+        • Return `"edits": []` when the diagram itself should not change (e.g. review only).
+        • Only when the user asks to redesign most of the diagram return a complete `graph` instead."""
+    )
+
 
+_COMMENT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "STRING"},
+        "text": {"type": "STRING"},
+        "markerClass": {"type": "STRING"},
+        "position": {
+            "type": "OBJECT",
+            "properties": {
+                side: {"type": "INTEGER"} for side in ("top", "left", "right", "bottom")
+            },
+        },
+    },
+    "required": ["id", "text"],
+}
 
-def _build_followup_prompt(user_prompt: str, current_xml: str) -> str:
+# Field order matters: the diagram is streamed (and shown) before the comments
+REPLY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "graph": GRAPH_SCHEMA,
+        "edits": EDIT_SCHEMA,
+        "comments": {"type": "ARRAY", "items": _COMMENT_SCHEMA},
+    },
+    "required": ["comments"],
+    "propertyOrdering": ["graph", "edits", "comments"],
+}
+
+# "graph" (structured JSON, default) or "xml" (fenced XML + JSON blocks)
+_OUTPUT_FORMAT = os.environ.get("TACITFLOW_OUTPUT_FORMAT", "graph").lower()
+
+
+def _system_prompt() -> str:
+    """System prompt for the configured output format."""
+    if _OUTPUT_FORMAT == "xml":
+        return _build_system_prompt()
+    return _build_graph_prompt()
+
+
+def _build_followup_prompt(user_prompt: str, current_xml: str, known: str = None) -> str:
     """
-    Prompt used after the first turn.  Gives the model the existing diagram
-    to edit and repeats the overlay instruction.
+    Prompt used after the first turn.  Gives the model a semantic summary
+    of the existing diagram (no DI geometry) and asks for an edit list.
+    Falls back to the full XML if the current diagram cannot be parsed.
+    *known* lists structural findings already shown to the user.
     """
+    try:
+        summary = summarize_graph(read_graph(current_xml))
+    except ET.ParseError:
+        return (
+            "Here is the CURRENT BPMN diagram you produced.  The user now requests changes.\n\n"
+            "```xml\n"
+            f"{current_xml}\n"
+            "```\n\n"
+            f"USER REQUEST:\n{user_prompt}\n\n"
+            + (
+                "Return ONLY the two code-blocks (xml + json) as previously described."
+                if _OUTPUT_FORMAT == "xml" else
+                "Return the JSON object with a complete `graph` and `comments`."
+            )
+        )
+    if _OUTPUT_FORMAT != "xml":
+        closing = "Return the JSON object with `edits` and `comments` as previously described."
+    else:
+        closing = "Return ONLY the two code-blocks (edits + json) as previously described."
     return (
-        "Here is the CURRENT BPMN diagram you produced.  The user now requests changes.\n\n"
-        "```xml\n"
-        f"{current_xml}\n"
-        "```\n\n"
+        "CURRENT DIAGRAM (summary):\n"
+        f"{summary}\n\n"
         f"USER REQUEST:\n{user_prompt}\n\n"
-        "Return ONLY the two code-blocks (xml + json) as previously described."
+        + (
+            "STRUCTURAL FINDINGS ALREADY SHOWN TO THE USER (local check – do not repeat "
+            f"them; comment on what they miss):\n{known}\n\n" if known else ""
+        )
+        + closing
     )
 
 
+def _parse_edit_list(body: str):
+    """The edit list in *body*, or None if it is not a JSON array of ops."""
+    try:
+        edits = json.loads(body or "[]")
+    except ValueError:
+        return None
+    if not isinstance(edits, list):
+        return None
+    if edits and not all(isinstance(e, dict) and "op" in e for e in edits):
+        return None
+    return edits
+
+
 # ------------------------------------------------------------------------
-#  Main handler expected by app.py
+#  Incremental fence extraction for streamed replies
 # ------------------------------------------------------------------------
-def get_bpmn_from_gemini_internal(
-    chat_history,
-    chat_state,
-    current_xml,
-    client,
-    gemini_api_available,
-):
+class _FenceParser:
     """
-    Parameters
-    ----------
-    chat_history : list[list[str|None, str|None]]
-        Gradio's running history [(user, bot), …]
-    chat_state : genai.Chat | None
-        The live Gemini chat session
-    current_xml : str
-        Latest BPMN XML shown in the UI
-    client : genai.Client | None
-        Already-initialised Gemini client (or None if key missing)
-    gemini_api_available : bool
-        Flags whether we can call the API
+    Scans a reply that arrives in chunks and reports every fenced
+    code-block (```lang … ```) as soon as its closing fence is seen.
 
-    Returns
-    -------
-    tuple
-        (chat_history, bpmn_xml, overlay_json, chat_state)
+    Replaces the two full-text ``re.search`` passes so the XML block can be
+    handed to the front-end before the JSON block has even started.
     """
-    user_prompt = chat_history[-1][0]
 
-    # ------------------------------------------------------------------ #
-    # 0.  Safeguard: no API key                                          #
-    # ------------------------------------------------------------------ #
-    if not gemini_api_available or not client:
-        err = "Google Gemini API key not found. Add GEMINI_FREE_API_KEY to .env."
-        chat_history[-1] = (user_prompt, err)
-        return chat_history, initial_bpmn_xml, "[]", None
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0            # where the next scan starts
+        self._lang = None        # language of the open block (None = outside)
+        self._body_start = 0
 
-    # ------------------------------------------------------------------ #
-    # 1.  First-turn vs follow-up logic                                  #
-    # ------------------------------------------------------------------ #
-    is_first_turn = chat_state is None
-    if is_first_turn:
-        system_prompt = _build_system_prompt()
+    @property
+    def text(self) -> str:
+        """Everything received so far."""
+        return self._buf
 
-        # Start a **brand-new** chat session and send the system prompt
-        chat = client.chats.create(model="gemini-2.5-pro")
-        chat.send_message(system_prompt)
+    @property
+    def open_block(self):
+        """``(lang, partial_body)`` of an unterminated block, else None."""
+        if self._lang is None:
+            return None
+        return self._lang, self._buf[self._body_start:].strip()
 
-        # User’s actual request (diagram description)
-        message_to_send = (
-            user_prompt
-            + "\n\nRemember: respond with the two code-blocks (xml + json)."
-        )
+    def feed(self, chunk: str) -> list:
+        """Append *chunk* and return the ``(lang, body)`` blocks it closed."""
+        self._buf += chunk or ""
+        closed = []
+        while True:
+            if self._lang is None:
+                start = self._buf.find("```", self._pos)
+                if start < 0:
+                    # Keep the last two chars: a fence may straddle chunks
+                    self._pos = max(self._pos, len(self._buf) - 2)
+                    return closed
+                lang_start = start + 3
+                lang_end = lang_start
+                while lang_end < len(self._buf) and (
+                    self._buf[lang_end].isalnum() or self._buf[lang_end] in "_-"
+                ):
+                    lang_end += 1
+                if lang_end == len(self._buf):
+                    # Language tag may still be arriving
+                    self._pos = start
+                    return closed
+                self._lang = self._buf[lang_start:lang_end].lower()
+                self._body_start = self._pos = lang_end
+            else:
+                end = self._buf.find("```", self._pos)
+                if end < 0:
+                    self._pos = max(self._pos, len(self._buf) - 2)
+                    return closed
+                closed.append((self._lang, self._buf[self._body_start:end].strip()))
+                self._lang = None
+                self._pos = end + 3
+
+
+class _JsonFieldParser:
+    """
+    Incremental counterpart of :class:`_FenceParser` for structured output.
+
+    The reply is a single JSON object; every top-level field is reported as
+    ``(name, value)`` as soon as its value is complete, so ``graph`` reaches
+    the canvas while ``comments`` are still being generated.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self.complete = False    # top-level object closed
+
+    @property
+    def text(self) -> str:
+        """Everything received so far."""
+        return self._buf
+
+    def feed(self, chunk: str) -> list:
+        """Append *chunk* and return the ``(name, value)`` fields it closed."""
+        self._buf += chunk or ""
+        closed = []
+        buf = self._buf
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(buf[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.complete = True
+                    self._close(buf[self._value_start:i] if self._value_start else "", closed)
+            elif c == ":" and self._depth == 1:
+                self._value_start = i + 1
+            elif c == "," and self._depth == 1:
+                self._close(buf[self._value_start:i] if self._value_start else "", closed)
+        self._pos = len(buf)
+        return closed
+
+    def _close(self, raw, closed):
+        if self._key is not None and raw.strip():
+            try:
+                closed.append((self._key, json.loads(raw)))
+            except ValueError:
+                pass
+        self._key = None
+        self._value_start = None
+
+
+def _build_correction_prompt(problems: list, structured: bool) -> str:
+    """
+    One targeted follow-up when the reply could not be used even after local
+    repair: name the problems instead of asking for a fresh generation.
+    """
+    listed = "\n".join(f"- {p}" for p in problems)
+    fmt = (
+        "the JSON object (graph or edits, plus comments)" if structured
+        else "the two code-blocks (xml or edits, plus json)"
+    )
+    return (
+        "Your previous reply could not be used:\n"
+        f"{listed}\n\n"
+        f"Send the same answer again, complete and well-formed, as {fmt}. "
+        "Keep it as short as possible."
+    )
+
+
+def _progress_message(parser: _FenceParser, xml_ready: bool) -> str:
+    """Interim bot message shown while the reply is still streaming."""
+    size_kb = len(parser.text.encode("utf-8")) / 1024
+    if xml_ready:
+        return f"✅ Diagram ready – collecting review comments… ({size_kb:.1f} kB)"
+    return f"⏳ Drafting the BPMN diagram… ({size_kb:.1f} kB received)"
+
+
+# Minimum seconds between two interim UI updates while streaming
+_PROGRESS_INTERVAL = 0.3
+_LOCAL_NOTES = 100           # most elements annotated by the local structural check
+
+# Model the explicit context cache is created for (routing may pick others)
+_MODEL = os.environ.get("TACITFLOW_PRO_MODEL", DEFAULT_PRO_MODEL)
+# Part of every cache key: editing the prompts invalidates cached replies
+_PROMPT_VERSION = hashlib.sha256(
+    (_OUTPUT_FORMAT + _system_prompt() + OUTLINE_PROMPT).encode("utf-8")
+).hexdigest()[:12]
+
+
+def _content(role: str, text: str) -> dict:
+    """A chat history entry in the google-genai dict form."""
+    return {"role": role, "parts": [{"text": text}]}
+
+
+# ------------------------------------------------------------------------
+#  Session setup: system prompt as system instruction / context cache
+# ------------------------------------------------------------------------
+_CONTEXT_CACHE_TTL = 3600           # seconds an explicit context cache lives
+_context_cache = {"name": None, "expires": 0.0}
+_context_lock = threading.Lock()
+
+
+def _session_config(model: str = _MODEL) -> types.GenerateContentConfig:
+    """
+    Config for a new chat.  The system prompt travels as a system
+    instruction with every request instead of costing an extra round trip,
+    or – once :func:`prewarm_sessions` has created one – as a reference to
+    an explicit context cache so it is not re-billed at full price (only
+    for *model* ``_MODEL``: context caches are per model).  In the graph
+    format the reply is constrained to ``REPLY_SCHEMA``.
+    """
+    structured = {}
+    if _OUTPUT_FORMAT != "xml":
+        structured = {
+            "response_mime_type": "application/json",
+            "response_schema": REPLY_SCHEMA,
+        }
+    with _context_lock:
+        name, expires = _context_cache["name"], _context_cache["expires"]
+    if name and model == _MODEL and expires - time.time() > 60:
+        return types.GenerateContentConfig(cached_content=name, **structured)
+    return types.GenerateContentConfig(system_instruction=_system_prompt(), **structured)
+
+
+def _refresh_context_cache(client):
+    ttl = f"{_CONTEXT_CACHE_TTL}s"
+    with _context_lock:
+        name = _context_cache["name"]
+    if name:
+        client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=ttl))
     else:
-        chat = chat_state
-        message_to_send = _build_followup_prompt(user_prompt, current_xml)
+        name = client.caches.create(
+            model=_MODEL,
+            config=types.CreateCachedContentConfig(
+                system_instruction=_system_prompt(),
+                display_name=f"tacitflow-system-{_PROMPT_VERSION}",
+                ttl=ttl,
+            ),
+        ).name
+    with _context_lock:
+        _context_cache["name"] = name
+        _context_cache["expires"] = time.time() + _CONTEXT_CACHE_TTL
+
+
+def prewarm_sessions(client):
+    """
+    Create the explicit context cache for the system prompt and keep it
+    alive from a daemon thread, so new sessions start without any setup
+    call.  Gemini rejects caches below its minimum token count; in that
+    case sessions keep using the plain system instruction.
+    """
+    def keep_alive():
+        while True:
+            try:
+                _refresh_context_cache(client)
+            except Exception as exc:
+                logger.warning("Context cache unavailable, using system instruction: %s", exc)
+                return
+            time.sleep(_CONTEXT_CACHE_TTL / 2)
+
+    if client is not None:
+        threading.Thread(target=keep_alive, name="context-cache", daemon=True).start()
+
+
+# ------------------------------------------------------------------------
+#  One conversational turn (shared by the sync and async handlers)
+# ------------------------------------------------------------------------
+class _Turn:
+    """
+    Builds the message for one user turn, consults the cache and turns
+    streamed reply text into ``(chat_history, bpmn_xml, overlay_json,
+    session_id)`` UI tuples.  Holds no I/O besides the cache, so the sync
+    and async handlers only differ in how they talk to Gemini (the async one
+    calls the constructor, ``feed``, ``correction_message`` and ``finish``
+    in a worker thread).
+
+    *stored_history* is the session's history from the store, or None for
+    an unknown / expired session.  Parsing, validation and payload sizes
+    are recorded on *trace* (a :class:`metrics.RequestTrace`).
+    """
+
+    def __init__(self, chat_history, session_id, stored_history, current_xml, cache, router,
+                 trace=None):
+        self.chat_history = chat_history
+        self.trace = trace or RequestTrace()
+        self.chat_state = session_id
+        self.stored_history = stored_history
+        self.current_xml = current_xml
+        self.cache = cache
+        self.user_prompt = chat_history[-1][0]
+
+        # -------------------------------------------------------------- #
+        # 1.  First-turn vs follow-up logic                              #
+        # -------------------------------------------------------------- #
+        # An expired session with a diagram on screen continues as a
+        # follow-up: the prompt carries the diagram summary anyway.  A
+        # session undone back to the empty canvas has an empty history
+        self.is_first_turn = not stored_history and (
+            not current_xml or current_xml.strip() == initial_bpmn_xml.strip()
+        )
+        self.structured = _OUTPUT_FORMAT != "xml"
+        # Review requests: structural findings come from a local analysis
+        # (bpmn_analysis.py); a quick check needs no model call at all
+        self.review = None if self.is_first_turn else review_kind(self.user_prompt)
+        self.findings = []
+        if self.review:
+            try:
+                with self.trace.phase("analysis"):
+                    self.findings = analyze_xml(current_xml)
+            except ET.ParseError:
+                self.review = None
+        # Simple edit commands are applied locally (bpmn_commands.py)
+        self.intent = None
+        self.local_xml = None
+        self.local_summary = None
+        if not self.is_first_turn and not self.review and local_edits_enabled():
+            self._plan_local_edit()
+        if self.is_first_turn:
+            # User’s actual request (diagram description)
+            self.message = self.user_prompt + (
+                "\n\nRemember: reply with the JSON object (graph + comments)."
+                if self.structured else
+                "\n\nRemember: respond with the two code-blocks (xml + json)."
+            )
+        else:
+            self.message = _build_followup_prompt(
+                self.user_prompt, current_xml,
+                describe_findings(self.findings) if self.review == "review" else None,
+            )
+        full_diagram = "```xml" in self.message
+        self.model = router.choose(self.user_prompt, self.is_first_turn, full_diagram)
+        # Small edits are admitted before large generations (gemini_scheduler.py)
+        self.small = router.is_small(self.user_prompt, self.is_first_turn, full_diagram)
+        # Very large first diagrams: outline + parts in parallel (gemini_decompose.py)
+        self.decompose = (
+            self.is_first_turn and self.structured and wants_decomposition(self.user_prompt)
+        )
+
+        self.cache_key = None
+        self.cached_text = None
+        if cache is not None and self.review != "quick" and self.local_xml is None:
+            self.cache_key = make_key(
+                self.user_prompt, "" if self.is_first_turn else current_xml,
+                self.model, _PROMPT_VERSION,
+            )
+            self.cached_text = cache.get(self.cache_key)
+        self.trace.set(
+            session=session_id, model=self.model, first_turn=self.is_first_turn,
+            cached=self.cached_text is not None, prompt_chars=len(self.message),
+        )
+        if self.review:
+            self.trace.set(analysis=self.review, findings=len(self.findings))
+        self.trace.set(
+            path=(
+                "local_edit" if self.local_xml is not None else
+                "local_check" if self.review == "quick" else
+                "cache" if self.cached_text is not None else "model"
+            ),
+            intent=self.intent,
+        )
+
+        self.parser = _JsonFieldParser() if self.structured else _FenceParser()
+        self.generated_xml = None
+        self.overlay_json = None
+        self.edit_problems = []
+        self.repairs = []
+        self.invalid = []        # why the reply could not be used
+        self.corrected = False   # correction request already sent
+        self.cacheable = False
+        self.last_update = 0.0
+
+    def history(self) -> list:
+        """Session history the request is sent on (plus a cached reply)."""
+        history = list(self.stored_history or [])
+        if self.cached_text is None:
+            return history
+        return history + [
+            _content("user", self.message), _content("model", self.cached_text)
+        ]
+
+    def _ui(self, bot_msg, xml, overlays, state):
+        self.chat_history[-1] = (self.user_prompt, bot_msg)
+        self.trace.count("updates")
+        self.trace.count(
+            "payload_bytes",
+            len(bot_msg.encode("utf-8")) + len((xml or "").encode("utf-8")) + len(overlays),
+        )
+        return self.chat_history, xml, overlays, state
 
     # ------------------------------------------------------------------ #
-    # 2.  Ask Gemini                                                     #
+    # 2.  Parse fences / JSON fields as the chunks arrive                #
     # ------------------------------------------------------------------ #
-    try:
-        response = chat.send_message(message_to_send)
-        raw_text = response.text or ""
+    def feed(self, text: str) -> list:
+        """Consume one chunk of reply text; return UI updates to yield."""
+        updates = []
+        with self.trace.phase("parse"):
+            completed = self.parser.feed(text)
+        with self.trace.phase("validate"):
+            if self.structured:
+                changes = [self._on_field(name, value) for name, value in completed]
+            else:
+                changes = [self._on_block(lang, body) for lang, body in completed]
+        for changed in changes:
+            if not changed:
+                continue
+            self.last_update = time.monotonic()
+            updates.append(self._ui(
+                _progress_message(self.parser, True), self.generated_xml, "[]",
+                self.chat_state,
+            ))
+
+        now = time.monotonic()
+        if now - self.last_update >= _PROGRESS_INTERVAL:
+            self.last_update = now
+            updates.append(self._ui(
+                _progress_message(self.parser, self.generated_xml is not None),
+                self.generated_xml or self.current_xml or initial_bpmn_xml, "[]",
+                self.chat_state,
+            ))
+        return updates
+
+    def queued(self, position: int) -> tuple:
+        """UI tuple while the request waits for the Gemini quota."""
+        return self._ui(
+            f"⏳ Waiting for Gemini capacity – you are number {position} in the queue…",
+            self.generated_xml or self.current_xml or initial_bpmn_xml, "[]", self.chat_state,
+        )
+
+    def outlined(self, parts: int) -> tuple:
+        """UI tuple once a decomposed request has its outline."""
+        return self._ui(
+            f"🧩 Outline ready – drawing {parts} parts in parallel…",
+            self.current_xml or initial_bpmn_xml, "[]", self.chat_state,
+        )
+
+    def partial(self, reply: dict, done: int, total: int) -> tuple:
+        """UI tuple with the parts finished so far (the others as placeholders)."""
+        with self.trace.phase("validate"):
+            xml = graph_to_xml(normalize_graph(reply["graph"]))
+        return self._ui(
+            f"🧩 Drawing the diagram in {total} parts… ({done}/{total} done)",
+            xml, "[]", self.chat_state,
+        )
 
+    def _plan_local_edit(self):
+        """Recognise a simple command and apply it; leaves ``local_xml`` None otherwise."""
+        try:
+            with self.trace.phase("intent"):
+                planned = plan_command(self.user_prompt, read_graph(self.current_xml))
+            if planned is None:
+                return
+            self.intent, edits, summary = planned
+            with self.trace.phase("validate"):
+                xml, problems = apply_edits(self.current_xml, edits)
+        except ET.ParseError:
+            return
+        if problems:
+            # Not as simple as it looked – the model gets the request
+            logger.info("Local %s edit not applied: %s", self.intent, problems)
+            return
+        self.local_xml = xml
+        self.local_summary = summary
+        self.trace.count("edits", len(edits))
+
+    def local_edit(self) -> tuple:
+        """UI tuple of a command applied locally, without a model call."""
+        self.generated_xml = self.local_xml
+        self.trace.set(model="local", xml_bytes=len(self.local_xml))
+        return self._ui(
+            f"✏️ Done – {self.local_summary} (applied locally, no model call).",
+            self.local_xml, "[]", self.chat_state,
+        )
+
+    def local_review(self) -> tuple:
+        """UI tuple of a quick check, answered from the local findings alone."""
+        overlays = to_overlays(self.findings, _LOCAL_NOTES)
+        bot_msg = "🔎 Structural check (local, no model call):\n" + summarize_findings(self.findings)
+        self.trace.set(model="local", xml_bytes=len(self.current_xml or ""))
+        return self._ui(
+            bot_msg, self.current_xml or initial_bpmn_xml,
+            json.dumps(overlays, ensure_ascii=False), self.chat_state,
+        )
+
+    def exchange(self) -> list:
+        """The turn as history entries (user prompt, bot message) for the session."""
+        return [_content("user", self.user_prompt), _content("model", self.chat_history[-1][1])]
+
+    def _merge_findings(self, overlay_json: str) -> tuple:
+        """
+        The model's comments plus the local findings on the final diagram,
+        as overlay JSON, and those findings.
+        """
+        findings = self.findings
+        with self.trace.phase("analysis"):
+            if self.generated_xml != self.current_xml:
+                try:
+                    findings = analyze_xml(self.generated_xml)
+                except ET.ParseError:
+                    findings = []
+        try:
+            comments = json.loads(overlay_json)
+        except ValueError:
+            comments = []
+        if not isinstance(comments, list):
+            comments = []
+        self.trace.set(findings=len(findings))
+        return json.dumps(comments + to_overlays(findings, _LOCAL_NOTES), ensure_ascii=False), findings
+
+    def _on_block(self, lang, body) -> bool:
+        """Handle one closed fence; True if the diagram changed."""
+        edits = (
+            _parse_edit_list(body)
+            if lang in ("edits", "json") and not self.is_first_turn
+            and self.generated_xml is None else None
+        )
         # -------------------------------------------------------------- #
-        # 2a.  Extract BPMN XML code-block                               #
+        # 2a.  BPMN XML block closed → push it to the canvas              #
         # -------------------------------------------------------------- #
-        xml_match = re.search(r"```xml\s*([\s\S]*?)\s*```", raw_text, re.IGNORECASE)
-        generated_xml = xml_match.group(1).strip() if xml_match else ""
-
-        # Pre-flight: if we somehow got markdown chatter or no defs tag,
-        # fall back to initial template so the front-end never breaks.
-        if not generated_xml or "<bpmn:definitions" not in generated_xml:
-            generated_xml = initial_bpmn_xml
-        # Ensure XML declaration
-        if not generated_xml.lstrip().startswith("<?xml"):
-            generated_xml = (
-                '<?xml version="1.0" encoding="UTF-8"?>\n' + generated_xml
+        if lang == "xml" and self.generated_xml is None:
+            xml, self.repairs, self.invalid = repair_xml(
+                body, None if self.is_first_turn else self.current_xml
             )
+            if xml is None:
+                logger.debug("Unusable XML block: %s", self.invalid)
+                return False
+            self.generated_xml = xml
+            self.cacheable = True
+            return True
+        # -------------------------------------------------------------- #
+        # 2b.  Edit list closed → apply it to the current diagram         #
+        # -------------------------------------------------------------- #
+        if edits is not None and (lang == "edits" or edits):
+            self._apply_edits(edits)
+            return True
+        # -------------------------------------------------------------- #
+        # 2c.  Overlay JSON block closed                                  #
+        # -------------------------------------------------------------- #
+        if lang == "json" and self.overlay_json is None:
+            self.overlay_json = body or "[]"
+        return False
+
+    def _on_field(self, name, value) -> bool:
+        """Handle one completed field of a structured reply (same steps)."""
+        if name == "graph" and isinstance(value, dict) and self.generated_xml is None:
+            previous = None
+            if not self.is_first_turn:
+                try:
+                    previous = read_layout(self.current_xml)
+                except ET.ParseError:
+                    pass
+            graph = normalize_graph(value, self.repairs)
+            if not graph["nodes"]:
+                self.invalid = ["the graph contains no nodes"]
+                return False
+            self.generated_xml = graph_to_xml(graph, previous)
+            self.cacheable = True
+            return True
+        if (
+            name == "edits" and isinstance(value, list)
+            and not self.is_first_turn and self.generated_xml is None
+        ):
+            self._apply_edits([e for e in value if isinstance(e, dict) and "op" in e])
+            return True
+        if name == "comments" and self.overlay_json is None:
+            self.overlay_json = json.dumps(value if isinstance(value, list) else [])
+        return False
+
+    def _apply_edits(self, edits):
+        try:
+            self.generated_xml, self.edit_problems = apply_edits(self.current_xml, edits)
+            self.cacheable = True
+        except ET.ParseError as exc:
+            self.generated_xml = self.current_xml
+            self.edit_problems = [f"current diagram could not be parsed ({exc})"]
+        self.trace.count("edits", len(edits))
+
+    # ------------------------------------------------------------------ #
+    # 3.  Validate the finished reply; one correction request at most    #
+    # ------------------------------------------------------------------ #
+    def correction_message(self):
+        """
+        Called once the reply stream has ended.  Salvages a truncated
+        ```xml block, and if the reply is still unusable returns the
+        correction prompt to send (resetting the parser for its reply).
+        Returns None when the reply is fine or a correction was already
+        tried.
+        """
+        if self.generated_xml is None and not self.structured:
+            open_block = self.parser.open_block
+            if open_block is not None and open_block[0] == "xml":
+                with self.trace.phase("validate"):
+                    self._on_block(*open_block)
+        if self.generated_xml is None and self.structured and not self.parser.complete:
+            self.invalid = self.invalid or ["the JSON reply is incomplete (cut off?)"]
+        if self.generated_xml is None and self.is_first_turn and not self.invalid:
+            self.invalid = ["the reply contains no diagram"]
 
-        print(f"Generated XML:\n{generated_xml}")
+        if self.generated_xml is not None or not self.invalid or self.corrected:
+            return None
+        self.corrected = True
+        message = _build_correction_prompt(self.invalid, self.structured)
+        logger.info("Requesting correction: %s", self.invalid)
+        self.trace.count("corrections")
+        self.invalid = []
+        self.parser = _JsonFieldParser() if self.structured else _FenceParser()
+        return message
+
+    def finish(self) -> tuple:
+        """Final UI tuple once the reply is complete."""
+        unusable = self.generated_xml is None and (self.invalid or self.is_first_turn)
+        if self.generated_xml is None:
+            # Follow-ups may legitimately leave the diagram untouched; never
+            # replace the user's diagram with the blank template
+            self.generated_xml = self.current_xml or initial_bpmn_xml
 
         # -------------------------------------------------------------- #
-        # 2b.  Extract overlay JSON code-block                           #
+        # 2d.  Update chat history (bot message is generic)              #
         # -------------------------------------------------------------- #
-        json_match = re.search(
-            r"```json\s*([\s\S]*?)\s*```", raw_text, re.IGNORECASE
+        bot_msg = "Here is the updated BPMN diagram based on your request:"
+        if unusable:
+            bot_msg = (
+                "⚠️ Gemini's reply could not be turned into a diagram"
+                + (f" ({'; '.join(self.invalid)})" if self.invalid else "")
+                + ". The diagram was left unchanged – please try again."
+            )
+        if self.repairs:
+            bot_msg += "\n\n🔧 Repaired locally:\n" + "\n".join(
+                f"• {r}" for r in self.repairs
+            )
+        if self.edit_problems:
+            bot_msg += "\n\n⚠️ Some changes could not be applied:\n" + "\n".join(
+                f"• {p}" for p in self.edit_problems
+            )
+        overlays = self.overlay_json or "[]"
+        if self.review == "review":
+            overlays, findings = self._merge_findings(overlays)
+            if findings:
+                bot_msg += "\n\n🔎 Structural check (local):\n" + summarize_findings(findings)
+
+        # After a correction round the parser only holds the correction
+        # reply, which would not replay the turn – such turns are not cached
+        if (
+            self.cache_key is not None and self.cached_text is None
+            and self.cacheable and not self.corrected
+        ):
+            self.cache.put(self.cache_key, self.parser.text)
+
+        result = self._ui(bot_msg, self.generated_xml, overlays, self.chat_state)
+        self.trace.set(
+            xml_bytes=len(self.generated_xml), repairs=len(self.repairs),
+            edit_problems=len(self.edit_problems),
+        )
+        self.trace.finish(
+            "unusable" if unusable else "cached" if self.cached_text is not None else "ok"
+        )
+        return result
+
+    def fail(self, exc) -> tuple:
+        """Fail gracefully: keep whatever XML already arrived, drop overlays."""
+        result = self._ui(
+            f"❌ Gemini API error: {exc}",
+            self.generated_xml or self.current_xml or initial_bpmn_xml, "[]",
+            self.chat_state,
         )
-        overlay_json = json_match.group(1).strip() if json_match else "[]"
+        self.trace.finish("error", exc)
+        return result
 
-        print(f"Overlay comments: {overlay_json}")
 
-        # -------------------------------------------------------------- #
-        # 2c.  Update chat history (bot message is generic)              #
-        # -------------------------------------------------------------- #
-        chat_history[-1] = (
-            user_prompt,
-            "Here is the updated BPMN diagram based on your request:",
+def _tokens_used(trace) -> int:
+    """Input + output + thinking tokens recorded on *trace* so far."""
+    return sum(trace.counts.get(f"{kind}_tokens", 0) for kind in ("input", "output", "thinking"))
+
+
+def _no_api_key(chat_history) -> tuple:
+    """Safeguard reply when no API key / client is configured."""
+    err = "Google Gemini API key not found. Add GEMINI_FREE_API_KEY to .env."
+    chat_history[-1] = (chat_history[-1][0], err)
+    return chat_history, initial_bpmn_xml, "[]", None
+
+
+# ------------------------------------------------------------------------
+#  Main handlers expected by app.py
+# ------------------------------------------------------------------------
+_default_router = None
+_default_sessions = None
+_default_metrics = None
+_sync_loop = None
+_sync_lock = threading.Lock()
+
+
+def _router_or_default(router):
+    global _default_router
+    if router is not None:
+        return router
+    with _sync_lock:
+        if _default_router is None:
+            _default_router = Router.from_env()
+        return _default_router
+
+
+def _sessions_or_default(sessions):
+    """*sessions*, or a process-local in-memory store."""
+    global _default_sessions
+    if sessions is not None:
+        return sessions
+    with _sync_lock:
+        if _default_sessions is None:
+            _default_sessions = SessionStore()
+        return _default_sessions
+
+
+def _metrics_or_default(metrics):
+    """*metrics*, or a process-wide registry."""
+    global _default_metrics
+    if metrics is not None:
+        return metrics
+    with _sync_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
+
+
+def _background_loop():
+    """Event loop (in a daemon thread) that runs the async handler for sync callers."""
+    global _sync_loop
+    with _sync_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever, name="gemini-sync", daemon=True
+            ).start()
+        return _sync_loop
+
+
+def stream_bpmn_from_gemini_internal(
+    chat_history,
+    chat_state,
+    current_xml,
+    client,
+    gemini_api_available,
+    cache=None,
+    router=None,
+    sessions=None,
+    metrics=None,
+):
+    """
+    Streaming variant of :func:`get_bpmn_from_gemini_internal`.
+
+    Same parameters; instead of returning once, it is a generator that
+    yields the ``(chat_history, bpmn_xml, overlay_json, chat_state)`` tuple
+    repeatedly: progress messages while Gemini is writing, the diagram as
+    soon as the ```xml block closes, and the final state with overlays.
+
+    If a :class:`response_cache.ResponseCache` is given, a hit replays the
+    stored reply without calling Gemini and appends the turn to the chat
+    history so follow-ups still see it.
+
+    Runs :func:`astream_bpmn_from_gemini_internal` on a background event
+    loop, so deadlines, retries and hedging behave the same for sync callers.
+    """
+    loop = _background_loop()
+    agen = astream_bpmn_from_gemini_internal(
+        chat_history, chat_state, current_xml, client, gemini_api_available, cache, router,
+        sessions, metrics,
+    )
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+async def astream_bpmn_from_gemini_internal(
+    chat_history,
+    chat_state,
+    current_xml,
+    client,
+    gemini_api_available,
+    cache=None,
+    router=None,
+    sessions=None,
+    metrics=None,
+):
+    """
+    Async-generator twin of :func:`stream_bpmn_from_gemini_internal` built on
+    ``client.aio``: waiting for Gemini does not hold a worker thread, so one
+    event loop can serve many sessions at once.
+
+    Every call goes through *router* (a :class:`gemini_router.Router`,
+    default from the environment), which picks the model for the turn and
+    applies deadlines, retries, hedging and the circuit breaker.  The
+    request is traced into *metrics* (see metrics.py).
+
+    Session / cache I/O (SQLite by default) and the CPU-heavy steps –
+    analysis, repair, layout, edits – run in worker threads, so a large
+    diagram never stalls the other sessions on the loop.
+    """
+    if not gemini_api_available or not client:
+        yield _no_api_key(chat_history)
+        return
+
+    router = _router_or_default(router)
+    sessions = _sessions_or_default(sessions)
+    trace = _metrics_or_default(metrics).trace()
+    with trace.phase("session"):
+        stored = await asyncio.to_thread(sessions.history, chat_state)
+        session_id = chat_state if stored is not None else sessions.new_id()
+        turn = await asyncio.to_thread(
+            _Turn, chat_history, session_id, stored, current_xml, cache, router, trace
         )
+        history = turn.history()
+
+    if turn.review == "quick" or turn.local_xml is not None:
+        # Answered locally (structural check or simple edit) – no model call
+        result = turn.local_review() if turn.review == "quick" else turn.local_edit()
+        with trace.phase("save"):
+            await asyncio.to_thread(sessions.save, session_id, history + turn.exchange())
+        trace.finish("local")
+        yield result
+        return
 
-        return chat_history, generated_xml, overlay_json, chat
+    def make_chat(model):
+        # Local – no round trip; a fresh session per attempt so a hedged
+        # or retried request never sees a half-finished reply
+        return client.aio.chats.create(
+            model=model, config=_session_config(model), history=history
+        )
 
+    chat = None
+    try:
+        if turn.cached_text is not None:
+            # Rebuild the session as if Gemini had just answered
+            chat = make_chat(turn.model)
+            for update in await asyncio.to_thread(turn.feed, turn.cached_text):
+                yield update
+            message = await asyncio.to_thread(turn.correction_message)
+        else:
+            message = turn.message
+        if turn.decompose and turn.cached_text is None:
+            reply = None
+            decomposer = Decomposer(
+                client, router, turn.model, _system_prompt(), trace, session=session_id
+            )
+            try:
+                async for event in decomposer.run(turn.user_prompt):
+                    if "outline" in event:
+                        yield turn.outlined(len(event["outline"]["parts"]))
+                    elif event.get("final"):
+                        reply = json.dumps(event["reply"], ensure_ascii=False)
+                    else:
+                        yield await asyncio.to_thread(
+                            turn.partial, event["reply"], event["done"], event["total"]
+                        )
+            except ValueError as exc:
+                # Unreadable outline → one call for the whole diagram
+                logger.info("Decomposition skipped: %s", exc)
+            if reply is not None:
+                trace.set(decomposed=True)
+                for update in await asyncio.to_thread(turn.feed, reply):
+                    yield update
+                # The session continues as if one reply had drawn it all
+                history = history + [_content("user", turn.message), _content("model", reply)]
+                chat = make_chat(turn.model)
+                message = await asyncio.to_thread(turn.correction_message)
+        while message is not None:
+            ticket = None
+            if router.scheduler is not None:
+                ticket = router.scheduler.ticket(
+                    session_id, len(message) + sum(len(str(h)) for h in history), turn.small
+                )
+                with trace.phase("queue"):
+                    async for position in ticket.wait():
+                        yield turn.queued(position)
+            spent = _tokens_used(trace)
+            try:
+                call = router.stream(make_chat, turn.model, message)
+                async for chunk in trace.stream(call):
+                    for update in await asyncio.to_thread(turn.feed, chunk.text or ""):
+                        yield update
+            finally:
+                if ticket is not None:
+                    ticket.release(_tokens_used(trace) - spent)
+            trace.count("attempts", call.attempts)
+            trace.set(model=call.model, hedged=call.hedged)
+            chat = call.chat
+            history = chat.get_history(curated=True)
+            # Unusable reply → one targeted correction request
+            message = await asyncio.to_thread(turn.correction_message)
+        if chat is not None:
+            with trace.phase("save"):
+                await asyncio.to_thread(sessions.save, session_id, chat.get_history(curated=True))
+        yield await asyncio.to_thread(turn.finish)
     except Exception as exc:
-        # Fail gracefully: keep previous XML, drop overlays
-        err_msg = f"❌ Gemini API error: {exc}"
-        chat_history[-1] = (user_prompt, err_msg)
-        return chat_history, current_xml or initial_bpmn_xml, "[]", chat_state
+        yield turn.fail(exc)
+    finally:
+        # Browser went away mid-stream (generator closed / cancelled)
+        trace.finish("cancelled")
+
+
+def get_bpmn_from_gemini_internal(
+    chat_history,
+    chat_state,
+    current_xml,
+    client,
+    gemini_api_available,
+    cache=None,
+    router=None,
+    sessions=None,
+    metrics=None,
+):
+    """
+    Parameters
+    ----------
+    chat_history : list[list[str|None, str|None]]
+        Gradio's running history [(user, bot), …]
+    chat_state : str | None
+        Session id in *sessions* (None before the first turn)
+    current_xml : str
+        Latest BPMN XML shown in the UI
+    client : genai.Client | None
+        Already-initialised Gemini client (or None if key missing)
+    gemini_api_available : bool
+        Flags whether we can call the API
+    cache : response_cache.ResponseCache | None
+        Optional reply cache
+    router : gemini_router.Router | None
+        Model routing and call policy (default: from the environment)
+    sessions : session_store.SessionStore | None
+        Where chat histories live (default: process-local memory)
+    metrics : metrics.Metrics | None
+        Registry the request's trace is reported to (default: process-wide)
+
+    Returns
+    -------
+    tuple
+        (chat_history, bpmn_xml, overlay_json, chat_state)
+    """
+    result = None
+    for result in stream_bpmn_from_gemini_internal(
+        chat_history, chat_state, current_xml, client, gemini_api_available, cache, router,
+        sessions, metrics,
+    ):
+        pass
+    return result
+
+
+async def aget_bpmn_from_gemini_internal(
+    chat_history,
+    chat_state,
+    current_xml,
+    client,
+    gemini_api_available,
+    cache=None,
+    router=None,
+    sessions=None,
+    metrics=None,
+):
+    """Async :func:`get_bpmn_from_gemini_internal` (same parameters and result)."""
+    result = None
+    async for result in astream_bpmn_from_gemini_internal(
+        chat_history, chat_state, current_xml, client, gemini_api_available, cache, router,
+        sessions, metrics,
+    ):
+        pass
+    return result
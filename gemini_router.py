@@ -0,0 +1,420 @@
+"""
+gemini_router.py
+----------------
+Model routing and call policy for Gemini requests.
+
+  • Routing: small follow-up edits go to a fast model, first diagrams and
+    redesigns to the pro model (``Router.choose``).
+  • Deadlines: one for the first chunk, one for the whole reply.
+  • Retries with full-jitter exponential backoff on timeouts, 429 and 5xx.
+  • Optional hedging: if the first chunk has not arrived after the model's
+    observed p95 time-to-first-chunk, a second identical request is fired
+    and whichever answers first wins; the other is cancelled.
+  • A circuit breaker per model: after repeated failures the model is
+    skipped for a cool-down period (falling back to the other model), then
+    a single trial request decides whether it is healthy again.
+  • Optional admission control (gemini_scheduler.py): ``router.scheduler``
+    is consulted by the handlers before each call and paused on a 429.
+
+The router only needs a ``make_chat(model)`` callable returning an object
+with an async ``send_message_stream(message)`` – a ``google.genai``
+``AsyncChat`` or the fake in fake_gemini.py.
+"""
+
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from gemini_scheduler import Scheduler
+
+DEFAULT_PRO_MODEL = "gemini-2.5-pro"
+DEFAULT_FAST_MODEL = "gemini-2.5-flash"
+
+_RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+_REDESIGN_RE = re.compile(
+    r"\b(redesign|restructure|rewrite|from scratch|start over|new process|whole|entire|complete)\b",
+    re.IGNORECASE,
+)
+
+
+class CircuitOpenError(RuntimeError):
+    """Every candidate model is failing; the request was not sent."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """A Gemini call missed its first-chunk or total deadline."""
+
+
+class EmptyReply(ConnectionError):
+    """The reply stream ended before its first chunk (retried like a dropped connection)."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Timeouts, rate limits, server errors and dropped connections."""
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    return getattr(exc, "code", None) in _RETRYABLE_CODES
+
+
+# ------------------------------------------------------------------------
+#  Latency statistics and circuit breaker (shared by all sessions)
+# ------------------------------------------------------------------------
+class LatencyTracker:
+    """Rolling window of time-to-first-chunk per model."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def quantile(self, model: str, q: float = 0.95):
+        """The *q* quantile for *model*, or None until enough samples exist."""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker per model.
+
+    ``closed`` → (``failure_threshold`` failures) → ``open`` for
+    ``reset_after`` seconds → ``half-open``: one trial call is let through;
+    success closes the circuit, failure opens it again.  A trial that ends
+    without either (cancelled, non-retryable error) is given back with
+    :meth:`release_trial`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._failures = {}
+        self._opened_at = {}
+        self._trial = {}             # model → owner of its half-open trial call
+        self._lock = threading.Lock()
+
+    def state(self, model: str) -> str:
+        with self._lock:
+            return self._state(model)
+
+    def _state(self, model):
+        opened = self._opened_at.get(model)
+        if opened is None:
+            return "closed"
+        if time.monotonic() - opened >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self, model: str, owner=None) -> bool:
+        """
+        True if a call to *model* may be sent now.  *owner* identifies the
+        call if it becomes the half-open trial (see :meth:`release_trial`).
+        """
+        with self._lock:
+            state = self._state(model)
+            if state == "closed":
+                return True
+            if state == "half-open" and model not in self._trial:
+                self._trial[model] = owner
+                return True
+            return False
+
+    def release_trial(self, model: str, owner):
+        """
+        End *owner*'s trial of *model* if neither success nor failure was
+        recorded for it; counts as a failure, so the circuit opens again.
+        """
+        with self._lock:
+            if model in self._trial and self._trial[model] is owner:
+                del self._trial[model]
+                self._failures[model] = self._failures.get(model, 0) + 1
+                self._opened_at[model] = time.monotonic()
+
+    def retry_in(self, model: str) -> float:
+        """Seconds until *model* accepts a trial call again."""
+        with self._lock:
+            opened = self._opened_at.get(model)
+        if opened is None:
+            return 0.0
+        return max(0.0, self.reset_after - (time.monotonic() - opened))
+
+    def record_success(self, model: str):
+        with self._lock:
+            self._failures[model] = 0
+            self._opened_at.pop(model, None)
+            self._trial.pop(model, None)
+
+    def record_failure(self, model: str):
+        with self._lock:
+            self._failures[model] = self._failures.get(model, 0) + 1
+            if model in self._trial or self._failures[model] >= self.failure_threshold:
+                self._opened_at[model] = time.monotonic()
+            self._trial.pop(model, None)
+
+
+# ------------------------------------------------------------------------
+#  Router
+# ------------------------------------------------------------------------
+class Router:
+    """
+    Picks a model per turn and runs the call under the policy above.
+
+    Parameters
+    ----------
+    pro_model, fast_model : str
+        Model for generation / for small edits.  Equal names disable routing.
+    fast_max_words : int
+        Follow-up prompts up to this many words (and no redesign wording)
+        go to *fast_model*.
+    first_chunk_timeout, total_timeout : float
+        Deadlines in seconds per attempt.
+    retries : int
+        Extra attempts after a retryable failure.
+    backoff : float
+        Base delay of the full-jitter backoff (``uniform(0, backoff * 2**n)``).
+    hedge : bool
+        Fire a second request when the first one is slower than usual.
+    hedge_after : float
+        Hedging delay until the latency tracker has enough samples.
+    hedge_quantile : float
+        Quantile of time-to-first-chunk used as hedging delay afterwards.
+    scheduler : gemini_scheduler.Scheduler | None
+        Quota / fair-queuing admission shared by all sessions (None = off).
+    """
+
+    def __init__(
+        self,
+        pro_model=DEFAULT_PRO_MODEL,
+        fast_model=DEFAULT_FAST_MODEL,
+        fast_max_words=25,
+        first_chunk_timeout=45.0,
+        total_timeout=240.0,
+        retries=2,
+        backoff=0.5,
+        hedge=False,
+        hedge_after=10.0,
+        hedge_quantile=0.95,
+        breaker=None,
+        latency=None,
+        scheduler=None,
+    ):
+        self.pro_model = pro_model
+        self.fast_model = fast_model
+        self.fast_max_words = fast_max_words
+        self.first_chunk_timeout = first_chunk_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.hedge_quantile = hedge_quantile
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = latency or LatencyTracker()
+        self.scheduler = scheduler
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a router from ``TACITFLOW_*`` environment variables:
+        ``PRO_MODEL``, ``FAST_MODEL``, ``FAST_MAX_WORDS``,
+        ``FIRST_CHUNK_TIMEOUT``, ``TIMEOUT``, ``RETRIES``, ``HEDGE`` (1 = on),
+        ``HEDGE_AFTER``, ``BREAKER_FAILURES`` and ``BREAKER_RESET``; the
+        scheduler from ``TACITFLOW_QUOTA_*`` (see gemini_scheduler.py).
+        """
+        env = os.environ.get
+        return cls(
+            pro_model=env("TACITFLOW_PRO_MODEL", DEFAULT_PRO_MODEL),
+            fast_model=env("TACITFLOW_FAST_MODEL", DEFAULT_FAST_MODEL),
+            fast_max_words=int(env("TACITFLOW_FAST_MAX_WORDS", 25)),
+            first_chunk_timeout=float(env("TACITFLOW_FIRST_CHUNK_TIMEOUT", 45)),
+            total_timeout=float(env("TACITFLOW_TIMEOUT", 240)),
+            retries=int(env("TACITFLOW_RETRIES", 2)),
+            hedge=env("TACITFLOW_HEDGE", "0") == "1",
+            hedge_after=float(env("TACITFLOW_HEDGE_AFTER", 10)),
+            breaker=CircuitBreaker(
+                failure_threshold=int(env("TACITFLOW_BREAKER_FAILURES", 5)),
+                reset_after=float(env("TACITFLOW_BREAKER_RESET", 30)),
+            ),
+            scheduler=Scheduler.from_env(),
+        )
+
+    def choose(self, prompt: str, is_first_turn: bool, full_diagram: bool = False) -> str:
+        """
+        Model for one turn: the pro model for first diagrams, follow-ups
+        that carry the full XML and anything that reads like a redesign;
+        the fast model for short edit requests.
+        """
+        if self.is_small(prompt, is_first_turn, full_diagram):
+            return self.fast_model
+        return self.pro_model
+
+    def is_small(self, prompt: str, is_first_turn: bool, full_diagram: bool = False) -> bool:
+        """A short follow-up edit (fast model, served first by the scheduler)."""
+        if is_first_turn or full_diagram:
+            return False
+        return (
+            len((prompt or "").split()) <= self.fast_max_words
+            and not _REDESIGN_RE.search(prompt or "")
+        )
+
+    def candidates(self, model: str) -> list:
+        """*model* first, then the other tier as fallback."""
+        other = self.fast_model if model == self.pro_model else self.pro_model
+        return [model] if other == model else [model, other]
+
+    def stream(self, make_chat, model: str, message: str) -> "RoutedCall":
+        """Start a routed streaming call; iterate the result with ``async for``."""
+        return RoutedCall(self, make_chat, model, message)
+
+
+class RoutedCall:
+    """
+    One logical request: yields reply text chunks; afterwards ``chat`` is
+    the session whose history contains the reply and ``model`` the model
+    that produced it.
+
+    Retries and hedging only happen before the first chunk is handed out,
+    so callers never see a reply twice; a failure mid-stream is raised.
+    """
+
+    def __init__(self, router: Router, make_chat, model: str, message: str):
+        self.router = router
+        self.make_chat = make_chat
+        self.requested = model
+        self.message = message
+        self.model = None
+        self.chat = None
+        self.attempts = 0
+        self.hedged = False
+        self._tried = set()          # models this call was admitted to
+
+    def _next_model(self) -> str:
+        breaker = self.router.breaker
+        for model in self.router.candidates(self.requested):
+            if breaker.allow(model, owner=self):
+                self._tried.add(model)
+                return model
+        wait = min(breaker.retry_in(m) for m in self.router.candidates(self.requested))
+        raise CircuitOpenError(
+            f"Gemini is failing repeatedly – paused for {wait:.0f} s before trying again"
+        )
+
+    async def _open(self, model):
+        """Send the request; returns ``(chat, iterator, first_chunk)``."""
+        self.attempts += 1
+        chat = self.make_chat(model)
+        started = time.monotonic()
+        stream = await chat.send_message_stream(self.message)
+        iterator = stream.__aiter__()
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            raise EmptyReply(f"{model} returned an empty reply") from None
+        self.router.latency.observe(model, time.monotonic() - started)
+        return chat, iterator, first
+
+    async def _first_chunk(self, model):
+        """First attempt plus (optionally) a hedge; returns the winner."""
+        router = self.router
+        primary = asyncio.ensure_future(self._open(model))
+        tasks = {primary: model}
+        deadline = time.monotonic() + router.first_chunk_timeout
+        try:
+            if router.hedge:
+                delay = router.latency.quantile(model, router.hedge_quantile) or router.hedge_after
+                done, _ = await asyncio.wait(
+                    [primary], timeout=min(delay, router.first_chunk_timeout)
+                )
+                if not done and router.breaker.allow(model):
+                    self.hedged = True
+                    tasks[asyncio.ensure_future(self._open(model))] = model
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    raise DeadlineExceeded(
+                        f"no reply from {model} within {router.first_chunk_timeout:g} s"
+                    )
+                for task in done:
+                    if task.exception() is None:
+                        return tasks[task], task.result()
+                if not pending:
+                    raise next(iter(done)).exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        raise DeadlineExceeded(f"no reply from {model}")
+
+    def __aiter__(self):
+        return self._run()
+
+    async def _run(self):
+        attempts = self._attempts()
+        try:
+            async for chunk in attempts:
+                yield chunk
+        finally:
+            await attempts.aclose()
+            # A half-open trial that ended without a recorded outcome
+            # (non-retryable error, cancellation, closed mid-stream)
+            for model in self._tried:
+                self.router.breaker.release_trial(model, self)
+
+    async def _attempts(self):
+        router = self.router
+        failures = 0
+        while True:
+            model = self._next_model()
+            try:
+                model, (chat, iterator, first) = await self._first_chunk(model)
+                break
+            except Exception as exc:
+                if not is_retryable(exc):
+                    raise
+                if getattr(exc, "code", None) == 429 and router.scheduler is not None:
+                    router.scheduler.throttle()
+                router.breaker.record_failure(model)
+                if failures >= router.retries:
+                    raise
+                failures += 1
+                await asyncio.sleep(random.uniform(0, router.backoff * 2 ** failures))
+
+        self.model, self.chat = model, chat
+        deadline = time.monotonic() + router.total_timeout
+        try:
+            yield first
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(
+                        f"{model} did not finish within {router.total_timeout:g} s"
+                    )
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(
+                        f"{model} did not finish within {router.total_timeout:g} s"
+                    ) from None
+                yield chunk
+        except Exception as exc:
+            if is_retryable(exc):
+                router.breaker.record_failure(model)
+            raise
+        router.breaker.record_success(model)
@@ -0,0 +1,348 @@
+"""
+gemini_scheduler.py
+-------------------
+Admission control in front of Gemini calls, shared by every session of a
+process.
+
+Without it each request is sent the moment it arrives: at the quota limit
+every user gets a 429 at once, and one user firing large generations can
+crowd out everybody else.  The :class:`Scheduler` instead
+
+  • keeps two token buckets sized to the project quota – requests per
+    minute and tokens per minute.  A call is charged an estimate up front
+    (prompt characters / 4 plus the expected reply) and settled against
+    the real ``usage_metadata`` once it completes;
+  • orders waiting calls by weighted fair queuing per session: each call
+    gets a virtual finish tag of ``max(virtual clock, session's last tag)
+    + cost``,
+    so a session with ten calls queued is served after sessions with one;
+  • serves small edits before large generations, with aging so a large
+    generation waits at most ``aging`` seconds behind edits;
+  • optionally caps the calls in flight;
+  • pauses admissions for a moment when Gemini answers 429 anyway;
+  • reports each waiting call's queue position, which the handler shows
+    in the chat.
+
+Configured by ``TACITFLOW_QUOTA_*`` environment variables; with neither a
+quota nor an in-flight cap there is no scheduler and calls go straight out.
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+DEFAULT_QUEUE = 1000             # waiting calls before new ones are refused
+DEFAULT_MAX_WAIT = 300.0         # seconds a call may wait for admission
+DEFAULT_AGING = 30.0             # seconds after which a large call counts as small
+DEFAULT_PAUSE = 10.0             # seconds admissions stop after a 429
+SMALL_REPLY_TOKENS = 1500        # expected reply of an edit
+LARGE_REPLY_TOKENS = 8000        # expected reply of a new diagram
+
+
+class QueueFullError(RuntimeError):
+    """Too many calls are already waiting for the Gemini quota."""
+
+
+class QueueTimeout(TimeoutError):
+    """A call waited longer than ``max_wait`` for admission."""
+
+
+def estimate_tokens(chars: int, small: bool) -> int:
+    """Up-front cost of a call with *chars* characters of prompt and history."""
+    return chars // 4 + (SMALL_REPLY_TOKENS if small else LARGE_REPLY_TOKENS)
+
+
+class TokenBucket:
+    """*per_minute* units, refilled continuously; the level may go negative (debt)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until *amount* (capped at the capacity) is available."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount
+
+    def settle(self, amount: float, now: float):
+        """Give back (positive) or charge (negative) *amount*."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Ticket:
+    """One call's place in the queue; obtained from :meth:`Scheduler.ticket`."""
+
+    def __init__(self, scheduler, session, cost, small, seq, loop):
+        self.scheduler = scheduler
+        self.session = session
+        self.cost = cost
+        self.small = small
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.finish_tag = 0.0
+        self.granted = False
+        self.released = False
+        self._future = loop.create_future()
+
+    async def wait(self):
+        """
+        Async generator: yields the 1-based queue position whenever it
+        changes and returns once the call is admitted.  Raises
+        :class:`QueueTimeout` after ``max_wait`` seconds; leaving early
+        gives the place up.
+        """
+        scheduler = self.scheduler
+        deadline = self.enqueued + scheduler.max_wait
+        last = None
+        try:
+            while not self.granted:
+                position = scheduler.position(self)
+                if position is not None and position != last:
+                    last = position
+                    yield position
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise QueueTimeout(
+                        f"no Gemini capacity within {scheduler.max_wait:g} s – please try again"
+                    )
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._future), min(1.0, remaining))
+                except asyncio.TimeoutError:
+                    scheduler._pump()     # in case the wake-up timer's loop is gone
+        except BaseException:
+            scheduler._withdraw(self)
+            raise
+
+    async def acquire(self):
+        """Wait for admission without position reports."""
+        async for _ in self.wait():
+            pass
+
+    def release(self, used_tokens: int = None):
+        """
+        The call is over; *used_tokens* (input + output, if known) settles
+        the up-front estimate.  Safe to call more than once.
+        """
+        self.scheduler._release(self, used_tokens)
+
+
+class Scheduler:
+    """
+    Parameters
+    ----------
+    rpm, tpm : float | None
+        Requests / tokens per minute of the quota (None = unlimited).
+    max_in_flight : int
+        Calls running at the same time (0 = no cap).
+    max_queue : int
+        Waiting calls before :class:`QueueFullError` is raised.
+    max_wait : float
+        Seconds a call may wait before :class:`QueueTimeout`.
+    aging : float
+        Seconds after which a waiting large call is treated as small.
+    pause : float
+        Seconds admissions stop after :meth:`throttle` (a 429 reply).
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_in_flight=0, max_queue=DEFAULT_QUEUE,
+                 max_wait=DEFAULT_MAX_WAIT, aging=DEFAULT_AGING, pause=DEFAULT_PAUSE):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.aging = aging
+        self.pause = pause
+        self.in_flight = 0
+        self.admitted = 0
+        self.refused = 0
+        self._waiting = []
+        self._session_tags = {}
+        self._vtime = 0.0
+        self._paused_until = 0.0
+        self._timer = False          # a wake-up for the quota refill is scheduled
+        self._order = None           # (computed at, sorted waiting tickets)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        ``TACITFLOW_QUOTA_RPM`` / ``_TPM`` (quota), ``_IN_FLIGHT`` (cap),
+        ``_QUEUE``, ``_MAX_WAIT``, ``_AGING`` and ``_PAUSE``.  Returns None
+        when neither a quota nor a cap is set.
+        """
+        env = os.environ.get
+        rpm = float(env("TACITFLOW_QUOTA_RPM", 0)) or None
+        tpm = float(env("TACITFLOW_QUOTA_TPM", 0)) or None
+        in_flight = int(env("TACITFLOW_QUOTA_IN_FLIGHT", 0))
+        if not (rpm or tpm or in_flight):
+            return None
+        return cls(
+            rpm=rpm, tpm=tpm, max_in_flight=in_flight,
+            max_queue=int(env("TACITFLOW_QUOTA_QUEUE", DEFAULT_QUEUE)),
+            max_wait=float(env("TACITFLOW_QUOTA_MAX_WAIT", DEFAULT_MAX_WAIT)),
+            aging=float(env("TACITFLOW_QUOTA_AGING", DEFAULT_AGING)),
+            pause=float(env("TACITFLOW_QUOTA_PAUSE", DEFAULT_PAUSE)),
+        )
+
+    # ------------------------------------------------------------------
+    #  Public API
+    # ------------------------------------------------------------------
+    def ticket(self, session, prompt_chars: int, small: bool) -> Ticket:
+        """
+        Queue a call of *session* (any hashable; None = anonymous) with
+        *prompt_chars* characters of prompt and history.  Must be called
+        from the event loop that will wait on it.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if len(self._waiting) >= self.max_queue:
+                self.refused += 1
+                raise QueueFullError(
+                    f"{len(self._waiting)} requests are already waiting for Gemini – please try again"
+                )
+            ticket = Ticket(
+                self, session, estimate_tokens(prompt_chars, small), small, next(self._seq), loop
+            )
+            start = max(self._vtime, self._session_tags.get(session, 0.0))
+            ticket.finish_tag = start + ticket.cost
+            self._session_tags[session] = ticket.finish_tag
+            self._waiting.append(ticket)
+            self._order = None
+        self._pump()
+        return ticket
+
+    def throttle(self, seconds: float = None):
+        """Stop admitting calls for *seconds* (default ``pause``) – Gemini said 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + (seconds or self.pause))
+        self._pump()
+
+    def position(self, ticket: Ticket):
+        """1-based place of a waiting *ticket*, None once admitted."""
+        with self._lock:
+            if ticket.granted or ticket not in self._waiting:
+                return None
+            now = time.monotonic()
+            if self._order is None or now - self._order[0] > 1.0:
+                self._order = (now, sorted(self._waiting, key=lambda t: self._key(t, now)))
+            order = self._order[1]
+        try:
+            return order.index(ticket) + 1
+        except ValueError:
+            return len(order) + 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "waiting": len(self._waiting),
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "refused": self.refused,
+                "requests_available": (
+                    round(self.requests.available(now), 1) if self.requests else None
+                ),
+                "tokens_available": round(self.tokens.available(now)) if self.tokens else None,
+                "paused_for": round(max(0.0, self._paused_until - now), 1),
+            }
+
+    # ------------------------------------------------------------------
+    #  Internals
+    # ------------------------------------------------------------------
+    def _key(self, ticket, now):
+        small = ticket.small or now - ticket.enqueued >= self.aging
+        return (0 if small else 1, ticket.finish_tag, ticket.seq)
+
+    def _delay(self, ticket, now) -> float:
+        delay = self._paused_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(ticket.cost, now))
+        return delay
+
+    def _pump(self):
+        """Admit waiting calls while quota and the in-flight cap allow."""
+        granted = []
+        wake = None
+        with self._lock:
+            now = time.monotonic()
+            while self._waiting:
+                if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                    break
+                head = min(self._waiting, key=lambda t: self._key(t, now))
+                delay = self._delay(head, now)
+                if delay > 0:
+                    if not self._timer:
+                        self._timer = True
+                        wake = (delay, head._future.get_loop())
+                    break
+                self._waiting.remove(head)
+                self._order = None
+                if self.requests is not None:
+                    self.requests.take(1, now)
+                if self.tokens is not None:
+                    self.tokens.take(head.cost, now)
+                self._vtime = max(self._vtime, head.finish_tag - head.cost)
+                head.granted = True
+                self.in_flight += 1
+                self.admitted += 1
+                granted.append(head)
+            if len(self._session_tags) > 4 * len(self._waiting) + 1000:
+                self._session_tags = {
+                    s: tag for s, tag in self._session_tags.items() if tag > self._vtime
+                }
+        for ticket in granted:
+            ticket._future.get_loop().call_soon_threadsafe(_resolve, ticket._future)
+        if wake is not None:
+            delay, loop = wake
+            loop.call_soon_threadsafe(loop.call_later, delay + 0.001, self._wake)
+
+    def _wake(self):
+        with self._lock:
+            self._timer = False
+        self._pump()
+
+    def _withdraw(self, ticket):
+        with self._lock:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._order = None
+                return
+        if ticket.granted:
+            self._release(ticket, None)
+
+    def _release(self, ticket, used_tokens):
+        with self._lock:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+            if used_tokens is not None and self.tokens is not None:
+                self.tokens.settle(ticket.cost - used_tokens, time.monotonic())
+        self._pump()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
@@ -0,0 +1,291 @@
+"""
+metrics.py
+----------
+Request instrumentation: per-phase latency, token counts, payload sizes
+and error classes.
+
+The handler used to ``print`` every generated diagram and overlay array –
+synchronous, unstructured and silent about where the time went.  Now each
+request carries a :class:`RequestTrace` that
+
+  • times the phases (``session`` setup, ``ttft`` – time to the first
+    model chunk –, ``model`` time spent waiting on chunks, ``parse`` of
+    fences / JSON fields, ``validate`` – repair, serialisation or edit
+    application –, session ``save``);
+  • counts input / output / cached / thinking tokens from the replies'
+    ``usage_metadata``, bytes pushed to the browser and UI updates;
+  • on completion writes ONE structured (JSON) log line and feeds the
+    aggregates of a :class:`Metrics` registry.
+
+The registry renders Prometheus text (``/metrics``) or a JSON snapshot with
+estimated quantiles (``/metrics.json``); app.py mounts both next to the
+Gradio UI.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("tacitflow.requests")
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+SIZE_BUCKETS = (1e3, 4e3, 16e3, 64e3, 256e3, 1e6, 4e6, 16e6)
+_QUANTILES = (0.5, 0.95, 0.99)
+_USAGE_FIELDS = {
+    "input": "prompt_token_count",
+    "output": "candidates_token_count",
+    "cached": "cached_content_token_count",
+    "thinking": "thoughts_token_count",
+}
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Linear interpolation inside the bucket holding the *q* quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for upper, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return self.buckets[-1] if self.buckets else None
+
+
+# ------------------------------------------------------------------------
+#  Registry
+# ------------------------------------------------------------------------
+class Metrics:
+    """
+    Thread-safe counters and histograms keyed by name and labels.
+
+    Names follow Prometheus conventions (``tacitflow_*_total`` for
+    counters, ``*_seconds`` / ``*_bytes`` for histograms).
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def trace(self, **fields) -> "RequestTrace":
+        """Start instrumenting one request."""
+        return RequestTrace(self, **fields)
+
+    # ------------------------------------------------------------------
+    #  Exposition
+    # ------------------------------------------------------------------
+    def prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        typed = set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (h.buckets, list(h.counts), h.sum, h.count))
+                for key, h in self._histograms.items()
+            )
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_label_text(labels)} {value:g}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for upper, n in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += n
+                le = upper if upper == "+Inf" else f"{upper:g}"
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(labels)} {total:g}")
+            lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Counters plus count / sum / mean / estimated quantiles per histogram."""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = []
+            for (name, labels), h in sorted(self._histograms.items(), key=lambda kv: kv[0]):
+                entry = {
+                    "name": name, "labels": dict(labels), "count": h.count,
+                    "sum": h.sum, "mean": h.sum / h.count if h.count else None,
+                }
+                entry.update({f"p{int(q * 100)}": h.quantile(q) for q in _QUANTILES})
+                histograms.append(entry)
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+
+# ------------------------------------------------------------------------
+#  One request
+# ------------------------------------------------------------------------
+class RequestTrace:
+    """
+    Phase timings and counters of one request.  Phases and counts
+    accumulate (a correction request adds a second ``model`` span);
+    :meth:`finish` reports once.
+
+    *metrics* may be None: the trace then only logs.
+    """
+
+    def __init__(self, metrics=None, **fields):
+        self.metrics = metrics
+        self.fields = dict(fields)
+        self.phases = {}
+        self.counts = {}
+        self.started = time.perf_counter()
+        self.finished = False
+        self.record = None       # the log record, once finished
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def usage(self, usage_metadata):
+        """Add the token counts of one finished model reply."""
+        if usage_metadata is None:
+            return
+        for kind, attr in _USAGE_FIELDS.items():
+            value = getattr(usage_metadata, attr, None)
+            if value:
+                self.count(f"{kind}_tokens", value)
+
+    async def stream(self, chunks):
+        """
+        Re-yield the chunks of a streaming reply, timing the waits
+        (``ttft`` once, ``model`` for every chunk) and taking the token
+        counts from the last chunk that carries ``usage_metadata``.
+        """
+        iterator = chunks.__aiter__()
+        started = time.perf_counter()
+        usage = None
+        first = True
+        while True:
+            waited = time.perf_counter()
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                self.add("model", time.perf_counter() - waited)
+            if first:
+                self.add("ttft", time.perf_counter() - started)
+                first = False
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            yield chunk
+        self.usage(usage)
+
+    def finish(self, outcome: str, error: BaseException = None) -> dict:
+        """Record the request in the registry and log it; returns the log record."""
+        if self.finished:
+            return {}
+        self.finished = True
+        total = time.perf_counter() - self.started
+        error_class = type(error).__name__ if error is not None else None
+        record = {
+            "event": "request",
+            **self.fields,
+            "outcome": outcome,
+            "total_ms": round(total * 1000, 1),
+            **{f"{name}_ms": round(s * 1000, 1) for name, s in self.phases.items()},
+            **self.counts,
+        }
+        if error is not None:
+            record["error"] = error_class
+            record["error_message"] = str(error)[:300]
+        self.record = record
+
+        metrics = self.metrics
+        if metrics is not None:
+            model = self.fields.get("model", "")
+            metrics.inc("tacitflow_requests_total", outcome=outcome, model=model)
+            metrics.observe("tacitflow_request_seconds", total, outcome=outcome)
+            for name, seconds in self.phases.items():
+                metrics.observe("tacitflow_phase_seconds", seconds, phase=name)
+            for kind in _USAGE_FIELDS:
+                if self.counts.get(f"{kind}_tokens"):
+                    metrics.inc(
+                        "tacitflow_tokens_total", self.counts[f"{kind}_tokens"],
+                        kind=kind, model=model,
+                    )
+            if "payload_bytes" in self.counts:
+                metrics.observe(
+                    "tacitflow_payload_bytes", self.counts["payload_bytes"], SIZE_BUCKETS
+                )
+            if self.fields.get("path"):
+                metrics.inc("tacitflow_path_total", path=self.fields["path"])
+            for name in ("attempts", "corrections", "updates"):
+                if self.counts.get(name):
+                    metrics.inc(f"tacitflow_{name}_total", self.counts[name])
+            if error_class is not None:
+                metrics.inc("tacitflow_errors_total", error=error_class)
+
+        level = logging.WARNING if error is not None else logging.INFO
+        logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+        return record
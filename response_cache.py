@@ -0,0 +1,186 @@
+"""
+response_cache.py
+-----------------
+Two-level cache for Gemini replies.
+
+  • Level 1: in-process LRU bounded by entry count and total bytes.
+  • Level 2: optional SQLite file with TTL eviction, shared by every worker
+    that points at the same path and kept across restarts.
+
+Keys combine the normalised user prompt, a hash of the diagram the prompt
+refers to, the model name and the prompt version (see ``make_key``).  The
+cached value is the raw reply text, so a hit goes through exactly the same
+block parsing as a live reply.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 7 * 24 * 3600          # seconds
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+_PURGE_EVERY = 100                   # puts between expired-row sweeps
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    text = re.sub(r"\s+", " ", (prompt or "").strip().lower())
+    return text.rstrip(" .!?")
+
+
+def make_key(prompt: str, current_xml: str, model: str, prompt_version: str) -> str:
+    """SHA-256 cache key for one generation request."""
+    xml_hash = hashlib.sha256((current_xml or "").encode("utf-8")).hexdigest()
+    material = "\x1f".join((normalize_prompt(prompt), xml_hash, model, prompt_version))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU in front of an optional SQLite store.
+
+    Parameters
+    ----------
+    path : str | None
+        SQLite file for the persistent level; ``None`` keeps memory only.
+    ttl : float
+        Seconds an entry stays valid (both levels).
+    max_entries, max_bytes : int
+        Limits of the in-memory level; least recently used entries go first.
+        ``max_entries=0`` disables the memory level (every read goes to
+        SQLite), for values other processes may overwrite.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lru = OrderedDict()        # key -> (expires, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0,
+            "stores": 0, "evictions": 0, "expired": 0,
+        }
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses(expires)")
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a cache from ``TACITFLOW_CACHE_*`` environment variables:
+        ``_PATH`` (SQLite file, empty = memory only), ``_TTL`` (seconds),
+        ``_MAX_ENTRIES`` and ``_MAX_MB``.  ``TACITFLOW_CACHE=0`` disables it.
+        """
+        if os.environ.get("TACITFLOW_CACHE", "1") == "0":
+            return None
+        return cls(
+            path=os.environ.get("TACITFLOW_CACHE_PATH", ".cache/responses.sqlite3") or None,
+            ttl=float(os.environ.get("TACITFLOW_CACHE_TTL", DEFAULT_TTL)),
+            max_entries=int(os.environ.get("TACITFLOW_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(float(os.environ.get("TACITFLOW_CACHE_MAX_MB", 32)) * 1024 * 1024),
+        )
+
+    # ------------------------------------------------------------------
+    #  Public API
+    # ------------------------------------------------------------------
+    def get(self, key: str):
+        """Cached reply text for *key*, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._lru.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return value
+                self._drop(key)
+                self._stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._remember(key, row[0], row[1])
+                    self._stats["disk_hits"] += 1
+                    return row[0]
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._stats["expired"] += 1
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, value: str):
+        """Store *value* under *key* in both levels."""
+        now = time.time()
+        expires = now + self.ttl
+        with self._lock:
+            self._remember(key, value, expires)
+            self._stats["stores"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created, expires)"
+                    " VALUES (?, ?, ?, ?)", (key, value, now, expires),
+                )
+                self._puts += 1
+                if self._puts % _PURGE_EVERY == 0:
+                    self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+
+    def stats(self) -> dict:
+        """Hit/miss counters plus current memory usage."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._lru)
+            stats["bytes"] = self._bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+    # ------------------------------------------------------------------
+    #  LRU bookkeeping (caller holds the lock)
+    # ------------------------------------------------------------------
+    def _remember(self, key, value, expires):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes or not self.max_entries:
+            return
+        self._drop(key)
+        self._lru[key] = (expires, value)
+        self._bytes += size
+        while len(self._lru) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._lru))
+            self._drop(oldest)
+            self._stats["evictions"] += 1
+
+    def _drop(self, key):
+        entry = self._lru.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1].encode("utf-8"))
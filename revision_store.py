@@ -0,0 +1,453 @@
+"""
+revision_store.py
+-----------------
+Per-session diagram history: undo, redo, branches and diffs without a
+model call.
+
+Every turn used to overwrite the diagram; getting an earlier version back
+meant asking Gemini to recreate it.  Now each diagram state a session
+reaches is recorded as a revision:
+
+  • keyed by a hash of its content (XML + overlays) – reaching the same
+    diagram again moves to the existing revision instead of storing a copy;
+  • stored as a line delta against its parent, compressed, with a full
+    keyframe every ``keyframe_every`` revisions (or when the delta would not
+    be smaller), so long sessions stay small and any revision rebuilds from
+    at most that many deltas;
+  • together with the session's compacted chat history at that point
+    (session_store.py), so going back also rewinds what Gemini remembers.
+
+Revisions form a tree: undo moves to the parent, redo retraces the undone
+steps, ``checkout`` jumps to any revision and the next turn branches from
+it.  :func:`diff_graphs` compares two revisions semantically (elements and
+flows added, removed, renamed, moved between lanes).
+
+A session's revisions live in one entry of a response_cache.ResponseCache –
+memory LRU or a SQLite file shared by all workers – with a sliding TTL.
+"""
+
+import base64
+import difflib
+import hashlib
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+import zlib
+
+from bpmn_model import read_graph
+from response_cache import ResponseCache
+
+DEFAULT_TTL = 24 * 3600              # seconds an idle session's history is kept
+DEFAULT_MAX_SESSIONS = 2000          # in-memory LRU size
+DEFAULT_MAX_REVISIONS = 200          # per session; the oldest leaves go first
+KEYFRAME_EVERY = 16                  # longest delta chain
+_DIFF_MAX_LINES = 20000              # larger changed regions are stored whole
+_LABEL_CHARS = 80
+
+
+def content_id(xml: str, overlays: str) -> str:
+    """Content address of a diagram state."""
+    digest = hashlib.sha256((xml or "").encode("utf-8"))
+    digest.update(b"\x1f" + (overlays or "[]").encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+# ------------------------------------------------------------------------
+#  Line deltas
+# ------------------------------------------------------------------------
+def make_delta(base: str, target: str) -> list:
+    """
+    Ops rebuilding *target* from *base*: ``[start, end]`` copies base lines,
+    a string inserts text.  Common prefix / suffix are matched first, so
+    a local edit of a large document costs little.
+    """
+    a = base.splitlines(keepends=True)
+    b = target.splitlines(keepends=True)
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a_mid, b_mid = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+
+    ops = []
+
+    def copy(start, end):
+        if end <= start:
+            return
+        if ops and isinstance(ops[-1], list) and ops[-1][1] == start:
+            ops[-1][1] = end
+        else:
+            ops.append([start, end])
+
+    def insert(lines):
+        if lines:
+            ops.append("".join(lines))
+
+    copy(0, prefix)
+    if len(a_mid) > _DIFF_MAX_LINES or len(b_mid) > _DIFF_MAX_LINES:
+        insert(b_mid)
+    else:
+        matcher = difflib.SequenceMatcher(None, a_mid, b_mid, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                copy(prefix + i1, prefix + i2)
+            else:
+                insert(b_mid[j1:j2])
+    copy(len(a) - suffix, len(a))
+    return ops
+
+
+def apply_delta(base: str, ops: list) -> str:
+    lines = base.splitlines(keepends=True)
+    return "".join(
+        "".join(lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops
+    )
+
+
+def _pack(value) -> str:
+    raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+
+def _unpack(text: str):
+    return json.loads(zlib.decompress(base64.b64decode(text)).decode("utf-8"))
+
+
+# ------------------------------------------------------------------------
+#  Store
+# ------------------------------------------------------------------------
+class Revision:
+    """One diagram state as returned by the store."""
+
+    __slots__ = ("id", "parent", "seq", "label", "created", "xml", "overlays", "session")
+
+    def __init__(self, id, parent, seq, label, created, xml, overlays, session):
+        self.id = id
+        self.parent = parent
+        self.seq = seq
+        self.label = label
+        self.created = created
+        self.xml = xml
+        self.overlays = overlays
+        self.session = session      # compacted chat history (SessionStore.load)
+
+
+class RevisionStore:
+    """
+    Parameters
+    ----------
+    path : str | None
+        SQLite file shared by all workers; ``None`` keeps memory only.
+    ttl : float
+        Seconds an idle session's history survives.
+    max_sessions : int
+        Sessions held in the in-memory LRU when there is no *path*.
+    max_revisions : int
+        Revisions kept per session; beyond that the oldest revision that
+        nothing else depends on is dropped.
+    keyframe_every : int
+        Longest chain of deltas before a full copy is stored.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS,
+                 max_revisions=DEFAULT_MAX_REVISIONS, keyframe_every=KEYFRAME_EVERY,
+                 max_bytes=128 * 1024 * 1024):
+        self.max_revisions = max_revisions
+        self.keyframe_every = keyframe_every
+        self._kv = ResponseCache(
+            path=path, ttl=ttl, max_entries=0 if path else max_sessions, max_bytes=max_bytes
+        )
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a store from ``TACITFLOW_REVISION_*`` environment variables:
+        ``_PATH`` (SQLite file, empty = memory only), ``_TTL`` (seconds) and
+        ``_MAX`` (revisions per session).  ``TACITFLOW_REVISIONS=0``
+        disables the history.
+        """
+        if os.environ.get("TACITFLOW_REVISIONS", "1") == "0":
+            return None
+        return cls(
+            path=os.environ.get("TACITFLOW_REVISION_PATH", ".cache/revisions.sqlite3") or None,
+            ttl=float(os.environ.get("TACITFLOW_REVISION_TTL", DEFAULT_TTL)),
+            max_revisions=int(os.environ.get("TACITFLOW_REVISION_MAX", DEFAULT_MAX_REVISIONS)),
+        )
+
+    # ------------------------------------------------------------------
+    #  Public API
+    # ------------------------------------------------------------------
+    def commit(self, session_id: str, xml: str, overlays: str, label: str = "",
+               session=None) -> Revision:
+        """
+        Record the state a turn produced and make it the head.  An existing
+        revision with the same content becomes the head instead.  *session*
+        is the chat session to restore with it (``SessionStore.load``).
+        """
+        history = self._load(session_id)
+        rid = content_id(xml, overlays)
+        revisions = history["revisions"]
+        if rid in revisions:
+            if history["head"] != rid or session is not None:
+                if history["head"] != rid:
+                    history["redo"] = []
+                history["head"] = rid
+                if session is not None:
+                    revisions[rid]["session"] = _pack(session)
+                self._save(session_id, history)
+            return self._revision(history, rid)
+
+        parent = history["head"] if history["head"] in revisions else None
+        entry = {
+            "parent": parent,
+            "seq": history["seq"] + 1,
+            "label": " ".join((label or "").split())[:_LABEL_CHARS],
+            "created": time.time(),
+            "overlays": overlays or "[]",
+            "session": _pack(session) if session is not None else None,
+        }
+        base = self._xml(history, parent) if parent else None
+        delta = _pack(make_delta(base, xml)) if base is not None else None
+        full = _pack(xml)
+        if (
+            delta is None or len(delta) >= len(full)
+            or revisions[parent].get("depth", 0) + 1 >= self.keyframe_every
+        ):
+            entry["full"] = full
+        else:
+            entry["delta"] = delta
+            entry["depth"] = revisions[parent].get("depth", 0) + 1
+        revisions[rid] = entry
+        history["seq"] += 1
+        history["head"] = rid
+        history["redo"] = []
+        self._prune(history)
+        self._save(session_id, history)
+        return self._revision(history, rid)
+
+    def head(self, session_id: str):
+        history = self._load(session_id)
+        return self._revision(history, history["head"]) if history["head"] else None
+
+    def get(self, session_id: str, rid: str):
+        """Revision *rid* of the session, or None."""
+        history = self._load(session_id)
+        return self._revision(history, rid) if rid in history["revisions"] else None
+
+    def undo(self, session_id: str):
+        """Move the head to its parent; returns the new head or None."""
+        history = self._load(session_id)
+        head = history["revisions"].get(history["head"])
+        if head is None or head["parent"] not in history["revisions"]:
+            return None
+        history["redo"].append(history["head"])
+        history["head"] = head["parent"]
+        self._save(session_id, history)
+        return self._revision(history, history["head"])
+
+    def redo(self, session_id: str):
+        """Retrace the last undo; returns the new head or None."""
+        history = self._load(session_id)
+        while history["redo"]:
+            rid = history["redo"].pop()
+            if rid in history["revisions"]:
+                history["head"] = rid
+                self._save(session_id, history)
+                return self._revision(history, rid)
+        return None
+
+    def checkout(self, session_id: str, rid: str):
+        """Make *rid* the head; the next commit branches from it."""
+        history = self._load(session_id)
+        if rid not in history["revisions"]:
+            return None
+        if history["head"] != rid:
+            history["head"] = rid
+            history["redo"] = []
+            self._save(session_id, history)
+        return self._revision(history, rid)
+
+    def log(self, session_id: str) -> list:
+        """
+        Revisions oldest first as dicts ``{id, parent, seq, label, created,
+        head, branch}``; ``branch`` marks revisions that are not on the
+        head's line of ancestors.
+        """
+        history = self._load(session_id)
+        revisions = history["revisions"]
+        line, rid = set(), history["head"]
+        while rid in revisions and rid not in line:
+            line.add(rid)
+            rid = revisions[rid]["parent"]
+        return [
+            {
+                "id": rid, "parent": entry["parent"], "seq": entry["seq"],
+                "label": entry["label"], "created": entry["created"],
+                "head": rid == history["head"], "branch": rid not in line,
+            }
+            for rid, entry in sorted(revisions.items(), key=lambda item: item[1]["seq"])
+        ]
+
+    def diff(self, session_id: str, old: str, new: str) -> dict:
+        """Semantic difference between two revisions (see :func:`diff_graphs`)."""
+        history = self._load(session_id)
+        return diff_graphs(
+            read_graph(self._xml(history, old)), read_graph(self._xml(history, new))
+        )
+
+    def stats(self) -> dict:
+        return self._kv.stats()
+
+    # ------------------------------------------------------------------
+    #  Internals
+    # ------------------------------------------------------------------
+    def _load(self, session_id):
+        raw = self._kv.get(f"revisions:{session_id}") if session_id else None
+        if raw is None:
+            return {"head": None, "seq": 0, "redo": [], "revisions": {}}
+        return json.loads(raw)
+
+    def _save(self, session_id, history):
+        if session_id:
+            self._kv.put(f"revisions:{session_id}", json.dumps(history, separators=(",", ":")))
+
+    def _xml(self, history, rid) -> str:
+        """Rebuild the XML of *rid* from its keyframe and the deltas after it."""
+        revisions = history["revisions"]
+        chain = []
+        while "full" not in revisions[rid]:
+            chain.append(revisions[rid]["delta"])
+            rid = revisions[rid]["parent"]
+        xml = _unpack(revisions[rid]["full"])
+        for delta in reversed(chain):
+            xml = apply_delta(xml, _unpack(delta))
+        return xml
+
+    def _revision(self, history, rid) -> Revision:
+        entry = history["revisions"][rid]
+        return Revision(
+            rid, entry["parent"], entry["seq"], entry["label"], entry["created"],
+            self._xml(history, rid), entry["overlays"],
+            _unpack(entry["session"]) if entry.get("session") else None,
+        )
+
+    def _prune(self, history):
+        """Drop the oldest leaf revisions beyond ``max_revisions``."""
+        revisions = history["revisions"]
+        while len(revisions) > self.max_revisions:
+            parents = {entry["parent"] for entry in revisions.values()}
+            protected = parents | {history["head"]} | set(history["redo"])
+            leaves = [rid for rid in revisions if rid not in protected]
+            if not leaves:
+                # A long straight line: re-root it one revision later
+                root = min(
+                    (rid for rid, e in revisions.items() if e["parent"] not in revisions),
+                    key=lambda rid: revisions[rid]["seq"],
+                )
+                children = [rid for rid, e in revisions.items() if e["parent"] == root]
+                if not children or root == history["head"]:
+                    return
+                for child in children:
+                    entry = revisions[child]
+                    if "full" not in entry:
+                        entry["full"] = _pack(self._xml(history, child))
+                        entry.pop("delta", None)
+                        entry["depth"] = 0
+                    entry["parent"] = None
+                del revisions[root]
+                continue
+            del revisions[min(leaves, key=lambda rid: revisions[rid]["seq"])]
+
+
+# ------------------------------------------------------------------------
+#  Semantic diff
+# ------------------------------------------------------------------------
+def diff_graphs(old: dict, new: dict) -> dict:
+    """
+    Differences between two ``bpmn_model.read_graph`` graphs: nodes and
+    flows added / removed, nodes renamed, retyped or moved to another lane,
+    and flows whose label changed.
+    """
+    def flow_key(flow):
+        return flow.get("id") or f"{flow.get('source')}->{flow.get('target')}"
+
+    old_nodes = {n["id"]: n for n in old["nodes"] if n.get("id")}
+    new_nodes = {n["id"]: n for n in new["nodes"] if n.get("id")}
+    old_flows = {flow_key(f): f for f in old["flows"]}
+    new_flows = {flow_key(f): f for f in new["flows"]}
+    lane_names = {lane["id"]: lane.get("name") or lane["id"] for lane in old["lanes"] + new["lanes"]}
+
+    changed = []
+    for node_id in old_nodes.keys() & new_nodes.keys():
+        a, b = old_nodes[node_id], new_nodes[node_id]
+        changes = {}
+        for field in ("name", "type", "lane"):
+            if a.get(field) != b.get(field):
+                changes[field] = [a.get(field), b.get(field)]
+        if changes:
+            changed.append({"id": node_id, **changes})
+    relabelled = [
+        {"id": fid, "name": [old_flows[fid].get("name"), new_flows[fid].get("name")]}
+        for fid in old_flows.keys() & new_flows.keys()
+        if old_flows[fid].get("name") != new_flows[fid].get("name")
+    ]
+    rewired = [
+        fid for fid in old_flows.keys() & new_flows.keys()
+        if (old_flows[fid].get("source"), old_flows[fid].get("target"))
+        != (new_flows[fid].get("source"), new_flows[fid].get("target"))
+    ]
+    return {
+        "added": [new_nodes[i] for i in new_nodes.keys() - old_nodes.keys()],
+        "removed": [old_nodes[i] for i in old_nodes.keys() - new_nodes.keys()],
+        "changed": changed,
+        "flows_added": [new_flows[i] for i in new_flows.keys() - old_flows.keys()],
+        "flows_removed": [old_flows[i] for i in old_flows.keys() - new_flows.keys()],
+        "flows_changed": relabelled + [{"id": fid, "rewired": True} for fid in rewired],
+        "lane_names": lane_names,
+    }
+
+
+def describe_diff(diff: dict, limit: int = 30) -> str:
+    """Markdown bullet list of a :func:`diff_graphs` result."""
+    lanes = diff.get("lane_names", {})
+
+    def label(node):
+        return f"**{node.get('name') or node['id']}** ({node['type']})"
+
+    lines = [f"• added {label(n)}" for n in diff["added"]]
+    lines += [f"• removed {label(n)}" for n in diff["removed"]]
+    for change in diff["changed"]:
+        if "name" in change:
+            lines.append(f"• renamed “{change['name'][0] or change['id']}” → “{change['name'][1]}”")
+        if "type" in change:
+            lines.append(f"• {change['id']}: {change['type'][0]} → {change['type'][1]}")
+        if "lane" in change:
+            old, new = (lanes.get(l, l or "no lane") for l in change["lane"])
+            lines.append(f"• {change['id']} moved from lane {old} to {new}")
+    for flow in diff["flows_added"]:
+        lines.append(f"• new flow {flow['source']} → {flow['target']}"
+                     + (f" “{flow['name']}”" if flow.get("name") else ""))
+    for flow in diff["flows_removed"]:
+        lines.append(f"• removed flow {flow['source']} → {flow['target']}")
+    for flow in diff["flows_changed"]:
+        if flow.get("rewired"):
+            lines.append(f"• flow {flow['id']} reconnected")
+        else:
+            lines.append(f"• flow {flow['id']} label “{flow['name'][0] or ''}” → “{flow['name'][1] or ''}”")
+    if not lines:
+        return "No differences in the process (layout or comments only)."
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"• … and {len(lines) - limit} more"]
+    return "\n".join(lines)
+
+
+def safe_diff(store: RevisionStore, session_id: str, old: str, new: str) -> str:
+    """:func:`describe_diff` of two revisions, or the reason it failed."""
+    try:
+        return describe_diff(store.diff(session_id, old, new))
+    except (KeyError, ET.ParseError) as exc:
+        return f"Could not compare the revisions ({exc})."
@@ -0,0 +1,185 @@
+"""
+session_store.py
+----------------
+Chat sessions kept outside the Gradio process state.
+
+``gr.State`` used to hold a live genai ``Chat`` per browser tab: the whole
+transcript plus SDK objects, never evicted and only usable by the worker
+that created it.  Now the browser only holds a session id; the history
+lives in a :class:`SessionStore`:
+
+  • in memory (LRU by count and bytes) or in a SQLite file, so any
+    worker pointed at the same file can continue any session;
+  • sliding TTL – every turn re-saves the session;
+  • a history window: only the last ``history_turns`` exchanges are kept
+    verbatim.  Older turns are compacted locally to a list of the user's
+    earlier requests (the current diagram itself travels with every
+    follow-up prompt, so old model replies carry no extra information).
+    Inside the window stale diagram summaries are dropped and every model
+    reply but the last is replaced by a short stub.
+
+A stored session is the last model reply plus a few KB of JSON,
+regardless of conversation length.
+"""
+
+import json
+import os
+import uuid
+
+from response_cache import ResponseCache
+
+DEFAULT_TTL = 24 * 3600              # seconds an idle session is kept
+DEFAULT_MAX_SESSIONS = 2000          # in-memory LRU size
+DEFAULT_HISTORY_TURNS = 4            # exchanges kept verbatim
+_MAX_EARLIER = 20                    # compacted requests kept
+_EARLIER_CHARS = 200                 # characters kept per compacted request
+
+_SUMMARY_HEADER = "CURRENT DIAGRAM (summary):\n"
+_REQUEST_HEADER = "USER REQUEST:\n"
+_REMEMBER = "\n\nRemember:"
+_OMITTED_REPLY = "(diagram reply omitted – the current diagram is in the prompt)"
+
+
+def _text(content) -> str:
+    """Concatenated text parts of a genai ``Content`` or its dict form."""
+    parts = content.get("parts") if isinstance(content, dict) else content.parts
+    texts = []
+    for part in parts or []:
+        text = part.get("text") if isinstance(part, dict) else part.text
+        thought = part.get("thought") if isinstance(part, dict) else getattr(part, "thought", None)
+        if text and not thought:
+            texts.append(text)
+    return "".join(texts)
+
+
+def _role(content) -> str:
+    return content.get("role") if isinstance(content, dict) else content.role
+
+
+def _entry(role: str, text: str) -> dict:
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def user_request(message: str) -> str:
+    """The user's own words inside a first-turn or follow-up prompt."""
+    if _REQUEST_HEADER in message:
+        message = message.split(_REQUEST_HEADER, 1)[1].split("\n\n", 1)[0]
+    return message.split(_REMEMBER, 1)[0].strip()
+
+
+def _drop_summary(message: str) -> str:
+    """Replace the (stale) diagram summary of an older follow-up prompt."""
+    if not message.startswith(_SUMMARY_HEADER) or _REQUEST_HEADER not in message:
+        return message
+    return "(diagram summary of that turn omitted)\n\n" + message[message.index(_REQUEST_HEADER):]
+
+
+class SessionStore:
+    """
+    Parameters
+    ----------
+    path : str | None
+        SQLite file shared by all workers; ``None`` keeps sessions in
+        process memory only.
+    ttl : float
+        Seconds an idle session survives.
+    max_sessions : int
+        Sessions held in the in-memory LRU when there is no *path*.  With a
+        shared SQLite file every read goes to the file (another worker may
+        have advanced the session); the file is bounded by the TTL.
+    history_turns : int
+        User/model exchanges kept verbatim; older ones are compacted.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS,
+                 history_turns=DEFAULT_HISTORY_TURNS, max_bytes=64 * 1024 * 1024):
+        self.history_turns = history_turns
+        self._kv = ResponseCache(
+            path=path, ttl=ttl, max_entries=0 if path else max_sessions, max_bytes=max_bytes
+        )
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a store from ``TACITFLOW_SESSION_*`` environment variables:
+        ``_PATH`` (SQLite file, empty = memory only), ``_TTL`` (seconds),
+        ``_MAX`` (in-memory sessions) and ``TACITFLOW_HISTORY_TURNS``.
+        """
+        return cls(
+            path=os.environ.get("TACITFLOW_SESSION_PATH", ".cache/sessions.sqlite3") or None,
+            ttl=float(os.environ.get("TACITFLOW_SESSION_TTL", DEFAULT_TTL)),
+            max_sessions=int(os.environ.get("TACITFLOW_SESSION_MAX", DEFAULT_MAX_SESSIONS)),
+            history_turns=int(os.environ.get("TACITFLOW_HISTORY_TURNS", DEFAULT_HISTORY_TURNS)),
+        )
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    # ------------------------------------------------------------------
+    #  Public API
+    # ------------------------------------------------------------------
+    def load(self, session_id: str):
+        """``{"earlier": [...], "history": [...]}`` or None if unknown / expired."""
+        if not session_id:
+            return None
+        raw = self._kv.get(session_id)
+        return json.loads(raw) if raw is not None else None
+
+    def history(self, session_id: str):
+        """
+        Chat history to start a request with, compacted turns first; None
+        if the session is unknown or expired.
+        """
+        session = self.load(session_id)
+        if session is None:
+            return None
+        prefix = []
+        if session["earlier"]:
+            prefix = [
+                _entry("user", "EARLIER REQUESTS IN THIS CONVERSATION (oldest first):\n"
+                       + "\n".join(f"- {r}" for r in session["earlier"])),
+                _entry("model", "Noted."),
+            ]
+        return prefix + session["history"]
+
+    def save(self, session_id: str, history: list):
+        """
+        Store *history* (genai ``Content`` objects or dicts, as returned by
+        ``chat.get_history(curated=True)``), compacted to the window.
+        """
+        self._kv.put(session_id, json.dumps(self.compact(history), ensure_ascii=False))
+
+    def restore(self, session_id: str, session: dict):
+        """Put back a session as :meth:`load` returned it (undo / checkout)."""
+        self._kv.put(session_id, json.dumps(session, ensure_ascii=False))
+
+    def compact(self, history: list) -> dict:
+        """Split *history* into compacted earlier requests and a verbatim window."""
+        earlier, turns = [], []
+        for content in history:
+            role, text = _role(content), _text(content)
+            if not text:
+                continue
+            if role == "user" and text.startswith("EARLIER REQUESTS IN THIS CONVERSATION"):
+                earlier += [line[2:] for line in text.splitlines()[1:] if line.startswith("- ")]
+            elif role == "user":
+                turns.append([text, None])
+            elif turns and turns[-1][1] is None:
+                turns[-1][1] = text
+
+        cut = max(0, len(turns) - self.history_turns)
+        earlier += [user_request(user)[:_EARLIER_CHARS] for user, _ in turns[:cut]]
+        window = turns[cut:]
+
+        entries = []
+        for index, (user, model) in enumerate(window):
+            if index < len(window) - 1:
+                user = _drop_summary(user)
+                model = model and _OMITTED_REPLY
+            entries.append(_entry("user", user))
+            entries.append(_entry("model", model or "(no reply)"))
+        return {"earlier": earlier[-_MAX_EARLIER:], "history": entries}
+
+    def stats(self) -> dict:
+        return self._kv.stats()
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from batch import BatchRunner, load_items
+from gemini_router import Router
+
+
+@pytest.mark.parametrize("record", [{"prompt": 42}, {"prompt": ["a", "b"]}, {"prompt": " "}, 7])
+def test_item_without_a_text_prompt_is_rejected(tmp_path, record):
+    source = tmp_path / "items.jsonl"
+    source.write_text(json.dumps({"prompt": "Order process"}) + "\n" + json.dumps(record) + "\n")
+
+    with pytest.raises(ValueError, match=r"items\.jsonl:2:"):
+        load_items(str(source))
+
+
+def test_rate_limits_leave_the_callers_router_alone(tmp_path):
+    router = Router()
+    runner = BatchRunner(None, str(tmp_path), rpm=60, tpm=100000, router=router)
+
+    assert router.scheduler is None
+    assert runner.router is not router and runner.router.scheduler is not None
+    assert runner.router.breaker is router.breaker
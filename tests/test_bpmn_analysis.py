@@ -0,0 +1,21 @@
+import pytest
+
+from bpmn_analysis import review_kind
+
+
+@pytest.mark.parametrize("prompt, kind", [
+    ("Add comments about bottlenecks", "review"),
+    ("insert some review notes", "review"),
+    ("Review the diagram", "review"),
+    ("check the diagram", "quick"),
+    ("Quick check of my diagram, please", "quick"),
+    ("Check the process for GDPR compliance issues", "review"),
+    ("Check my diagram: is the credit limit step in the right lane?", "review"),
+    ("Make comments on the diagram", "review"),
+    ("Make the approval a user task", None),
+    ("Add a task Ship after Pack", None),
+    ("add a review step after Check stock", None),
+])
+def test_review_kind(prompt, kind, monkeypatch):
+    monkeypatch.delenv("TACITFLOW_ANALYSIS", raising=False)
+    assert review_kind(prompt) == kind
@@ -0,0 +1,48 @@
+import pytest
+
+from bpmn_commands import plan_command
+from bpmn_graph import graph_to_xml, normalize_graph
+from bpmn_model import read_graph
+
+_GRAPH = read_graph(graph_to_xml(normalize_graph({
+    "nodes": [
+        {"id": "Start_1", "type": "startEvent"},
+        {"id": "Task_Check", "type": "task", "name": "Check stock"},
+        {"id": "Task_Approve", "type": "userTask", "name": "Approve order"},
+        {"id": "Task_Ship", "type": "task", "name": "Ship goods"},
+        {"id": "End_1", "type": "endEvent"},
+    ],
+    "flows": [
+        {"source": "Start_1", "target": "Task_Check"},
+        {"source": "Task_Check", "target": "Task_Approve"},
+        {"source": "Task_Approve", "target": "Task_Ship"},
+        {"source": "Task_Ship", "target": "End_1"},
+    ],
+})))
+
+
+def test_rename():
+    intent, edits, _ = plan_command("Rename Check stock to Verify stock", _GRAPH)
+    assert intent == "rename"
+    assert edits == [{"op": "rename", "id": "Task_Check", "name": "Verify stock"}]
+
+
+def test_quoted_name_is_taken_as_typed():
+    _, edits, _ = plan_command("rename Ship goods to 'Pick and pack'", _GRAPH)
+    assert edits[0]["name"] == "Pick and pack"
+
+
+@pytest.mark.parametrize("prompt", [
+    "Rename Check stock to Verify stock and then delete Ship goods",
+    "Rename Check stock to Verify stock, then delete Ship goods",
+    "Rename Check stock to Verify stock; remove Ship goods",
+    "Rename the approval step to something clearer",
+    "Rename Approve order to a better name",
+    "rename Check stock to more descriptive wording",
+    "rename Check stock to check whether every ordered item is on the shelf today",
+    "add a task called Pack and label after Check stock",
+    "insert a task something nicer before Ship goods",
+    "add an end event called Done. Then delete Ship goods after Ship goods",
+])
+def test_compound_or_vague_commands_go_to_the_model(prompt):
+    assert plan_command(prompt, _GRAPH) is None
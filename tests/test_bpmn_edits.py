@@ -0,0 +1,40 @@
+from bpmn_edits import apply_edits
+from bpmn_graph import graph_to_xml, normalize_graph
+
+_XML = graph_to_xml(normalize_graph({
+    "nodes": [{"id": "Start_1", "type": "startEvent"}, {"id": "Task_1", "type": "task"}],
+    "flows": [{"source": "Start_1", "target": "Task_1"}],
+}))
+
+
+def test_unknown_event_kind_is_not_interpolated():
+    xml, problems = apply_edits(_XML, [
+        {"op": "add_node", "id": "End_1", "type": "endEvent", "event": "bogus"},
+        {"op": "set_type", "id": "Start_1", "type": "startEvent", "event": "x y"},
+    ])
+
+    assert 'id="End_1"' in xml
+    assert "bogusEventDefinition" not in xml
+    assert len(problems) == 2 and all("unknown event kind" in p for p in problems)
+
+
+def test_known_event_kind_is_added():
+    xml, problems = apply_edits(_XML, [
+        {"op": "set_type", "id": "Start_1", "type": "startEvent", "event": "timer"},
+    ])
+
+    assert problems == []
+    assert "timerEventDefinition" in xml
+
+
+def test_malformed_fields_are_reported_not_raised():
+    xml, problems = apply_edits(_XML, [
+        {"op": "rename", "id": 5, "name": ["x"]},
+        {"op": "remove", "id": {}},
+        {"op": ["rename"], "id": "Task_1"},
+        {"op": "rename", "id": "Task_1", "name": "Pack goods", "note": {"ignored": True}},
+    ])
+
+    assert len(problems) == 3
+    assert all("must be text" in p for p in problems)
+    assert 'name="Pack goods"' in xml
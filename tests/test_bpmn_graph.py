@@ -0,0 +1,34 @@
+from bpmn_graph import graph_to_xml, normalize_graph
+
+
+def test_flow_ids_never_collide_with_nodes_or_each_other():
+    repairs = []
+    graph = normalize_graph({
+        "nodes": [
+            {"id": "Flow_1", "type": "task"},
+            {"id": "Task_2", "type": "task"},
+            {"id": "Task_3", "type": "task"},
+        ],
+        "flows": [
+            {"source": "Flow_1", "target": "Task_2"},
+            {"id": "Flow_2", "source": "Task_2", "target": "Task_3"},
+            {"id": "Task_3", "source": "Flow_1", "target": "Task_3"},
+        ],
+    }, repairs)
+
+    ids = [n["id"] for n in graph["nodes"]] + [f["id"] for f in graph["flows"]]
+    assert len(ids) == len(set(ids))
+    assert graph["flows"][1]["id"] == "Flow_2"
+    assert "flow id 'Task_3' is already used, renamed it" in repairs
+
+
+def test_unknown_event_kind_is_dropped():
+    repairs = []
+    graph = normalize_graph({
+        "nodes": [{"id": "Start_1", "type": "startEvent", "event": 'timer x="1"><bpmn:foo'}],
+        "flows": [],
+    }, repairs)
+
+    assert "event" not in graph["nodes"][0]
+    assert any("unknown event kind" in r for r in repairs)
+    assert "foo" not in graph_to_xml(graph)
@@ -0,0 +1,28 @@
+from bpmn_validate import repair_xml
+
+_DEFINITIONS = (
+    '<bpmn:definitions xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL" '
+    'id="Definitions_1" targetNamespace="http://bpmn.io/schema/bpmn">{}</bpmn:definitions>'
+)
+
+
+def test_message_flow_from_dropped_boundary_event_is_removed():
+    xml = _DEFINITIONS.format(
+        '<bpmn:collaboration id="Collaboration_1">'
+        '<bpmn:participant id="Pool_A" processRef="Process_A"/>'
+        '<bpmn:participant id="Pool_B" processRef="Process_B"/>'
+        '<bpmn:messageFlow id="M1" sourceRef="B1" targetRef="Task_B"/>'
+        '</bpmn:collaboration>'
+        '<bpmn:process id="Process_A">'
+        '<bpmn:task id="Task_A"/>'
+        '<bpmn:boundaryEvent id="B1" attachedToRef="Missing"/>'
+        '</bpmn:process>'
+        '<bpmn:process id="Process_B"><bpmn:task id="Task_B"/></bpmn:process>'
+    )
+    fixed, repairs, problems = repair_xml(xml)
+
+    assert problems == []
+    assert "boundaryEvent 'B1' is attached to missing 'Missing'" in repairs
+    assert any("messageFlow 'M1' has dangling sourceRef 'B1'" in r for r in repairs)
+    assert 'id="B1"' not in fixed
+    assert 'id="M1"' not in fixed
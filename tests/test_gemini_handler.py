@@ -0,0 +1,48 @@
+import json
+
+from gemini_handler import _Turn
+from gemini_router import Router
+
+
+class _DictCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        self.entries[key] = value
+
+
+_GRAPH = {
+    "nodes": [{"id": "Start_1", "type": "startEvent"}, {"id": "End_1", "type": "endEvent"}],
+    "flows": [{"source": "Start_1", "target": "End_1"}],
+}
+
+
+def _turn(cache):
+    return _Turn([["Draw an order process", None]], "s1", None, None, cache, Router())
+
+
+def test_reply_is_cached():
+    cache = _DictCache()
+    turn = _turn(cache)
+    turn.feed(json.dumps({"graph": _GRAPH, "comments": []}))
+    assert turn.correction_message() is None
+    turn.finish()
+
+    assert list(cache.entries.values()) == [json.dumps({"graph": _GRAPH, "comments": []})]
+
+
+def test_turn_that_needed_a_correction_is_not_cached():
+    cache = _DictCache()
+    turn = _turn(cache)
+    turn.feed(json.dumps({"graph": {"nodes": [], "flows": []}, "comments": []}))
+    assert turn.correction_message() is not None
+    turn.feed(json.dumps({"graph": _GRAPH, "comments": []}))
+    assert turn.correction_message() is None
+    turn.finish()
+
+    assert turn.generated_xml is not None and 'id="Start_1"' in turn.generated_xml
+    assert cache.entries == {}
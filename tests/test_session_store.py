@@ -0,0 +1,16 @@
+from session_store import SessionStore
+
+
+def test_window_keeps_only_the_last_model_reply():
+    store = SessionStore(history_turns=4)
+    history = []
+    for turn in range(3):
+        history.append({"role": "user", "parts": [{"text": f"request {turn}"}]})
+        history.append({"role": "model", "parts": [{"text": f"<bpmn:definitions>{turn}" + "x" * 5000}]})
+
+    entries = store.compact(history)["history"]
+    replies = [e["parts"][0]["text"] for e in entries if e["role"] == "model"]
+
+    assert len(replies) == 3
+    assert replies[-1].startswith("<bpmn:definitions>2")
+    assert all("omitted" in reply and len(reply) < 100 for reply in replies[:-1])